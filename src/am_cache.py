@@ -0,0 +1,70 @@
+#
+# am_cache.py - on-disk cache of summarized am results.  This module
+# is not run directly; it is imported by am_runner.py.
+#
+# The output of am is fully determined by its configuration and the
+# version of am, so the key for a result is the full am configuration
+# (header and layers) together with the am version string.  The value
+# stored is the parsed result of the run (see am_runner.AmResult), so
+# that recovery runs and reprocessing of cycles already computed can
+# skip running am.  Entries are stored, hashed, and evicted in the
+# same way as in grib_cache.py, whose GribCache this extends.
+#
+# The cache is configured in the environment:
+#
+#   AM_RESULT_CACHE_DIR    - cache directory.  If unset or empty,
+#                            there is no caching.
+#   AM_RESULT_CACHE_MAX_MB - byte budget for the cache, in MB.
+#
+
+import os
+
+import grib_cache
+
+CACHE_DIR    = os.getenv('AM_RESULT_CACHE_DIR', '')
+CACHE_MAX_MB = float(os.getenv('AM_RESULT_CACHE_MAX_MB', '10'))
+
+CACHE_SUFFIX = ".am"
+
+
+class AmResultCache(grib_cache.GribCache):
+
+    suffix = CACHE_SUFFIX
+
+    def __init__(self, path=CACHE_DIR, max_bytes=CACHE_MAX_MB * 1e6):
+        super().__init__(path, max_bytes)
+
+
+#
+# Build the cache key for a run of a given am version on a given
+# configuration.
+#
+def result_key(am_version, config):
+    return "am " + am_version + "\n" + config
+
+
+#
+# Encode a result for storage in the cache, as a line of numbers
+# written in full precision, with the (tau, Tb) pairs for any extra
+# bands after the standard values, and decode it as a tuple of
+# floats.
+#
+def encode_result(result):
+    values = list(result[:6])
+    for band in result.bands:
+        values.extend(band)
+    return (" ".join(repr(float(x)) for x in values) + "\n").encode()
+
+
+def decode_result(content):
+    return tuple(float(x) for x in content.decode().split())
+
+
+#
+# Return a cache using the directory and budget set in the
+# environment, or None if caching is not configured.
+#
+def default_cache():
+    if not CACHE_DIR:
+        return None
+    return AmResultCache()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+#
+# am_coef_cache.py - management of am's own disk cache of absorption
+# coefficients.  When the environment variable AM_CACHE_PATH names a
+# directory, am saves the absorption coefficients it computes for
+# each layer there, and reuses them when a later run has a layer at
+# the same pressure, temperature, and mixing ratios on the same
+# frequency grid, instead of recomputing them line by line.  At a
+# fixed site, the model layers are at fixed pressure levels, and the
+# temperatures on them vary over a modest range from one forecast
+# hour to the next, so a warm cache saves much of the cost of an am
+# run.  (This is separate from the cache of summarized am results in
+# am_cache.py, which only helps when an identical configuration is
+# run again.)
+#
+# am itself puts no limit on the size of the cache, so the cache is
+# kept within a byte budget here, by pruning the least recently used
+# files.  Since am does not update the modification times of the
+# cache files it reads, recency is taken from the later of their
+# access and modification times.  On a file system mounted noatime,
+# or relatime (the Linux default, under which the access time is
+# only updated when it is older than the modification time or a day
+# old), the access time says little, and eviction is in effect by
+# creation or modification time.  The am processes of an AmPool (see
+# am_runner.py) all share one cache directory, and pruning may run
+# while they do: files are only ever unlinked, so an am process that
+# has a file open can still read it, and a file that has been pruned
+# is just a cache miss.  Concurrent prunes, e.g. by the forecast job
+# and forecast_daemon.py, are serialized with a lock file in the
+# cache directory.
+#
+# The cache is configured in the environment:
+#
+#   AM_CACHE_PATH   - cache directory, passed to am.  If unset or
+#                     empty, am does not cache absorption
+#                     coefficients.
+#   AM_CACHE_MAX_MB - byte budget for the cache, in MB.
+#
+# Used as a script, this takes a command:
+#
+#   am_coef_cache.py warm lat lon altitude gfsdate gfscycle
+#           [--products fxxx ...]
+#       warm up the cache by running am on the layers for a
+#       representative set of forecast hours of a GFS cycle, by
+#       default one per day of the forecast, with the GFS data put
+#       in the GRIB cache (see grib_cache.py) for later use, and
+#       report the mean time per am run without the cache, with the
+#       cache cold, and with it warm.
+#   am_coef_cache.py prune
+#       prune the cache to its byte budget.
+#
+
+import argparse
+import fcntl
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import am_runner
+import grib_cache
+from forecast_cycle import convert, extract
+from gfs_cycle import fetch_products
+from gfs_products import product_name
+
+CACHE_PATH   = os.getenv('AM_CACHE_PATH', '')
+CACHE_MAX_MB = float(os.getenv('AM_CACHE_MAX_MB', '1000'))
+
+LOCK_NAME = ".prune.lock"
+
+
+#
+# List the files in the cache as (path, size, last use) tuples.
+#
+def entries(path=CACHE_PATH):
+    entries = []
+    for dirpath, _, names in os.walk(path):
+        for name in names:
+            if name == LOCK_NAME:
+                continue
+            fpath = os.path.join(dirpath, name)
+            try:
+                st = os.stat(fpath)
+            except FileNotFoundError:
+                continue    # pruned by another process
+            entries.append((fpath, st.st_size, max(st.st_atime, st.st_mtime)))
+    return entries
+
+
+#
+# Remove least recently used files until the cache is within its
+# byte budget.  Returns the number of files removed and the number
+# of bytes remaining.
+#
+def prune(path=CACHE_PATH, max_bytes=CACHE_MAX_MB * 1e6):
+    if not os.path.isdir(path):
+        return 0, 0
+    with open(os.path.join(path, LOCK_NAME), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        files  = sorted(entries(path), key=lambda e: e[2])
+        nbytes = sum(size for _, size, _ in files)
+        nremoved = 0
+        for fpath, size, _ in files:
+            if nbytes <= max_bytes:
+                break
+            try:
+                os.remove(fpath)
+                nremoved += 1
+            except FileNotFoundError:
+                pass
+            nbytes -= size
+    return nremoved, nbytes
+
+
+#
+# Run am on a list of configurations, in up to workers concurrent
+# processes, with AM_CACHE_PATH set to cache_path in their
+# environment.  Returns the mean time per run.
+#
+def mean_run_time(configs, cache_path, workers):
+    env = dict(os.environ, AM_CACHE_PATH=cache_path)
+
+    def run(config):
+        t0 = time.monotonic()
+        am_runner.run_am(config, env)
+        return time.monotonic() - t0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        times = list(executor.map(run, configs))
+    return sum(times) / max(len(times), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command",  help="warm or prune",
+        choices=("warm", "prune"))
+    parser.add_argument("args",     help="for warm: lat lon altitude " +
+        "gfsdate gfscycle",
+        nargs="*")
+    parser.add_argument("--products",
+        help="for warm: products to run (default: one per day)",
+        nargs="+", metavar="fxxx")
+    args = parser.parse_args()
+
+    if not CACHE_PATH:
+        parser.error("AM_CACHE_PATH is not set")
+    if (args.command == "prune"):
+        nremoved, nbytes = prune()
+        print("Pruned {0} files, {1:.1f} MB in use.".format(
+                nremoved, nbytes / 1e6))
+        return
+    if len(args.args) != 5:
+        parser.error("warm takes lat lon altitude gfsdate gfscycle")
+
+    lat, lon, altitude = (float(x) for x in args.args[0:3])
+    gfsdate, gfscycle  = args.args[3], int(args.args[4])
+    if args.products is None:
+        args.products = [product_name(hour) for hour in range(0, 385, 24)]
+
+    configs = []
+    for prod, content in fetch_products(lat, lon, gfsdate, gfscycle,
+            args.products, grib_cache.default_cache()):
+        profiles = None if content is None else extract(content, lat, lon,
+                prod)
+        if profiles is None:
+            continue
+        converted = convert(profiles, lat, lon, altitude, gfsdate, gfscycle,
+                prod)
+        if converted is not None:
+            configs.append(am_runner.am_config(converted[0]))
+    if not configs:
+        print("No forecast hours to run.", file=sys.stderr)
+        exit(1)
+
+    os.makedirs(CACHE_PATH, exist_ok=True)
+    workers = am_runner.AM_WORKERS
+    t_none = mean_run_time(configs, "", workers)
+    t_cold = mean_run_time(configs, CACHE_PATH, workers)
+    t_warm = mean_run_time(configs, CACHE_PATH, workers)
+    print("Ran am on {0} forecast hours: ".format(len(configs)) +
+            "{0:.3f} s per run without the cache, ".format(t_none) +
+            "{0:.3f} s cold, {1:.3f} s warm.".format(t_cold, t_warm))
+    nremoved, nbytes = prune()
+    print("Pruned {0} files, {1:.1f} MB in use.".format(
+            nremoved, nbytes / 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+#
+# am_runner.py - in-process driver for am.  This runs am on a set of
+# model layers from gfs16_to_am10.py, passing the configuration to am
+# over a pipe from memory, and parses the am output directly into
+# the values summarized in a forecast table line.  This takes the
+# place of the pipeline
+#
+#   cat header.amc layers.amc | $AM - 2>&1 | awk -f summarize.awk
+#
+# formerly run for each forecast hour.  This module is not run
+# directly; it is imported by the scripts which compute forecast
+# tables.
+#
+# By default, am computes a single spectral point at 225 GHz, as set
+# up in header.amc.  Additional frequencies may be given in AM_BANDS,
+# in which case the frequency grid in the header is replaced by the
+# coarsest grid including 225 GHz and all of them, so that the
+# opacity and brightness temperature at every frequency come from a
+# single am run.  These are added to the table line, after the
+# standard columns, as tau and Tb for each frequency.  The bands
+# must be multiples of 1 MHz, and the grid is limited to
+# MAX_GRID_POINTS points, so that bands such as "345 690" are cheap
+# but a set of bands needing a fine grid is refused.
+#
+# If an am result cache is given (see am_cache.py), am is only run
+# for configurations not already in the cache.
+#
+# Many forecast hours are run through am at once by an AmPool, which
+# keeps up to AM_WORKERS am processes running concurrently.  Since
+# each am process uses OMP_NUM_THREADS threads, the default is to
+# run enough of them to occupy all the cores of the machine.
+#
+# This module depends on the following environment variables:
+#   AM              - path to am executable
+#   AM_VERSION      - am version string, part of the result cache key
+#                     (if unset, obtained by running am -v)
+#   AM_CACHE_PATH   - am absorption coefficient cache directory (see
+#                     am_coef_cache.py), passed on to am
+#   APPDIR          - directory containing header.amc (defaults to
+#                     the directory containing this module)
+#   AM_BANDS        - additional frequencies [GHz] to be computed,
+#                     separated by spaces, e.g. "345 690"
+#   AM_WORKERS      - number of concurrent am processes (if unset or
+#                     empty, the number of cores / OMP_NUM_THREADS)
+#   OMP_NUM_THREADS - number of threads used by each am process
+#
+
+import collections
+import functools
+import math
+import os
+import re
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import am_cache
+
+AM     = os.getenv('AM', 'am')
+APPDIR = os.getenv('APPDIR', os.path.dirname(os.path.abspath(__file__)))
+
+AM_THREADS = int(os.getenv('OMP_NUM_THREADS', '1'))
+AM_WORKERS = int(os.getenv('AM_WORKERS') or
+        max((os.cpu_count() or 1) // max(AM_THREADS, 1), 1))
+
+HEADER_PATH = os.path.join(APPDIR, "header.amc")
+
+with open(HEADER_PATH) as f:
+    HEADER = f.read()
+
+AM_ERROR_LINES = 5      # lines of am output reported when am fails
+
+F_TAU       = 225.0     # frequency of the standard tau and Tb columns [GHz]
+EXTRA_BANDS = tuple(float(f) for f in os.getenv('AM_BANDS', '').split())
+
+MAX_GRID_POINTS = 100   # largest frequency grid allowed for AM_BANDS
+
+# column density units (cm^-2 equivalents)
+MM_PWV   = 3.3427e21
+KG_ON_M2 = 3.3427e21
+DU       = 2.6868e16
+
+#
+# Summary of an am run on the single-point spectrum set up in
+# header.amc:
+#   tau - zenith opacity at 225 GHz
+#   Tb  - zenith brightness temperature at 225 GHz [K]
+#   pwv - precipitable water vapor [mm]
+#   lwp - liquid water path [kg * m^-2]
+#   iwp - ice water path [kg * m^-2]
+#   o3  - ozone column [DU]
+#   bands - (tau, Tb) at each of the EXTRA_BANDS frequencies, or an
+#           empty tuple if these were not computed
+#
+AmResult = collections.namedtuple("AmResult",
+        ("tau", "Tb", "pwv", "lwp", "iwp", "o3", "bands"))
+AmResult.__new__.__defaults__ = ((),)
+
+_number_re = re.compile(r"[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?")
+
+_am_version      = os.getenv('AM_VERSION', '')
+_am_version_lock = threading.Lock()
+
+
+#
+# Return the am version string, as found in the output of am -v.
+#
+def am_version():
+    global _am_version
+    with _am_version_lock:
+        if not _am_version:
+            p = subprocess.run([AM, "-v"], stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT)
+            for line in p.stdout.decode().splitlines():
+                fields = line.split()
+                if fields[0:2] == ["am", "version"] and len(fields) > 2:
+                    _am_version = fields[2]
+                    break
+    return _am_version
+
+
+#
+# Return the am frequency grid statement for the coarsest grid
+# including all the given frequencies [GHz].  Raises ValueError if a
+# frequency is not a multiple of 1 MHz, or if the grid would have
+# more than MAX_GRID_POINTS points.
+#
+def frequency_grid(freqs):
+    mhz = [int(round(1000. * f)) for f in freqs]
+    for f, m in zip(freqs, mhz):
+        if m <= 0 or abs(1000. * f - m) > 1e-6:
+            raise ValueError("AM_BANDS: {0} GHz is not a positive "
+                    "multiple of 1 MHz".format(f))
+    df      = functools.reduce(math.gcd, mhz)
+    npoints = (max(mhz) - min(mhz)) // df + 1
+    if npoints > MAX_GRID_POINTS:
+        raise ValueError("AM_BANDS: the grid including {0} GHz has {1} "
+                "points at {2:g} GHz spacing, more than the limit of {3}; "
+                "round the bands to a coarser common spacing".format(
+                " ".join("{0:g}".format(f) for f in sorted(freqs)),
+                npoints, df / 1000., MAX_GRID_POINTS))
+    return "f {0:g} GHz {1:g} GHz {2:g} GHz".format(
+            min(mhz) / 1000., max(mhz) / 1000., df / 1000.)
+
+
+if EXTRA_BANDS:
+    HEADER = re.sub(r"^f .*$", frequency_grid((F_TAU,) + EXTRA_BANDS),
+            HEADER, count=1, flags=re.MULTILINE)
+
+
+#
+# Return the full am configuration for a set of model layers.
+#
+def am_config(layers):
+    return HEADER + layers
+
+
+#
+# Run am on a configuration, returning its exit status, and its
+# stderr and stdout merged as text.  am runs in the given
+# environment, by default that of this process.
+#
+def run_am(config, env=None):
+    p = subprocess.run([AM, "-"], input=config.encode(),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+    return p.returncode, p.stdout.decode()
+
+
+#
+# Numeric value of the leading part of a field, or 0 if there is
+# none, as for a string used as a number in awk.
+#
+def _number(field):
+    m = _number_re.match(field)
+    return float(m.group(0)) if m else 0.0
+
+
+#
+# Parse am output into an AmResult.  The column densities are taken
+# from the comment lines am writes to stderr for each column type,
+# and tau and Tb from the lines of the output spectrum.  Without
+# EXTRA_BANDS, the spectrum has a single line, and the last line is
+# used.  Otherwise, the line nearest each frequency is used.  Column
+# densities not found in the output are 0.  If the output has no
+# spectrum, as when am fails, None is returned.
+#
+def parse_output(output):
+    pwv = lwp = iwp = o3 = tau = Tb = 0.0
+    spectrum = []
+    for line in output.splitlines():
+        if line.startswith("#"):
+            fields = line.split() + ["", "", ""]
+            if "h2o" in line:
+                pwv = _number(fields[2]) / MM_PWV
+            if "lwp_abs_Rayleigh" in line:
+                lwp = _number(fields[2]) / KG_ON_M2
+            if "iwp_abs_Rayleigh" in line:
+                iwp = _number(fields[2]) / KG_ON_M2
+            if "o3" in line:
+                o3  = _number(fields[2]) / DU
+        elif line[:1].isdigit():
+            fields = line.split() + ["", "", ""]
+            spectrum.append(
+                    (_number(fields[0]), _number(fields[1]), _number(fields[2])))
+    if not spectrum:
+        return None
+    if not EXTRA_BANDS:
+        _, tau, Tb = spectrum[-1]
+        return AmResult(tau, Tb, pwv, lwp, iwp, o3)
+
+    def at(f):
+        return min(spectrum, key=lambda line: abs(line[0] - f))[1:]
+    tau, Tb = at(F_TAU)
+    return AmResult(tau, Tb, pwv, lwp, iwp, o3,
+            tuple(at(f) for f in EXTRA_BANDS))
+
+
+#
+# Return the AmResult for a set of model layers.  If a result cache
+# is given, the result is taken from it if present.  Otherwise am is
+# run, and if it succeeds, the result is put in the cache.  If am
+# fails, with a nonzero exit status or no spectrum in its output, the
+# end of its output is written to stderr, and None is returned.  The
+# cache is not used if the am version is unknown.
+#
+def am_result(layers, cache=None):
+    config = am_config(layers)
+    key = None
+    if cache is not None and am_version():
+        key = am_cache.result_key(am_version(), config)
+        content = cache.get(key)
+        if content is not None:
+            values = am_cache.decode_result(content)
+            return AmResult(*values[:6],
+                    bands=tuple(zip(values[6::2], values[7::2])))
+    status, output = run_am(config)
+    result = parse_output(output)
+    if status != 0 or result is None:
+        print("am failed with exit status {0}:\n".format(status) +
+                "\n".join(output.splitlines()[-AM_ERROR_LINES:]),
+                file=sys.stderr)
+        return None
+    if key is not None:
+        cache.put(key, am_cache.encode_result(result))
+    return result
+
+
+#
+# Format a forecast table line, with the given time stamp.  If the
+# result has no data for the EXTRA_BANDS, e.g. for a provisional
+# line, those columns are filled with nan.
+#
+def format_row(timestamp, result):
+    bands = result.bands or ((math.nan, math.nan),) * len(EXTRA_BANDS)
+    values = list(result[:6])
+    for tau, Tb in bands:
+        values.extend((tau, Tb))
+    return timestamp + "".join(" {0:12.4e}".format(x) for x in values) + "\n"
+
+
+#
+# Return the names of the table columns for the EXTRA_BANDS.
+#
+def band_columns():
+    names = []
+    for f in EXTRA_BANDS:
+        names.extend(("tau{0:g}".format(f), "Tb{0:g}[K]".format(f)))
+    return names
+
+
+#
+# Pool of concurrent am runs.  Each run is a separate am process,
+# so the threads here do nothing but wait on them.
+#
+class AmPool:
+
+    def __init__(self, workers=AM_WORKERS, max_pending=None, cache=None):
+        if workers < 1:
+            raise ValueError("workers must be positive")
+        self.workers     = workers
+        self.max_pending = 2 * workers if max_pending is None else max_pending
+        self.cache       = cache
+
+    #
+    # Compute results for a sequence of jobs, given as (key, layers)
+    # pairs, with am_result() and the result cache of the pool, if
+    # any.  This is a generator yielding (key, AmResult) pairs in the
+    # order the jobs were given, with None for jobs on which am
+    # failed.  No more than max_pending jobs are taken from the
+    # sequence ahead of the results yielded, so that if the jobs are
+    # themselves generated lazily, e.g. as GFS data are downloaded,
+    # the producer is held back when am falls behind, and the number
+    # of jobs in memory stays bounded.
+    #
+    def map(self, jobs):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = collections.deque()
+            for key, layers in jobs:
+                if len(pending) >= self.max_pending:
+                    k, future = pending.popleft()
+                    yield k, future.result()
+                pending.append((key, executor.submit(
+                        am_result, layers, self.cache)))
+            while pending:
+                k, future = pending.popleft()
+                yield k, future.result()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+#
+# backfill.py - compute the forecast tables for all the GFS cycles in
+# a range of dates, e.g. to fill in after a long outage, or to
+# recompute the archive after a change of am version.  The job script
+# only looks back 48 hours.
+#
+# The cycles are processed concurrently, each in its own process
+# from a pool of --jobs processes, and within each cycle, the
+# forecast hours are processed as described in forecast_cycle.py,
+# with many am runs at once.  The am processes and the NOMADS
+# request rate, burst, and connections (see nomads.py) are divided
+# evenly among the cycle processes, so that the backfill as a whole
+# stays within the same limits as a single forecast_cycle.py.
+#
+# Progress is checkpointed hour by hour in the cycle state
+# directories (see forecast_manifest.py), so a backfill that is
+# interrupted, or that leaves hours missing, can simply be run again
+# to finish; complete cycles are skipped, as are cycles locked by
+# another process, e.g. the forecast job (see forecast_manifest.py),
+# which are reported as not finished.  As each cycle finishes,
+# its table is written to the site forecast directory.  Progress,
+# counted in forecast hours from the cycle state, and the throughput
+# so far are written to stderr as each cycle finishes, and every
+# PROGRESS_INTERVAL seconds in between.
+#
+# NOMADS only keeps about ten days of GFS data.  Older cycles can be
+# recomputed with --reprocess from the profile archive (see
+# profile_archive.py), with no network access.  To recompute cycles
+# already complete, e.g. with a new am version, use a new directory
+# for the cycle state.
+#
+# This script depends on the environment variables used by
+# forecast_cycle.py.
+#
+
+import argparse
+import datetime
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import am_cache
+import am_runner
+import grib_cache
+import nomads
+import profile_archive
+from forecast_cycle import cycle_rows
+from forecast_manifest import Manifest, lock_cycle, write_table
+from gfs_products import valid_time_str
+
+JOBS              = 2     # Default number of cycles processed concurrently
+PROGRESS_INTERVAL = 60    # Time between progress reports [s]
+
+
+#
+# Return the analysis times of the GFS cycles from the first cycle
+# of start to the last cycle of end, given as dates (YYYYMMDD), in
+# order.
+#
+def cycle_times(start, end):
+    t    = datetime.datetime.strptime(start, "%Y%m%d")
+    tend = datetime.datetime.strptime(end, "%Y%m%d") + datetime.timedelta(
+            hours=18)
+    times = []
+    while t <= tend:
+        times.append(t)
+        t += datetime.timedelta(hours=6)
+    return times
+
+
+#
+# Return the cycle state directory for the cycle at time t.
+#
+def cycle_dir(cycles_dir, t):
+    return os.path.join(cycles_dir,
+            valid_time_str(t.strftime("%Y%m%d"), t.hour, 0))
+
+
+#
+# Return the total number of hours missing from the given cycles,
+# without creating the directories of cycles not yet started.
+#
+def count_missing(cycles_dir, times):
+    return sum(len(Manifest(cycle_dir(cycles_dir, t), create=False).missing())
+            for t in times)
+
+
+#
+# Compute the missing hours of one cycle, and write its table,
+# unless another process has the cycle locked.  This runs in a
+# worker process, using the given shares of the am processes and of
+# the NOMADS limits.  Returns the table name, the number of hours
+# completed, and the number still missing.
+#
+def backfill_cycle(args, t, am_workers, rate, burst, connections):
+    gfsdate  = t.strftime("%Y%m%d")
+    gfscycle = t.hour
+    basename = valid_time_str(gfsdate, gfscycle, 0)
+    manifest = Manifest(cycle_dir(args.cycles_dir, t))
+    missing  = manifest.missing()
+    if not missing:
+        return basename, 0, 0
+    lock = lock_cycle(manifest.path)
+    if lock is None:
+        return basename, 0, len(missing)
+    with lock:
+        missing = manifest.missing()
+        ndone = compute_cycle(args, manifest, gfsdate, gfscycle, missing,
+                am_workers, rate, burst, connections)
+        if ndone:
+            write_table(manifest, args.tabledir, basename)
+    return basename, ndone, len(missing) - ndone
+
+
+#
+# Compute the given missing hours of one cycle, marking them in its
+# manifest.  Returns the number of hours completed.
+#
+def compute_cycle(args, manifest, gfsdate, gfscycle, missing, am_workers,
+        rate, burst, connections):
+    limiter = nomads.TokenBucket(rate=rate, burst=burst)
+    pool    = am_runner.AmPool(workers=am_workers,
+            cache=am_cache.default_cache())
+    archive = profile_archive.default_archive()
+    cache   = None if args.reprocess else grib_cache.default_cache()
+    ndone = 0
+    try:
+        for prod, row, features in cycle_rows(args.lat, args.lon,
+                args.altitude, gfsdate, gfscycle, missing, cache, limiter,
+                pool, archive=archive, reprocess=args.reprocess,
+                max_connections=connections):
+            if row is not None:
+                manifest.mark(prod, row, features)
+                ndone += 1
+    finally:
+        if archive is not None and not args.reprocess:
+            archive.consolidate(gfsdate, gfscycle, args.lat, args.lon)
+    return ndone
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("lat",        help="site latitude [deg], (-90 to 90)",
+        type=float)
+    parser.add_argument("lon",        help="site longitude [deg], (-180 to 180)",
+        type=float)
+    parser.add_argument("altitude",   help="site altitude [m]",
+        type=float)
+    parser.add_argument("start",      help="first date (YYYYMMDD)",
+        type=str)
+    parser.add_argument("end",        help="last date (YYYYMMDD)",
+        type=str)
+    parser.add_argument("cycles_dir", help="directory for cycle state",
+        type=str)
+    parser.add_argument("tabledir",   help="site forecast table directory",
+        type=str)
+    parser.add_argument("--jobs",
+        help="number of cycles processed at once (default {0})".format(
+        JOBS),
+        type=int, default=JOBS)
+    parser.add_argument("--reprocess",
+        help="take the profiles from the profile archive instead of " +
+        "downloading GFS data (see profile_archive.py)",
+        action="store_true")
+    args = parser.parse_args()
+
+    if (args.lat < -90. or args.lat > 90.):
+        parser.error("invalid latitude")
+    if (args.lon < -180. or args.lon > 180.):
+        parser.error("invalid longitude")
+    if (args.altitude < -500.):
+        parser.error("invalid altitude")
+    if (args.jobs < 1):
+        parser.error("invalid number of jobs")
+    try:
+        times = cycle_times(args.start, args.end)
+    except ValueError:
+        parser.error("invalid date")
+    if not times:
+        parser.error("end date is before start date")
+    if args.reprocess and profile_archive.default_archive() is None:
+        parser.error("PROFILE_ARCHIVE_DIR is not set")
+
+    am_workers  = max(am_runner.AM_WORKERS // args.jobs, 1)
+    rate        = nomads.REQUEST_RATE / args.jobs
+    burst       = max(nomads.REQUEST_BURST // args.jobs, 1)
+    connections = max(nomads.MAX_CONNECTIONS // args.jobs, 1)
+
+    ntodo = count_missing(args.cycles_dir, times)
+    ncycles = nmissing = nfail = 0
+    t0 = time.monotonic()
+
+    def report(label):
+        ndone   = ntodo - count_missing(args.cycles_dir, times)
+        t_total = time.monotonic() - t0
+        print("{0}{1} of {2} hours in {3:.0f} s ".format(
+                label, ndone, ntodo, t_total) +
+                "({0:.2f} hours/s), {1} of {2} cycles finished.".format(
+                ndone / max(t_total, 1e-9), ncycles, len(times)),
+                file=sys.stderr)
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(backfill_cycle, args, t, am_workers,
+                rate, burst, connections): t for t in times}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=PROGRESS_INTERVAL,
+                    return_when=FIRST_COMPLETED)
+            if not done:
+                report("")
+            for future in done:
+                ncycles += 1
+                try:
+                    basename, n, nleft = future.result()
+                except Exception as err:
+                    t = futures[future]
+                    print("{0}: failed: {1}".format(valid_time_str(
+                            t.strftime("%Y%m%d"), t.hour, 0), err),
+                            file=sys.stderr)
+                    nfail += 1
+                    continue
+                nmissing += nleft
+                report("{0}: completed {1} hours, {2} missing; ".format(
+                        basename, n, nleft))
+    exit(1 if nmissing or nfail else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# bench_table_load.py - microbenchmark of the loading of the nine
+# latest forecast tables by plot_forecast.py.  This compares the
+# former way of loading each table, with one np.loadtxt() pass for
+# the date strings and another for the numeric columns, and a
+# Python loop converting each date string with strptime() and
+# date2num(), against forecast_store.read_table(), which reads each
+# table in a single pass into a structured array, converting the
+# time stamps to datetime64 and then to plot time all at once.  For
+# scale, the time to render a figure of the data like those made by
+# plot_forecast.py is also measured.
+#
+# Each method is timed over the whole set of tables, repeated a
+# given number of times, and the best time is reported, as with
+# timeit.
+#
+#   bench_table_load.py DATADIR [--repeat N] [--hours H]
+#
+
+import argparse
+import datetime
+import io
+import os
+import time
+
+import dateutil
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.dates as mdates
+import matplotlib.pyplot as plt
+import numpy as np
+
+import forecast_store
+
+FILENAMES = ('latest-48', 'latest-42', 'latest-36', 'latest-30',
+        'latest-24', 'latest-18', 'latest-12', 'latest-06', 'latest')
+REPEAT    = 20
+
+tz_UTC = dateutil.tz.gettz("UTC")
+
+
+#
+# Load a table as plot_forecast.py did before read_table().  Returns
+# the plot times and the numeric columns.
+#
+def load_loadtxt(fpath):
+    time_str = np.loadtxt(fpath, dtype=str, usecols=(0,), skiprows=1,
+            unpack=True)
+    columns = np.loadtxt(fpath, usecols=(1, 2, 3, 4, 5, 6), skiprows=1,
+            unpack=True)
+    time_plottime = []
+    for s in time_str.tolist():
+        dtime = datetime.datetime.strptime(s,
+                "%Y%m%d_%H:%M:%S").replace(tzinfo=tz_UTC)
+        time_plottime.append(mdates.date2num(dtime))
+    return np.asarray(time_plottime), columns
+
+
+#
+# Load a table with read_table().  Returns the plot times and the
+# numeric columns.
+#
+def load_single_pass(fpath):
+    table = forecast_store.read_table(fpath)
+    return (mdates.date2num(table["time"]),
+            [table[name] for name in table.dtype.names[1:7]])
+
+
+#
+# Render a five-panel figure of the tables, to PNG in memory, and
+# return the time taken.
+#
+def render(tables, hours):
+    t0 = time.perf_counter()
+    fig, axes_arr = plt.subplots(nrows=5,
+            gridspec_kw={'height_ratios':[2,1,1,1,1]}, sharex=True,
+            figsize=(6, 8))
+    axes_arr[0].set_yscale('log')
+    xmin = tables[0][0][0]
+    for time_plottime, columns in tables:
+        mask = time_plottime <= xmin + 2. + hours / 24.
+        for axes, k in zip(axes_arr, (0, 2, 3, 4, 5)):
+            axes.plot(time_plottime[mask], columns[k][mask], linewidth=0.3)
+    fig.savefig(io.BytesIO(), format='png', dpi=150)
+    plt.close(fig)
+    return time.perf_counter() - t0
+
+
+#
+# Return the best time over repeat runs of loading all the tables
+# with the given function, and the loaded tables.
+#
+def best_time(load, fpaths, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        tables = [load(fpath) for fpath in fpaths]
+        best = min(best, time.perf_counter() - t0)
+    return best, tables
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("datadir", help="data directory with the latest " +
+        "tables (latest, latest-06, ... latest-48)",
+        type=str)
+    parser.add_argument("--repeat",
+        help="number of repeats (default {0})".format(REPEAT),
+        type=int, default=REPEAT)
+    parser.add_argument("--hours",
+        help="hours forward to render (default 384)",
+        type=int, default=384)
+    args = parser.parse_args()
+
+    fpaths = [os.path.join(args.datadir, fname) for fname in FILENAMES]
+    for fpath in fpaths:
+        if not os.path.exists(fpath):
+            parser.error("no table {0}".format(fpath))
+    if (args.repeat < 1):
+        parser.error("invalid number of repeats")
+
+    t_old, old = best_time(load_loadtxt, fpaths, args.repeat)
+    t_new, new = best_time(load_single_pass, fpaths, args.repeat)
+    for (x_old, y_old), (x_new, y_new) in zip(old, new):
+        if (not np.allclose(x_old, x_new, rtol=0, atol=1e-9) or
+                not np.array_equal(y_old, y_new)):
+            print("Warning: the methods disagree.")
+            break
+    t_render = min(render(new, args.hours) for _ in range(3))
+    nrows = sum(len(x) for x, _ in new)
+    print("Loaded {0} tables, {1} rows, best of {2}:".format(
+            len(fpaths), nrows, args.repeat))
+    print("  two loadtxt passes, strptime loop: {0:8.2f} ms".format(
+            1e3 * t_old))
+    print("  single pass, datetime64:           {0:8.2f} ms".format(
+            1e3 * t_new))
+    print("  speedup:                           {0:8.1f}x".format(
+            t_old / max(t_new, 1e-12)))
+    print("Rendering a {0} hour figure: {1:.2f} ms".format(
+            args.hours, 1e3 * t_render))
+
+
+if __name__ == "__main__":
+    main()
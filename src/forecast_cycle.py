@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+#
+# forecast_cycle.py - for a given site latitude, longitude, and
+# altitude, compute the forecast table lines for the forecast hours
+# of one GFS production cycle not yet complete in the cycle state
+# directory (see forecast_manifest.py), or for a given subset of
+# them, and record them there as they are completed.
+#
+# This is a streaming pipeline, run within this one process.  GFS
+# data are retrieved as described in gfs_cycle.py, and as each
+# product arrives, it is converted to am layers and queued to run
+# through am in an AmPool (see am_runner.py), which runs many am
+# processes at once.  The lines are recorded in forecast hour order.
+# Each stage holds back the one before it when it falls behind, so
+# the amount of data in memory stays bounded however many hours are
+# processed.  With --surrogate, a first pass is made instead, with
+# provisional lines computed by the surrogate model (see
+# surrogate.py), leaving the hours to be completed by am.  am is not
+# run for hours whose results are already in the am result cache
+# (see am_cache.py).  At the end, a summary is written to stderr.
+#
+# The GFS profiles interpolated to the site are kept in the profile
+# archive, if there is one (see profile_archive.py).  With
+# --reprocess, the profiles are taken from the archive instead of
+# being downloaded, so that a cycle can be recomputed, e.g. with a
+# new version of am, with no network access.
+#
+# The cycle is locked for as long as this runs (see
+# forecast_manifest.py).  If another process, e.g. the forecast job
+# or the daemon, holds the lock, this exits at once with status 1.
+#
+
+import argparse
+import sys
+import time
+
+import am_cache
+import am_runner
+import gfs16_to_am10
+import grib_cache
+import nomads
+import profile_archive
+import surrogate
+from forecast_manifest import Manifest, lock_cycle
+from gfs_cycle import fetch_products
+from gfs_products import (FORECAST_HOURS, product_hour, product_name,
+    valid_time_str)
+
+#
+# Extract the profiles interpolated to the site from the GRIB data
+# for one product, or return None if this fails.
+#
+def extract(content, lat, lon, prod):
+    try:
+        profiles, _ = gfs16_to_am10.extract_profiles(content, lat, lon)
+    except Exception as err:
+        print("{0}: conversion failed: {1}".format(prod, err),
+                file=sys.stderr)
+        return None
+    return profiles
+
+
+#
+# Convert the profiles for one product to am layers, returning them
+# with the surrogate features of the product (see surrogate.py), or
+# None if conversion fails.
+#
+def convert(profiles, lat, lon, altitude, gfsdate, gfscycle, prod):
+    try:
+        layers = gfs16_to_am10.derive_layers(profiles, altitude)
+        text = gfs16_to_am10.render_layers(layers, lat, lon, altitude,
+                gfsdate, gfscycle, prod)
+    except ValueError as err:
+        print("{0}: conversion failed: {1}".format(prod, err),
+                file=sys.stderr)
+        return None
+    return text, surrogate.features(layers)
+
+
+#
+# Compute the forecast table lines for a set of products of a GFS
+# cycle.  This is a generator yielding (product, row, features)
+# tuples in forecast hour order, with row None for products that
+# could not be downloaded or converted, or on which am failed.  A row
+# is yielded as soon as it and those for all the earlier hours are
+# done.  If a surrogate model is given, the rows are computed with it
+# rather than with am, and the column densities in them are those of
+# the features.  If a profile archive is given, the profiles of each
+# product are put in it, or with reprocess, taken from it rather than
+# downloaded.  Downloads are made as described in
+# gfs_cycle.fetch_products().
+#
+def cycle_rows(lat, lon, altitude, gfsdate, gfscycle, prods, cache=None,
+        limiter=None, pool=None, model=None, archive=None, reprocess=False,
+        max_connections=nomads.MAX_CONNECTIONS):
+    if pool is None:
+        pool = am_runner.AmPool()
+    order   = sorted(prods, key=product_hour)
+    feats   = {}
+    results = {}
+
+    def sources():
+        if reprocess:
+            stored = archive.get(gfsdate, gfscycle, lat, lon)
+            for prod in order:
+                if prod not in stored:
+                    print("{0}: not in profile archive".format(prod),
+                            file=sys.stderr)
+                yield prod, stored.get(prod)
+            return
+        for prod, content in fetch_products(lat, lon, gfsdate, gfscycle,
+                prods, cache, limiter, max_connections):
+            profiles = None
+            if content is not None:
+                profiles = extract(content, lat, lon, prod)
+            if profiles is not None and archive is not None:
+                archive.put(gfsdate, gfscycle, prod, profiles, lat, lon)
+            yield prod, profiles
+
+    def jobs():
+        for prod, profiles in sources():
+            converted = None
+            if profiles is not None:
+                converted = convert(profiles, lat, lon, altitude,
+                        gfsdate, gfscycle, prod)
+            if converted is None:
+                results[prod] = None
+                continue
+            layers, feats[prod] = converted
+            yield prod, layers
+
+    def estimates():
+        for prod, layers in jobs():
+            F = feats[prod]
+            tau, Tb = model.predict(F)
+            yield prod, am_runner.AmResult(tau, Tb, F[0], F[1], F[2], F[3])
+
+    k = 0
+    for prod, result in (pool.map(jobs()) if model is None else estimates()):
+        if result is None:
+            results[prod] = None
+        else:
+            results[prod] = am_runner.format_row(valid_time_str(gfsdate,
+                    gfscycle, product_hour(prod)), result)
+        while k < len(order) and order[k] in results:
+            yield order[k], results.pop(order[k]), feats.pop(order[k], None)
+            k += 1
+    for prod in order[k:]:
+        yield prod, results.pop(prod), feats.pop(prod, None)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("lat",       help="site latitude [deg], (-90 to 90)",
+        type=float)
+    parser.add_argument("lon",       help="site longitude [deg], (-180 to 180)",
+        type=float)
+    parser.add_argument("altitude",  help="site altitude [m]",
+        type=float)
+    parser.add_argument("gfsdate",   help="GFS production date (YYYYMMDD)",
+        type=str)
+    parser.add_argument("gfscycle",  help="GFS production cycle (0, 6, 12, 18)",
+        type=int)
+    parser.add_argument("cycle_dir", help="cycle state directory",
+        type=str)
+    parser.add_argument("--no-cache",
+        help="bypass the GRIB cache (see grib_cache.py)",
+        action="store_true")
+    parser.add_argument("--products",
+        help="process only these products (default: all those missing)",
+        nargs="+", metavar="fxxx")
+    parser.add_argument("--surrogate",
+        help="compute provisional rows with this surrogate model " +
+        "instead of am (see surrogate.py)",
+        type=str, metavar="MODEL")
+    parser.add_argument("--reprocess",
+        help="take the profiles from the profile archive instead of " +
+        "downloading GFS data (see profile_archive.py)",
+        action="store_true")
+    args = parser.parse_args()
+
+    if (args.lat < -90. or args.lat > 90.):
+        parser.error("invalid latitude")
+    if (args.lon < -180. or args.lon > 180.):
+        parser.error("invalid longitude")
+    if (args.altitude < -500.):
+        parser.error("invalid altitude")
+    if (args.gfscycle not in (0, 6, 12, 18)):
+        parser.error("invalid GFS production cycle")
+    manifest = Manifest(args.cycle_dir)
+    lock = lock_cycle(manifest.path)    # held until exit
+    if lock is None:
+        print("{0}: locked by another process.".format(args.cycle_dir),
+                file=sys.stderr)
+        exit(1)
+    if args.products is None:
+        args.products = manifest.missing()
+    all_prods = [product_name(hour) for hour in FORECAST_HOURS]
+    for prod in args.products:
+        if prod not in all_prods:
+            parser.error("invalid product {0}".format(prod))
+
+    model = None
+    if args.surrogate is not None:
+        try:
+            model = surrogate.load(args.surrogate)
+        except (OSError, ValueError) as err:
+            parser.error("cannot load surrogate model: {0}".format(err))
+
+    archive = profile_archive.default_archive()
+    if args.reprocess:
+        if archive is None:
+            parser.error("PROFILE_ARCHIVE_DIR is not set")
+        try:
+            archive.get(args.gfsdate, args.gfscycle, args.lat, args.lon)
+        except ValueError as err:
+            parser.error("cannot reprocess: {0}".format(err))
+
+    cache = None if args.no_cache else grib_cache.default_cache()
+    pool  = am_runner.AmPool(cache=am_cache.default_cache())
+
+    t0 = time.monotonic()
+    nfail = 0
+    try:
+        for prod, row, features in cycle_rows(args.lat, args.lon,
+                args.altitude, args.gfsdate, args.gfscycle, args.products,
+                cache, pool=pool, model=model, archive=archive,
+                reprocess=args.reprocess):
+            if row is None:
+                nfail += 1
+            elif model is None:
+                manifest.mark(prod, row, features)
+            else:
+                manifest.mark_provisional(prod, row)
+    finally:
+        if archive is not None and not args.reprocess:
+            archive.consolidate(args.gfsdate, args.gfscycle, args.lat,
+                    args.lon)
+    t_total = time.monotonic() - t0
+
+    nprod = len(args.products)
+    if model is None:
+        method = "with {0} concurrent am processes".format(pool.workers)
+    else:
+        method = "with the surrogate model (provisional)"
+    print("Completed {0} of {1} forecast hours in {2:.1f} s {3}.".format(
+            nprod - nfail, nprod, t_total, method), file=sys.stderr)
+    stats = nomads.retry_stats()
+    print("Made {0} attempts with {1} retries ".format(
+            stats["attempts"], stats["retries"]) +
+            "({0} throttled, {1:.0f} s waiting); ".format(
+            stats["throttled"], stats["wait"]) +
+            "circuit breaker tripped {0} times, deferring {1} requests.".format(
+            stats["trips"], stats["deferred"]), file=sys.stderr)
+    if cache is not None:
+        stats = cache.stats()
+        print("GRIB cache: {0} hits, {1} misses, {2:.1f} MB in use.".format(
+                stats["hits"], stats["misses"], stats["bytes"] / 1e6),
+                file=sys.stderr)
+    if pool.cache is not None:
+        stats = pool.cache.stats()
+        nlookup = stats["hits"] + stats["misses"]
+        print("am result cache: {0} hits, {1} misses ".format(
+                stats["hits"], stats["misses"]) +
+                "({0:.0f}% hit rate), {1:.1f} MB in use.".format(
+                100. * stats["hits"] / max(nlookup, 1), stats["bytes"] / 1e6),
+                file=sys.stderr)
+    exit(1 if nfail else 0)
+
+
+if __name__ == "__main__":
+    main()
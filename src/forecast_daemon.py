@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+#
+# forecast_daemon.py - long-running alternative to waiting for a
+# whole GFS cycle to be produced before building its forecast table.
+# For a given site latitude, longitude, and altitude, this polls the
+# NOMADS server for the products of the most recent GFS cycles, and
+# processes each forecast hour as soon as NOAA publishes it, rather
+# than GFS_PRODUCTION_LAG hours after the analysis time.
+#
+# Availability is checked cheaply, with HEAD requests for the index
+# (.idx) file NOAA writes alongside each product file.  Products are
+# posted in hour order, so if the last missing product of a cycle is
+# available, all of them are; otherwise the missing products are
+# probed in order up to the first one not yet posted, with at most
+# MAX_PROBES probes per cycle on each pass.  The available products
+# are processed as described in forecast_cycle.py, and each table
+# line is checkpointed in the cycle state directory (see
+# forecast_manifest.py) as it is completed.  The table for the
+# cycle, with the hours completed so far, is then rewritten in the
+# site forecast directory.
+#
+# Cycle state directories and tables are named as they are by
+# sma-met-forecast_job.sh, which still publishes the tables and
+# plots.  When it runs, it finds the hours already done by the
+# daemon in the manifest, and computes only those remaining.  A
+# cycle the job is working on is locked (see forecast_manifest.py),
+# and is skipped until the job has finished with it.
+#
+# The profiles of each forecast hour are kept in the profile archive,
+# if there is one (see profile_archive.py).  After each pass, am's
+# absorption coefficient cache, if any, is pruned to its byte budget
+# (see am_coef_cache.py).
+#
+# This script depends on the environment variables used by
+# am_runner.py, am_cache.py, am_coef_cache.py, nomads.py,
+# grib_cache.py, and profile_archive.py.
+#
+
+import argparse
+import datetime
+import os
+import sys
+import time
+
+import am_cache
+import am_coef_cache
+import am_runner
+import gfs16_to_am10
+import grib_cache
+import nomads
+import profile_archive
+from forecast_cycle import cycle_rows
+from forecast_manifest import Manifest, lock_cycle, write_table
+from gfs_products import valid_time_str
+
+POLL_INTERVAL = 60       # Default time between polls [s]
+NUM_CYCLES    = 2        # Default number of recent cycles to follow
+MAX_PROBES    = 16       # Maximum availability probes per cycle per pass
+
+
+#
+# Return the analysis times of the most recent ncycles GFS cycles,
+# newest first, whether or not any of their products are available
+# yet.
+#
+def recent_cycles(ncycles):
+    now = datetime.datetime.utcnow()
+    latest = now.replace(hour=(now.hour - now.hour % 6), minute=0,
+            second=0, microsecond=0)
+    return [latest - datetime.timedelta(hours=(6 * k))
+            for k in range(ncycles)]
+
+
+#
+# Return those of the missing products of a cycle, given in hour
+# order, which are available on the server.
+#
+def available_products(gfsdate, gfscycle, missing, limiter):
+    if nomads.available(gfs16_to_am10.index_url(
+            gfsdate, gfscycle, missing[-1]), limiter):
+        return missing
+    ready = []
+    for prod in missing[:MAX_PROBES]:
+        if not nomads.available(gfs16_to_am10.index_url(
+                gfsdate, gfscycle, prod), limiter):
+            break
+        ready.append(prod)
+    return ready
+
+
+#
+# Process whatever is newly available for one cycle.  Returns the
+# number of forecast hours completed.
+#
+def process_cycle(args, t, cache, limiter, pool, archive=None):
+    gfsdate  = t.strftime("%Y%m%d")
+    gfscycle = t.hour
+    basename = valid_time_str(gfsdate, gfscycle, 0)
+    manifest = Manifest(os.path.join(args.cycles_dir, basename))
+    missing  = manifest.missing()
+    if not missing:
+        return 0
+    ready = available_products(gfsdate, gfscycle, missing, limiter)
+    if not ready:
+        return 0
+    lock = lock_cycle(manifest.path)
+    if lock is None:
+        return 0    # being worked on by the forecast job or a backfill
+
+    ndone = 0
+    with lock:
+        missing = manifest.missing()    # some may have been done meanwhile
+        ready   = [prod for prod in ready if prod in missing]
+        try:
+            for prod, row, features in cycle_rows(args.lat, args.lon,
+                    args.altitude, gfsdate, gfscycle, ready, cache, limiter,
+                    pool, archive=archive):
+                if row is not None:
+                    manifest.mark(prod, row, features)
+                    ndone += 1
+        finally:
+            if archive is not None:
+                archive.consolidate(gfsdate, gfscycle, args.lat, args.lon)
+        if ndone:
+            write_table(manifest, args.tabledir, basename)
+    if ndone:
+        print("{0}: completed {1} hours, {2} remaining.".format(
+                basename, ndone, len(missing) - ndone), file=sys.stderr)
+    return ndone
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("lat",        help="site latitude [deg], (-90 to 90)",
+        type=float)
+    parser.add_argument("lon",        help="site longitude [deg], (-180 to 180)",
+        type=float)
+    parser.add_argument("altitude",   help="site altitude [m]",
+        type=float)
+    parser.add_argument("cycles_dir", help="directory for cycle state",
+        type=str)
+    parser.add_argument("tabledir",   help="site forecast table directory",
+        type=str)
+    parser.add_argument("--poll-interval",
+        help="time between polls [s] (default {0})".format(POLL_INTERVAL),
+        type=float, default=POLL_INTERVAL)
+    parser.add_argument("--cycles",
+        help="number of recent cycles to follow (default {0})".format(
+        NUM_CYCLES),
+        type=int, default=NUM_CYCLES)
+    parser.add_argument("--once",
+        help="make a single pass and exit",
+        action="store_true")
+    args = parser.parse_args()
+
+    if (args.lat < -90. or args.lat > 90.):
+        parser.error("invalid latitude")
+    if (args.lon < -180. or args.lon > 180.):
+        parser.error("invalid longitude")
+    if (args.altitude < -500.):
+        parser.error("invalid altitude")
+    if (args.poll_interval <= 0.):
+        parser.error("invalid poll interval")
+    if (args.cycles < 1):
+        parser.error("invalid number of cycles")
+
+    cache   = grib_cache.default_cache()
+    limiter = nomads.TokenBucket()
+    pool    = am_runner.AmPool(cache=am_cache.default_cache())
+    archive = profile_archive.default_archive()
+    while True:
+        #
+        # An error in one cycle, e.g. a network or file system error,
+        # is reported, and the cycle is tried again on the next pass,
+        # so that the daemon keeps running.
+        #
+        for t in recent_cycles(args.cycles):
+            try:
+                process_cycle(args, t, cache, limiter, pool, archive)
+            except Exception as err:
+                print("{0}: pass failed: {1}".format(valid_time_str(
+                        t.strftime("%Y%m%d"), t.hour, 0), err),
+                        file=sys.stderr)
+        if am_coef_cache.CACHE_PATH:
+            try:
+                am_coef_cache.prune()
+            except OSError as err:
+                print("Pruning the am cache failed: {0}".format(err),
+                        file=sys.stderr)
+        if args.once:
+            break
+        time.sleep(args.poll_interval)
+
+
+if __name__ == "__main__":
+    main()
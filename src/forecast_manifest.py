@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+#
+# forecast_manifest.py - keeps track of which forecast hours of a
+# site forecast table are complete, so that a table left incomplete
+# by a failed run can be finished by computing only the missing
+# hours.
+#
+# The state for one forecast cycle is kept in a directory holding
+# one file per completed hour, named for the product, e.g.
+# f006.row, containing that hour's data line for the table, and a
+# file named manifest listing the completed products one per line.
+# A row file is always written in full before its product is
+# appended to the manifest, so a product listed in the manifest
+# always has a complete row.
+#
+# Alongside its row, a completed hour may record the profile
+# features used by the surrogate model (see surrogate.py) in a file
+# named features, one line per product.  Over many cycles, these and
+# the am results in the rows make up the surrogate training archive.
+# A first-pass row computed with the surrogate is written to a file
+# named e.g. f006.prov, and is not listed in the manifest, so the
+# hour is still missing, to be computed by am later.  The table
+# includes provisional rows for hours not yet complete.
+#
+# The table columns, which depend on the extra bands set in AM_BANDS
+# (see am_runner.py), are recorded in a file named columns when the
+# first row is recorded.  If AM_BANDS is changed, the rows already
+# recorded, which are of the wrong width, are treated as missing, and
+# when the first row with the new columns is recorded, the manifest
+# is started afresh, so that tables never mix rows of different
+# widths.  For a directory made before the columns were recorded,
+# the width of a recorded row is checked instead.
+#
+# A process working on a cycle holds an exclusive lock on the file
+# named for its state directory with the suffix .lock, e.g.
+# 20240101_06:00:00.lock, taken with lock_cycle() here by
+# forecast_pipeline.py, forecast_cycle.py, forecast_daemon.py, and
+# backfill.py.  Processes which find a cycle locked skip it, so that
+# overlapping forecast jobs, the daemon, backfills, and manual runs
+# never work on the same cycle at once.
+#
+# Used as a script, this takes a command and a cycle state
+# directory:
+#
+#   forecast_manifest.py missing DIR
+#       print the products not yet complete, in hour order
+#   forecast_manifest.py check DIR [--table FILE]
+#       exit with status 0 if all products are complete, 1 if not.
+#       If there is no manifest yet, but FILE is a complete table
+#       made before manifests were kept, the manifest is seeded
+#       from it.
+#   forecast_manifest.py assemble DIR
+#       print the table, with the header and rows in hour order
+#
+
+import argparse
+import fcntl
+import os
+import sys
+
+import am_runner
+from gfs_products import FORECAST_HOURS, product_name
+
+MANIFEST_NAME      = "manifest"
+FEATURES_NAME      = "features"
+COLUMNS_NAME       = "columns"
+ROW_SUFFIX         = ".row"
+PROVISIONAL_SUFFIX = ".prov"
+LOCK_SUFFIX        = ".lock"
+
+#
+# Table column headers, including those for any extra bands computed
+# by am (see am_runner.py).
+#
+TABLE_COLUMNS = (
+        "tau225",
+        "Tb[K]",
+        "pwv[mm]",
+        "lwp[kg*m^-2]",
+        "iwp[kg*m^-2]",
+        "o3[DU]") + tuple(am_runner.band_columns())
+TABLE_HEADER = "#{0:>16s}".format("date") + "".join(
+        " {0:>12s}".format(name) for name in TABLE_COLUMNS) + "\n"
+
+
+#
+# The state of one cycle, in the directory path, which is made if it
+# doesn't exist, unless create is False, e.g. for reading only.
+#
+class Manifest:
+
+    def __init__(self, path, create=True):
+        self.path = path
+        if create:
+            os.makedirs(path, exist_ok=True)
+        self.manifest_path = os.path.join(path, MANIFEST_NAME)
+        self.columns_path  = os.path.join(path, COLUMNS_NAME)
+        self._columns_ok   = False
+
+    def _row_path(self, prod):
+        return os.path.join(self.path, prod + ROW_SUFFIX)
+
+    def _provisional_path(self, prod):
+        return os.path.join(self.path, prod + PROVISIONAL_SUFFIX)
+
+    def exists(self):
+        return os.path.exists(self.manifest_path)
+
+    #
+    # Return the set of products listed in the manifest.
+    #
+    def _listed(self):
+        try:
+            with open(self.manifest_path) as f:
+                return set(line.strip() for line in f)
+        except FileNotFoundError:
+            return set()
+
+    #
+    # Return True if the rows recorded here have the current
+    # TABLE_COLUMNS.
+    #
+    def columns_match(self):
+        try:
+            with open(self.columns_path) as f:
+                return tuple(f.read().split()) == TABLE_COLUMNS
+        except FileNotFoundError:
+            pass
+        for prod in self._listed():
+            try:
+                return len(self.row(prod).split()) == 1 + len(TABLE_COLUMNS)
+            except FileNotFoundError:
+                continue
+        return True
+
+    #
+    # Before a row is recorded, record the current columns, starting
+    # the manifest afresh and removing any provisional rows if the
+    # rows recorded so far have other columns.
+    #
+    def _check_columns(self):
+        if self._columns_ok:
+            return
+        if not self.columns_match():
+            open(self.manifest_path, 'w').close()
+            for name in os.listdir(self.path):
+                if name.endswith(PROVISIONAL_SUFFIX):
+                    os.remove(os.path.join(self.path, name))
+        tmppath = self.columns_path + ".tmp"
+        with open(tmppath, 'w') as f:
+            f.write(" ".join(TABLE_COLUMNS) + "\n")
+        os.replace(tmppath, self.columns_path)
+        self._columns_ok = True
+
+    #
+    # Return the set of completed products.  If the rows recorded have
+    # other than the current columns, there are none.
+    #
+    def complete(self):
+        listed = self._listed()
+        if not listed or not self.columns_match():
+            return set()
+        return set(prod for prod in listed
+                if os.path.exists(self._row_path(prod)))
+
+    #
+    # Return the products not yet complete, in hour order.
+    #
+    def missing(self):
+        done = self.complete()
+        return [product_name(hour) for hour in FORECAST_HOURS
+                if product_name(hour) not in done]
+
+    def is_complete(self):
+        return not self.missing()
+
+    #
+    # Record the data line for a product as complete.  The row is
+    # written to a temporary file and renamed into place before the
+    # product is added to the manifest.  If features are given, they
+    # are recorded first.  Any provisional row is then removed.
+    #
+    def mark(self, prod, row, features=None):
+        self._check_columns()
+        tmppath = self._row_path(prod) + ".tmp"
+        with open(tmppath, 'w') as f:
+            f.write(row)
+        os.replace(tmppath, self._row_path(prod))
+        if features is not None:
+            with open(os.path.join(self.path, FEATURES_NAME), 'a') as f:
+                f.write(prod + "".join(" " + repr(float(x)) for x in features)
+                        + "\n")
+        with open(self.manifest_path, 'a') as f:
+            f.write(prod + "\n")
+        try:
+            os.remove(self._provisional_path(prod))
+        except FileNotFoundError:
+            pass
+
+    #
+    # Record a provisional data line for a product, to appear in the
+    # table until the product is complete.
+    #
+    def mark_provisional(self, prod, row):
+        self._check_columns()
+        tmppath = self._provisional_path(prod) + ".tmp"
+        with open(tmppath, 'w') as f:
+            f.write(row)
+        os.replace(tmppath, self._provisional_path(prod))
+
+    #
+    # Return a dict of the recorded features of completed products,
+    # as tuples of floats.
+    #
+    def features(self):
+        done = self.complete()
+        features = {}
+        try:
+            with open(os.path.join(self.path, FEATURES_NAME)) as f:
+                for line in f:
+                    fields = line.split()
+                    if fields and fields[0] in done:
+                        features[fields[0]] = tuple(
+                                float(x) for x in fields[1:])
+        except FileNotFoundError:
+            pass
+        return features
+
+    #
+    # Return the completed row for a product.
+    #
+    def row(self, prod):
+        with open(self._row_path(prod)) as f:
+            return f.read()
+
+    #
+    # Return the table, with the header and the completed rows in
+    # hour order.  Unless provisional is False, provisional rows are
+    # included for hours not yet complete.  Rows with other than the
+    # current columns are left out.
+    #
+    def assemble(self, provisional=True):
+        done  = self.complete()
+        table = [TABLE_HEADER]
+        match = self.columns_match()
+        for hour in FORECAST_HOURS:
+            prod = product_name(hour)
+            if prod in done:
+                table.append(self.row(prod))
+            elif provisional and match:
+                try:
+                    with open(self._provisional_path(prod)) as f:
+                        table.append(f.read())
+                except FileNotFoundError:
+                    pass
+        return "".join(table)
+
+    #
+    # Seed the manifest from a complete table, such as one made
+    # before manifests were kept.  Returns True if the table was
+    # complete, with the current columns, and the manifest was
+    # seeded.
+    #
+    def seed_from_table(self, table_path):
+        try:
+            with open(table_path) as f:
+                rows = [line for line in f if not line.startswith("#")]
+        except FileNotFoundError:
+            return False
+        if len(rows) != len(FORECAST_HOURS):
+            return False
+        if any(len(row.split()) != 1 + len(TABLE_COLUMNS) for row in rows):
+            return False
+        for hour, row in zip(FORECAST_HOURS, rows):
+            self.mark(product_name(hour), row)
+        return True
+
+
+#
+# Write the table for a cycle, with the hours completed so far, to
+# the file named basename in the year subdirectory of tabledir.  The
+# table is written to a temporary file and renamed into place, so
+# readers never see a partial table.
+#
+def write_table(manifest, tabledir, basename):
+    yeardir = os.path.join(tabledir, basename[0:4])
+    os.makedirs(yeardir, exist_ok=True)
+    outfile = os.path.join(yeardir, basename)
+    with open(outfile + ".tmp", 'w') as f:
+        f.write(manifest.assemble())
+    os.replace(outfile + ".tmp", outfile)
+
+
+#
+# Take the lock on the cycle with state directory path, without
+# waiting.  Returns the open lock file, which holds the lock until it
+# is closed, or None if another process holds the lock.
+#
+def lock_cycle(path):
+    lock = open(path.rstrip(os.sep) + LOCK_SUFFIX, 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command",  help="missing, check, or assemble",
+        choices=("missing", "check", "assemble"))
+    parser.add_argument("dir",      help="cycle state directory",
+        type=str)
+    parser.add_argument("--table",
+        help="complete table from which to seed a missing manifest",
+        type=str)
+    args = parser.parse_args()
+
+    manifest = Manifest(args.dir)
+    if (args.command == "missing"):
+        print(" ".join(manifest.missing()))
+    elif (args.command == "check"):
+        if (not manifest.exists() and args.table is not None):
+            manifest.seed_from_table(args.table)
+        exit(0 if manifest.is_complete() else 1)
+    else:
+        print(manifest.assemble(), end='')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,583 @@
+#!/usr/bin/env python
+#
+# forecast_pipeline.py - compute the forecast tables of the latest
+# GFS cycles for a given site latitude, longitude, and altitude, as
+# one pipeline spanning all of them.  This takes the place of running
+# make_forecast_table.sh for one cycle after another in
+# sma-met-forecast_job.sh.
+#
+# Each missing forecast hour (see forecast_manifest.py) passes
+# through the stages
+#
+#   fetch   - take the GRIB data from the GRIB cache (see
+#             grib_cache.py), or download it (see nomads.py)
+#   convert - interpolate the profiles to the site, put them in the
+#             profile archive, if any (see profile_archive.py), and
+#             derive the am layers, and with --surrogate, a
+#             provisional line from the surrogate model (see
+#             surrogate.py)
+#   am      - run am on the layers, or take the result from the am
+#             result cache (see am_runner.py and am_cache.py)
+#   record  - record the line in the cycle state directory
+#
+# Each stage has its own pool of worker threads, and takes its work
+# from a queue holding at most twice as many hours as it has
+# workers, so that a stage which falls behind holds back those
+# before it, and the data in memory stay bounded.  Up to --concurrent
+# cycles are fed into the pipeline at once, newest first, so that the
+# downloads for one cycle proceed while am runs on another, and
+# neither the network nor the CPU sits idle waiting for the other.
+# The hours of a cycle are recorded as they complete, and when all
+# of them are done, its table is written to the site forecast
+# directory, under a temporary name renamed into place, and added to
+# the verification index, if one is given (see verify.py).  With
+# --surrogate, a provisional table is written as soon as all the
+# hours of a cycle have been converted.
+#
+# Each cycle is locked while it is in the pipeline, and cycles
+# locked by another process, e.g. forecast_daemon.py or a stalled
+# earlier job, are skipped (see forecast_manifest.py).
+#
+# A watchdog thread checks the stages every WATCHDOG_INTERVAL
+# seconds.  A stage that has had an hour in progress for longer than
+# --stall-timeout seconds, or has had hours waiting in its queue for
+# that long without completing any, is reported as stalled, with the
+# hours it is stuck on.  If the stall lasts --stall-limit seconds,
+# the pipeline is abandoned: the tables of the cycles in progress
+# are written with the hours completed so far, and the script exits,
+# so that the job can go on to publish what it has.  The hours
+# still missing are computed by the next run.
+#
+# At the end, a summary is written to stderr, with the number of
+# hours completed and, for each stage, the fraction of the time its
+# workers were busy, and the fraction they spent blocked waiting for
+# room in the queue of the next stage, which shows where the
+# bottleneck lies.
+#
+# This script depends on the environment variables used by
+# forecast_cycle.py.
+#
+
+import argparse
+import datetime
+import os
+import queue
+import sys
+import threading
+import time
+
+import am_cache
+import am_runner
+import gfs16_to_am10
+import grib_cache
+import nomads
+import profile_archive
+import surrogate
+import verify
+from forecast_cycle import convert, extract
+from forecast_manifest import Manifest, lock_cycle, write_table
+from gfs_products import product_hour, valid_time_str
+
+NUM_CYCLES        = 9     # Default number of cycles, back from the latest
+CONCURRENT_CYCLES = 3     # Default number of cycles in the pipeline at once
+CONVERT_WORKERS   = 1     # Default number of conversion threads
+WATCHDOG_INTERVAL = 60    # Time between watchdog checks [s]
+STALL_TIMEOUT     = 900   # Default time without progress to report [s]
+STALL_LIMIT       = 3600  # Default time without progress to give up [s]
+
+
+#
+# The state of one cycle in the pipeline.  Its fields are only
+# changed by the record stage, apart from the circuit breaker, which
+# is shared by its downloads.
+#
+class Cycle:
+
+    def __init__(self, t, manifest, lock, missing):
+        self.gfsdate  = t.strftime("%Y%m%d")
+        self.gfscycle = t.hour
+        self.basename = valid_time_str(self.gfsdate, self.gfscycle, 0)
+        self.manifest = manifest
+        self.lock     = lock
+        self.missing  = missing
+        self.breaker  = nomads.CircuitBreaker()
+        self.first    = set()     # hours converted, or failed before am
+        self.ndone    = 0
+        self.nfail    = 0
+
+    def remaining(self):
+        return len(self.missing) - self.ndone - self.nfail
+
+
+#
+# A pipeline stage, with a pool of worker threads taking items from
+# its input queue.  Each item is a tuple whose first two elements
+# are the Cycle and product it belongs to.  The work function is a
+# generator, yielding (stage, item) pairs for the items to be passed
+# on to later stages.  If it raises an exception, the error is
+# reported, and the item is passed to the failure function, if any.
+# Each stage keeps track of the items in progress and of its
+# throughput, for the watchdog and the summary.
+#
+class Stage:
+
+    def __init__(self, name, work, workers, fail=None):
+        self.name      = name
+        self.work      = work
+        self.workers   = workers
+        self.fail      = fail
+        self.input     = queue.Queue(maxsize=2 * workers)
+        self.lock      = threading.Lock()
+        self.active    = {}
+        self.ndone     = 0
+        self.busy      = 0.0
+        self.blocked   = 0.0
+        self.last_done = time.monotonic()
+
+    def start(self):
+        for _ in range(self.workers):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def put(self, item):
+        self.input.put(item)
+
+    def _run(self):
+        while True:
+            item = self.input.get()
+            t0 = time.monotonic()
+            ident = threading.get_ident()
+            with self.lock:
+                self.active[ident] = (item, t0)
+            blocked = 0.0
+            try:
+                for stage, out in self.work(*item):
+                    t1 = time.monotonic()
+                    with self.lock:
+                        self.active[ident] = (item, None)
+                    stage.put(out)
+                    t2 = time.monotonic()
+                    with self.lock:
+                        self.active[ident] = (item, t2)
+                    blocked += t2 - t1
+            except Exception as err:
+                print("{0} {1}: {2} failed: {3}".format(item[0].basename,
+                        item[1], self.name, err), file=sys.stderr)
+                if self.fail is not None:
+                    self.fail(*item[0:2])
+            t1 = time.monotonic()
+            with self.lock:
+                del self.active[ident]
+                self.ndone    += 1
+                self.busy     += t1 - t0 - blocked
+                self.blocked  += blocked
+                self.last_done = t1
+
+    #
+    # Return a description of the stall in this stage, if it has had
+    # an item in progress for stall_timeout seconds, or items waiting
+    # that long without completing any, and the time it has been
+    # stalled, or None if it is not stalled.  Items held up waiting
+    # for room in the queue of the next stage don't count as in
+    # progress, since the stall is in that stage, not this one.
+    #
+    def stall(self, stall_timeout):
+        now = time.monotonic()
+        with self.lock:
+            held   = len(self.active)
+            active = sorted((a for a in self.active.values()
+                    if a[1] is not None), key=lambda a: a[1])
+            last_done = self.last_done
+        if held and not active:
+            return None
+        waiting = self.input.qsize()
+        if active:
+            item, t0 = active[0]
+            t_stall = now - t0
+        elif waiting:
+            t_stall = now - last_done
+        else:
+            return None
+        if t_stall < stall_timeout:
+            return None
+        if active:
+            where = "{0} in progress, oldest {1} {2} for {3:.0f} s".format(
+                    len(active), item[0].basename, item[1], now - t0)
+        else:
+            where = "none in progress"
+        return "{0} stage stalled for {1:.0f} s: {2}, {3} queued.".format(
+                self.name, t_stall, where, waiting), t_stall
+
+
+class Pipeline:
+
+    def __init__(self, args, model=None):
+        self.args     = args
+        self.model    = model
+        self.cache    = grib_cache.default_cache()
+        self.limiter  = nomads.TokenBucket()
+        nomads.reserve_connections(args.fetch_workers)
+        self.archive  = profile_archive.default_archive()
+        self.am_cache = am_cache.default_cache()
+        self.fetch    = Stage("fetch", self._fetch, args.fetch_workers,
+                self._fail)
+        self.convert  = Stage("convert", self._convert, args.convert_workers,
+                self._fail)
+        self.am       = Stage("am", self._am, args.am_workers, self._fail)
+        self.record   = Stage("record", self._record, 1)
+        self.stages   = (self.fetch, self.convert, self.am, self.record)
+        self.slots    = threading.Semaphore(args.concurrent)
+        self.lock     = threading.Lock()
+        self.marking  = threading.Lock()   # held while recording
+        self.cycles   = []      # cycles in the pipeline
+        self.fed      = False
+        self.finished = threading.Event()
+        self.aborted  = False
+        self.ndone    = 0
+        self.nfail    = 0
+        self.nhours   = 0
+
+    def _fetch(self, cycle, prod):
+        key = gfs16_to_am10.request_key(self.args.lat, self.args.lon,
+                cycle.gfsdate, cycle.gfscycle, prod)
+        content = None if self.cache is None else self.cache.get(key)
+        if content is None:
+            try:
+                content = nomads.fetch(gfs16_to_am10.request_url(
+                        self.args.lat, self.args.lon, cycle.gfsdate,
+                        cycle.gfscycle, prod), self.limiter,
+                        breaker=cycle.breaker)
+            except nomads.DownloadError:
+                yield self.record, (cycle, prod, "fail", None, None)
+                return
+            if self.cache is not None:
+                self.cache.put(key, content)
+        yield self.convert, (cycle, prod, content)
+
+    def _convert(self, cycle, prod, content):
+        args = self.args
+        converted = None
+        profiles = extract(content, args.lat, args.lon, prod)
+        if profiles is not None:
+            if self.archive is not None:
+                self.archive.put(cycle.gfsdate, cycle.gfscycle, prod,
+                        profiles, args.lat, args.lon)
+            converted = convert(profiles, args.lat, args.lon,
+                    args.altitude, cycle.gfsdate, cycle.gfscycle, prod)
+        if converted is None:
+            yield self.record, (cycle, prod, "fail", None, None)
+            return
+        layers, features = converted
+        if self.model is not None:
+            tau, Tb = self.model.predict(features)
+            F = features
+            yield self.record, (cycle, prod, "provisional", self._row(cycle,
+                    prod, am_runner.AmResult(tau, Tb, F[0], F[1], F[2], F[3])),
+                    None)
+        yield self.am, (cycle, prod, layers, features)
+
+    def _am(self, cycle, prod, layers, features):
+        result = am_runner.am_result(layers, self.am_cache)
+        if result is None:
+            yield self.record, (cycle, prod, "fail", None, None)
+            return
+        yield self.record, (cycle, prod, "row", self._row(cycle, prod,
+                result), features)
+
+    def _fail(self, cycle, prod):
+        self.record.put((cycle, prod, "fail", None, None))
+
+    def _row(self, cycle, prod, result):
+        return am_runner.format_row(valid_time_str(cycle.gfsdate,
+                cycle.gfscycle, product_hour(prod)), result)
+
+    #
+    # Record an item for an hour of a cycle, finishing the cycle when
+    # all of its hours have been through the pipeline.  Each hour is
+    # counted once, as done or failed, and an error recording it, e.g.
+    # in writing its row, is reported and counts as a failure of the
+    # hour, so this never raises.  Once the pipeline has been given
+    # up, nothing more is recorded.
+    #
+    def _record(self, cycle, prod, kind, row=None, features=None):
+        with self.marking:
+            if self.aborted:
+                return ()
+            try:
+                if kind == "provisional":
+                    cycle.manifest.mark_provisional(prod, row)
+                elif kind == "row":
+                    cycle.manifest.mark(prod, row, features)
+            except Exception as err:
+                print("{0} {1}: recording failed: {2}".format(
+                        cycle.basename, prod, err), file=sys.stderr)
+                if kind == "provisional":
+                    return ()
+                kind = "fail"
+            if kind != "row" and prod not in cycle.first:
+                cycle.first.add(prod)
+                if (self.model is not None and
+                        len(cycle.first) == len(cycle.missing)):
+                    self._write(cycle)
+            if kind == "provisional":
+                return ()   # the hour is still to be run through am
+            if kind == "row":
+                cycle.ndone += 1
+            else:
+                cycle.nfail += 1
+            if cycle.remaining() == 0:
+                self._finish(cycle)
+        return ()
+
+    #
+    # Write the table of a cycle, reporting any error.  Returns True if
+    # the table was written.
+    #
+    def _write(self, cycle):
+        try:
+            write_table(cycle.manifest, self.args.tabledir, cycle.basename)
+        except Exception as err:
+            print("{0}: writing table failed: {1}".format(cycle.basename,
+                    err), file=sys.stderr)
+            return False
+        return True
+
+    #
+    # Write the table of a cycle whose hours have all been through
+    # the pipeline, and release it.  The cycle is released whatever
+    # errors there are in consolidating its profiles, writing its
+    # table, or adding it to the verification index.
+    #
+    def _finish(self, cycle):
+        args = self.args
+        try:
+            if self.archive is not None:
+                self.archive.consolidate(cycle.gfsdate, cycle.gfscycle,
+                        args.lat, args.lon)
+            if cycle.ndone and self._write(cycle) and args.verify is not None:
+                verify.add(args.verify, datetime.datetime.strptime(
+                        cycle.basename, "%Y%m%d_%H:%M:%S"),
+                        cycle.manifest.assemble(provisional=False))
+        except Exception as err:
+            print("{0}: finishing failed: {1}".format(cycle.basename, err),
+                    file=sys.stderr)
+        finally:
+            print("{0}: completed {1} of {2} hours.".format(cycle.basename,
+                    cycle.ndone, len(cycle.missing)), file=sys.stderr)
+            cycle.lock.close()
+            with self.lock:
+                self.cycles.remove(cycle)
+                self.ndone += cycle.ndone
+                self.nfail += cycle.nfail
+                self._check_finished()
+            self.slots.release()
+
+    def _check_finished(self):
+        if self.fed and not self.cycles:
+            self.finished.set()
+
+    #
+    # Feed the missing hours of the cycles at times into the
+    # pipeline, with no more than args.concurrent cycles in it at
+    # once.  A cycle that cannot be set up, e.g. because its
+    # directory cannot be written, is reported and skipped, and the
+    # pipeline is marked as fed however this returns, so that it
+    # finishes once the cycles already in it are done.
+    #
+    def _feed(self, times):
+        args = self.args
+        try:
+            for t in times:
+                self.slots.acquire()
+                basename = valid_time_str(t.strftime("%Y%m%d"), t.hour, 0)
+                lock = None
+                try:
+                    manifest = Manifest(os.path.join(args.cycles_dir,
+                            basename))
+                    lock = lock_cycle(manifest.path)
+                    if lock is None:
+                        print("{0}: locked by another process, "
+                                "skipped.".format(basename), file=sys.stderr)
+                        self.slots.release()
+                        continue
+                    if not manifest.exists():
+                        manifest.seed_from_table(os.path.join(args.tabledir,
+                                basename[0:4], basename))
+                    missing = manifest.missing()
+                except Exception as err:
+                    print("{0}: skipped: {1}".format(basename, err),
+                            file=sys.stderr)
+                    if lock is not None:
+                        lock.close()
+                    self.slots.release()
+                    continue
+                if not missing:
+                    lock.close()
+                    self.slots.release()
+                    continue
+                cycle = Cycle(t, manifest, lock, missing)
+                with self.lock:
+                    self.cycles.append(cycle)
+                    self.nhours += len(missing)
+                for prod in missing:
+                    self.fetch.put((cycle, prod))
+        finally:
+            with self.lock:
+                self.fed = True
+                self._check_finished()
+
+    #
+    # Report stalled stages every WATCHDOG_INTERVAL seconds, and give
+    # up on the pipeline if a stall lasts args.stall_limit seconds.
+    #
+    def _watch(self):
+        while not self.finished.wait(WATCHDOG_INTERVAL):
+            for stage in self.stages:
+                stall = stage.stall(self.args.stall_timeout)
+                if stall is None:
+                    continue
+                msg, t_stall = stall
+                print(msg, file=sys.stderr)
+                if t_stall >= self.args.stall_limit:
+                    print("Giving up on the pipeline.", file=sys.stderr)
+                    self._abort()
+                    return
+
+    #
+    # Give up on the pipeline, writing the tables of the cycles in
+    # progress with the hours completed so far.  Recording is stopped
+    # first, so that no manifest changes while its table is written.
+    # If the record stage is itself stuck, and doesn't stop within
+    # WATCHDOG_INTERVAL seconds, the tables are left as they are.
+    #
+    def _abort(self):
+        if self.marking.acquire(timeout=WATCHDOG_INTERVAL):
+            try:
+                self.aborted = True
+                with self.lock:
+                    stuck = list(self.cycles)
+                for cycle in stuck:
+                    self._write(cycle)
+            finally:
+                self.marking.release()
+        else:
+            self.aborted = True
+            print("Recording is stuck, tables not written.", file=sys.stderr)
+        self.finished.set()
+
+    #
+    # Run the pipeline on the cycles at times, returning when all of
+    # them are done, or the pipeline is given up.
+    #
+    def run(self, times):
+        for stage in self.stages:
+            stage.start()
+        threading.Thread(target=self._feed, args=(times,), daemon=True).start()
+        threading.Thread(target=self._watch, daemon=True).start()
+        self.finished.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("lat",        help="site latitude [deg], (-90 to 90)",
+        type=float)
+    parser.add_argument("lon",        help="site longitude [deg], (-180 to 180)",
+        type=float)
+    parser.add_argument("altitude",   help="site altitude [m]",
+        type=float)
+    parser.add_argument("gfsdate",    help="latest GFS production date " +
+        "(YYYYMMDD)",
+        type=str)
+    parser.add_argument("gfscycle",   help="latest GFS production cycle " +
+        "(0, 6, 12, 18)",
+        type=int)
+    parser.add_argument("cycles_dir", help="directory for cycle state",
+        type=str)
+    parser.add_argument("tabledir",   help="site forecast table directory",
+        type=str)
+    parser.add_argument("--cycles",
+        help="number of cycles, back from the latest (default {0})".format(
+        NUM_CYCLES),
+        type=int, default=NUM_CYCLES)
+    parser.add_argument("--concurrent",
+        help="number of cycles in the pipeline at once (default {0})".format(
+        CONCURRENT_CYCLES),
+        type=int, default=CONCURRENT_CYCLES)
+    parser.add_argument("--fetch-workers",
+        help="number of concurrent downloads (default {0})".format(
+        nomads.MAX_CONNECTIONS),
+        type=int, default=nomads.MAX_CONNECTIONS)
+    parser.add_argument("--convert-workers",
+        help="number of conversion threads (default {0})".format(
+        CONVERT_WORKERS),
+        type=int, default=CONVERT_WORKERS)
+    parser.add_argument("--am-workers",
+        help="number of concurrent am processes (default {0})".format(
+        am_runner.AM_WORKERS),
+        type=int, default=am_runner.AM_WORKERS)
+    parser.add_argument("--surrogate",
+        help="also write provisional tables computed with this surrogate " +
+        "model (see surrogate.py)",
+        type=str, metavar="MODEL")
+    parser.add_argument("--verify",
+        help="add completed tables to this verification index " +
+        "(see verify.py)",
+        type=str, metavar="INDEX")
+    parser.add_argument("--stall-timeout",
+        help="time without progress after which a stage is reported " +
+        "stalled [s] (default {0})".format(STALL_TIMEOUT),
+        type=float, default=STALL_TIMEOUT)
+    parser.add_argument("--stall-limit",
+        help="time without progress after which the pipeline is given " +
+        "up [s] (default {0})".format(STALL_LIMIT),
+        type=float, default=STALL_LIMIT)
+    args = parser.parse_args()
+
+    if (args.lat < -90. or args.lat > 90.):
+        parser.error("invalid latitude")
+    if (args.lon < -180. or args.lon > 180.):
+        parser.error("invalid longitude")
+    if (args.altitude < -500.):
+        parser.error("invalid altitude")
+    if (args.gfscycle not in (0, 6, 12, 18)):
+        parser.error("invalid GFS production cycle")
+    if (args.cycles < 1):
+        parser.error("invalid number of cycles")
+    if (min(args.concurrent, args.fetch_workers, args.convert_workers,
+            args.am_workers) < 1):
+        parser.error("invalid number of workers")
+    if (args.stall_timeout <= 0. or args.stall_limit < args.stall_timeout):
+        parser.error("invalid stall timeout or limit")
+    try:
+        latest = datetime.datetime.strptime(args.gfsdate, "%Y%m%d") + \
+                datetime.timedelta(hours=args.gfscycle)
+    except ValueError:
+        parser.error("invalid date")
+    times = [latest - datetime.timedelta(hours=(6 * k))
+            for k in range(args.cycles)]
+
+    model = None
+    if args.surrogate is not None:
+        try:
+            model = surrogate.load(args.surrogate)
+        except (OSError, ValueError) as err:
+            parser.error("cannot load surrogate model: {0}".format(err))
+
+    pipeline = Pipeline(args, model)
+    t0 = time.monotonic()
+    pipeline.run(times)
+    t_total = time.monotonic() - t0
+
+    print("Completed {0} of {1} forecast hours in {2:.1f} s.".format(
+            pipeline.ndone, pipeline.nhours, t_total), file=sys.stderr)
+    t_workers = [max(stage.workers * t_total, 1e-9)
+            for stage in pipeline.stages]
+    print("Stage workers busy (blocked): " + ", ".join(
+            "{0} {1:.0f}% ({2:.0f}%) of {3}".format(stage.name,
+            100. * stage.busy / t, 100. * stage.blocked / t, stage.workers)
+            for stage, t in zip(pipeline.stages, t_workers)) + ".",
+            file=sys.stderr)
+    exit(1 if pipeline.aborted or pipeline.nfail else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+#
+# forecast_store.py - compact binary store of the forecast tables of
+# the latest NSLOTS GFS cycles, for plot_forecast.py and any other
+# program which needs them all at once.  The text tables remain the
+# published form of the forecasts; the store holds the same data in
+# a form that can be memory-mapped and used in place, without
+# parsing.
+#
+# The store is a NumPy .npy file holding a structured array of
+# NSLOTS records, one per cycle, used as a ring buffer: the record
+# for a cycle is at index (cycle analysis time in hours / 6) % NSLOTS,
+# so the latest NSLOTS cycles, spanning 48 hours, always occupy
+# distinct records.  Each record has the fields
+#
+#   cycle  - analysis time of the cycle (datetime64[s]), or NaT if
+#            the record is empty
+#   time   - valid time of each forecast hour (datetime64[s]), or NaT
+#            for hours not in the table
+#   tau225, Tb[K], ... - one field for each numeric column of the
+#            table, named as in the table header, with a value for
+#            each forecast hour, or nan for hours not in the table
+#
+# where the forecast hours are those listed in gfs_products.py.
+# While a record is being rewritten, its cycle is set to NaT, so a
+# reader never mistakes a partly written record for a complete one.
+# If the columns of a table differ from those in the store, e.g.
+# after a change to AM_BANDS, the store is made anew.  Updates, e.g.
+# by overlapping forecast jobs, are serialized with a lock on the
+# file named for the store with the suffix .lock.
+#
+# Used as a script, this adds a forecast table file, named for its
+# cycle as in sma-met-forecast_job.sh, to a store:
+#
+#   forecast_store.py update STORE TABLE
+#
+
+import argparse
+import datetime
+import fcntl
+import os
+import warnings
+
+import numpy as np
+
+from gfs_products import FORECAST_HOURS
+
+NSLOTS = 9
+
+
+#
+# Return the dtype of the store records, for the given numeric
+# column names.
+#
+def store_dtype(columns):
+    nhours = len(FORECAST_HOURS)
+    return np.dtype([("cycle", "M8[s]"), ("time", "M8[s]", (nhours,))] +
+            [(name, "f8", (nhours,)) for name in columns])
+
+
+#
+# Return the record index for the cycle with the given analysis
+# time.
+#
+def slot(cycle):
+    hours = np.datetime64(cycle, 'h').astype(np.int64)
+    return (hours // 6) % NSLOTS
+
+
+#
+# Open a store, memory-mapped, read-only by default.
+#
+def open_store(path, mode='r'):
+    return np.load(path, mmap_mode=mode)
+
+
+#
+# Make a new, empty store with the given numeric columns.  It is
+# written to a temporary file and renamed into place, so a reader
+# never sees a partial store.
+#
+def create(path, columns):
+    tmppath = path + ".tmp"
+    store = np.lib.format.open_memmap(tmppath, mode='w+',
+            dtype=store_dtype(columns), shape=(NSLOTS,))
+    store["cycle"] = np.datetime64('NaT')
+    store["time"]  = np.datetime64('NaT')
+    for name in columns:
+        store[name] = np.nan
+    store.flush()
+    del store
+    os.replace(tmppath, path)
+
+
+#
+# Return the names of the numeric columns in a store.
+#
+def columns(store):
+    return store.dtype.names[2:]
+
+
+#
+# Return the record for the cycle with the given analysis time, or
+# None if it is not in the store.  The record is a view into the
+# store, not a copy.
+#
+def cycle_record(store, cycle):
+    cycle = np.datetime64(cycle, 's')
+    rec = store[slot(cycle)]
+    if rec["cycle"] != cycle:
+        return None
+    return rec
+
+
+#
+# Return the analysis time of the latest cycle in the store, or
+# None if it is empty.
+#
+def latest_cycle(store):
+    cycles = store["cycle"][~np.isnat(store["cycle"])]
+    if len(cycles) == 0:
+        return None
+    return cycles.max()
+
+
+#
+# Return the record for the cycle hours_ago hours before the latest
+# one in the store, or None if it is not in the store.
+#
+def recent(store, hours_ago):
+    latest = latest_cycle(store)
+    if latest is None:
+        return None
+    return cycle_record(store, latest - np.timedelta64(hours_ago, 'h'))
+
+
+#
+# Convert an array of forecast table time stamps (YYYYMMDD_HH:MM:SS)
+# to datetime64[s], all at once, from the digits of the stamps.
+#
+def table_times(stamps):
+    stamps = np.ascontiguousarray(stamps, dtype="S17")
+    d = (stamps.view(np.uint8).reshape(-1, 17) - ord('0')).astype(np.int64)
+    year   = 1000 * d[:, 0] + 100 * d[:, 1] + 10 * d[:, 2] + d[:, 3]
+    month  = 10 * d[:, 4]  + d[:, 5]
+    day    = 10 * d[:, 6]  + d[:, 7]
+    second = 3600 * (10 * d[:, 9]  + d[:, 10]) + \
+            60 * (10 * d[:, 12] + d[:, 13]) + 10 * d[:, 15] + d[:, 16]
+    months = np.array(12 * (year - 1970) + month - 1, dtype="M8[M]")
+    return (months.astype("M8[s]") + (day - 1) * np.timedelta64(1, 'D') +
+            second * np.timedelta64(1, 's'))
+
+
+#
+# Read a forecast table, from a file path, or from a file object or
+# sequence of lines, in a single pass.  Returns a structured array
+# with one record per row, with the field "time" holding the valid
+# time of the row (datetime64[s]), and a float field for each numeric
+# column, named as in the table header.
+#
+def read_table(source):
+    f = open(source) if isinstance(source, str) else iter(source)
+    try:
+        names = next(f, "#").lstrip('#').split()[1:]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=UserWarning)  # no rows
+            rows = np.loadtxt(f, ndmin=1, comments='#', dtype=np.dtype(
+                    [("stamp", "S17")] + [(name, "f8") for name in names]))
+    finally:
+        if isinstance(source, str):
+            f.close()
+    table = np.empty(len(rows), dtype=np.dtype([("time", "M8[s]")] +
+            [(name, "f8") for name in names]))
+    table["time"] = table_times(rows["stamp"])
+    for name in names:
+        table[name] = rows[name]
+    return table
+
+
+#
+# Parse the text of a forecast table for the cycle with the given
+# analysis time.  Returns the names of the numeric columns, an array
+# of the valid times of the forecast hours, and a dict of arrays of
+# the values in each column, laid out as in a store record.
+#
+def parse_table(cycle, table):
+    rows   = read_table(table.splitlines())
+    names  = list(rows.dtype.names[1:])
+    cycle  = np.datetime64(cycle, 's')
+    index  = np.full(max(FORECAST_HOURS) + 1, -1)
+    index[list(FORECAST_HOURS)] = np.arange(len(FORECAST_HOURS))
+    hours  = (rows["time"] - cycle) // np.timedelta64(1, 'h')
+    k      = np.where((hours >= 0) & (hours < len(index)),
+            index[np.clip(hours, 0, len(index) - 1)], -1)
+    rows, k = rows[k >= 0], k[k >= 0]
+    time   = np.full(len(FORECAST_HOURS), np.datetime64('NaT'),
+            dtype="M8[s]")
+    time[k] = rows["time"]
+    values = {name: np.full(len(FORECAST_HOURS), np.nan) for name in names}
+    for name in names:
+        values[name][k] = rows[name]
+    return names, time, values
+
+
+#
+# Put the rows of a forecast table for the cycle with the given
+# analysis time into its record in the store at path, making the
+# store if need be.
+#
+def update(path, cycle, table):
+    cycle = np.datetime64(cycle, 's')
+    names, time, values = parse_table(cycle, table)
+
+    with open(path + ".lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if (not os.path.exists(path) or
+                columns(open_store(path)) != tuple(names)):
+            create(path, names)
+        store = open_store(path, mode='r+')
+        rec = store[slot(cycle)]
+        rec["cycle"] = np.datetime64('NaT')
+        store.flush()
+        rec["time"] = time
+        for name in names:
+            rec[name] = values[name]
+        store.flush()
+        rec["cycle"] = cycle
+        store.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", help="update",
+        choices=("update",))
+    parser.add_argument("store",   help="store file (.npy)",
+        type=str)
+    parser.add_argument("table",   help="forecast table file, named for " +
+        "its cycle (YYYYMMDD_HH:00:00)",
+        type=str)
+    args = parser.parse_args()
+
+    try:
+        cycle = datetime.datetime.strptime(os.path.basename(args.table),
+                "%Y%m%d_%H:%M:%S")
+    except ValueError:
+        parser.error("table file name is not a cycle time")
+    with open(args.table) as f:
+        update(args.store, cycle, f.read())
+
+
+if __name__ == "__main__":
+    main()
@@ -21,16 +21,12 @@ import argparse
 import datetime
 import dateutil.parser as dparser
 import math
+import numpy as np
 import pygrib
-import requests
 import sys
-import time
 
-# Timeouts and retries
-CONN_TIMEOUT        = 15       # Initial server response timeout in seconds
-READ_TIMEOUT        = 15       # Stalled download timeout in seconds
-RETRY_DELAY         = 60       # Delay before retry (NOAA requests 60 s)
-MAX_DOWNLOAD_TRIES  = 4
+import grib_cache
+import nomads
 
 # Numerical and physical constants
 BADVAL              = -99999.  # placeholder for missing or undefined data
@@ -79,6 +75,16 @@ CYCLE_REQUEST_FORMAT = "&dir=%2Fgfs.{0}%2F{1:02d}%2Fatmos"
 # coded as "0p25" for 0.25 deg, etc.
 LATLON_GRID_STR = "0p25"
 
+# URL of the index file for a complete GFS product file on the
+# NOMADS server.  The index is written after the product file itself,
+# so its presence shows that the product is available.  Fields are:
+#   {0} - date in the form YYYYMMDD
+#   {1} - forecast production cycle (00, 06, 12, 18)
+#   {2} - grid spacing string
+#   {3} - forecast product
+INDEX_URL_FORMAT = ("https://nomads.ncep.noaa.gov/pub/data/nccf/com/gfs/prod/"
+    "gfs.{0}/{1:02d}/atmos/gfs.t{1:02d}z.pgrb2.{2}.{3}.idx")
+
 # Format string for the grid subset request.
 SUBREGION_REQUEST_FORMAT = (
     "&subregion=&leftlon={0}&rightlon={1}&toplat={2}&bottomlat={3}")
@@ -122,332 +128,498 @@ LAYER_HEADER = """
 """
 
 #
-# Function for bilinear grid interpolation.  a[i_lat][i_lon] is a
-# 2x2 array of adjacent points on the lon,lat grid.  u,v are the
-# fractional distances in grid spacing in grid spacing units from
-# the "bottom left" grid point to the interpolation point.
+# Function for bilinear grid interpolation.  a[..., i_lat, i_lon] is a
+# 2x2 array of adjacent points on the lon,lat grid, for any number of
+# leading axes.  u,v are the fractional distances in grid spacing in
+# grid spacing units from the "bottom left" grid point to the
+# interpolation point.
 #
 def grid_interp(a, u, v):
-    return ( a[0][0] * (1.0 - u) * (1.0 - v) + a[1][0] * u * (1.0 - v)
-           + a[0][1] * (1.0 - u) * v         + a[1][1] * u * v        )
-
-
-#
-# Parse the command line and validate arguments.
-#
-parser = argparse.ArgumentParser()
-parser.add_argument("lat",      help="site latitude [deg], (-90 to 90)",
-    type=float)
-parser.add_argument("lon",      help="site longitude [deg], (-180 to 180)",
-    type=float)
-parser.add_argument("altitude", help="site altitude [m]",
-    type=float)
-parser.add_argument("gfsdate",  help="GFS production date (YYYYMMDD)",
-    type=str)
-parser.add_argument("gfscycle", help="GFS production cycle (0, 6, 12, 18)",
-    type=int)
-parser.add_argument("gfsprod",  help="GFS product: anl or f000 - f384",
-    type=str)
-args = parser.parse_args()
-
-if (args.lat < -90. or args.lat > 90.):
-    parser.error("invalid latitude")
-if (args.lon < -180. or args.lon > 180.):
-    parser.error("invalid longitude")
-if (args.altitude < -500.):
-    parser.error("invalid altitude")
-try:
-    gfsdatetime = dparser.parse(args.gfsdate)
-except:
-    parser.error("bad GFS production date")
-if (gfsdatetime < datetime.datetime(2017, 1, 1)):
-    parser.error("GFS production date too early")
-if (args.gfscycle not in (0, 6, 12, 18)):
-    parser.error("invalid GFS production cycle")
-if (args.gfsprod != "anl"):
-    if (args.gfsprod[0:1] == "f"):
-        forecast_hour = int(args.gfsprod[1:])
-        #
-        # These checks pertain to the 0.25 degree product
-        #
-        if (forecast_hour < 0 or forecast_hour > 384):
-            parser.error("invalid forecast hour (out of range)")
-        if (forecast_hour > 120 and forecast_hour % 3 != 0):
-            parser.error("invalid forecast hour (3-hourly only after 120 h)")
-    else:
-        parser.error("invalid GFS product name")
+    return ( a[..., 0, 0] * (1.0 - u) * (1.0 - v) + a[..., 1, 0] * u * (1.0 - v)
+           + a[..., 0, 1] * (1.0 - u) * v         + a[..., 1, 1] * u * v        )
+
 
 #
-# Args OK.  Build the request URL to retrieve the GFS data.
+# The requested regional subset will be the four points nearest the
+# user-requested lat, lon.  This function returns the lon, lat of the
+# "bottom left" grid point of the subset, and the grid spacing.
+#
+def latlon_subregion(lat, lon):
+    latlon_delta = float(LATLON_GRID_STR[0:1]) + 0.01 * float(LATLON_GRID_STR[2:])
+    leftlon = math.floor(lon / latlon_delta) * latlon_delta
+    bottomlat = math.floor(lat / latlon_delta) * latlon_delta
+    return leftlon, bottomlat, latlon_delta
+
+
 #
-request_url = CGI_URL.format(LATLON_GRID_STR)
-request_url += PRODUCT_REQUEST_FORMAT.format(
-    args.gfscycle,
-    LATLON_GRID_STR,
-    args.gfsprod)
-for lev in LEVELS:
-    request_url += LEVEL_REQUEST_FORMAT.format(int(lev))
-for var in VARIABLES:
-    request_url += VARIABLE_REQUEST_FORMAT.format(var)
+# Build the request URL to retrieve the GFS data for a given site
+# position, production date (YYYYMMDD) and cycle, and product.
+#
+def request_url(lat, lon, gfsdate, gfscycle, gfsprod):
+    url = CGI_URL.format(LATLON_GRID_STR)
+    url += PRODUCT_REQUEST_FORMAT.format(
+        gfscycle,
+        LATLON_GRID_STR,
+        gfsprod)
+    for lev in LEVELS:
+        url += LEVEL_REQUEST_FORMAT.format(int(lev))
+    for var in VARIABLES:
+        url += VARIABLE_REQUEST_FORMAT.format(var)
+    leftlon, bottomlat, latlon_delta = latlon_subregion(lat, lon)
+    url += SUBREGION_REQUEST_FORMAT.format(
+            leftlon,
+            leftlon + latlon_delta,
+            bottomlat + latlon_delta,
+            bottomlat)
+    url += CYCLE_REQUEST_FORMAT.format(
+            gfsdate,
+            gfscycle)
+    return url
+
 
 #
-# The requested regional subset will be the four points nearest the
-# user-requested lat, lon.
-#
-latlon_delta = float(LATLON_GRID_STR[0:1]) + 0.01 * float(LATLON_GRID_STR[2:])
-leftlon = math.floor(args.lon / latlon_delta) * latlon_delta
-rightlon = leftlon + latlon_delta
-bottomlat = math.floor(args.lat / latlon_delta) * latlon_delta
-toplat = bottomlat + latlon_delta
-
-request_url += SUBREGION_REQUEST_FORMAT.format(
-        leftlon,
-        rightlon,
-        toplat,
-        bottomlat)
-request_url += CYCLE_REQUEST_FORMAT.format(
-        args.gfsdate,
-        args.gfscycle)
-
-#
-# Download the requested data in grib2 format, and build an index
-# for efficient lookups by variable name and level.  Allow a
-# limited number of retries for connection errors and timeouts.
-#
-retry = MAX_DOWNLOAD_TRIES
-while retry > 0:
-    try:
-        r = requests.get(request_url, timeout=(CONN_TIMEOUT, READ_TIMEOUT))
-        if r.status_code == requests.codes.ok:
-            errflag = 0
-        else:
-            errflag = 1
-            print("Download failed with status code {0}".format(r.status_code),
-                    file=sys.stderr, end='')
-    except requests.exceptions.ConnectTimeout:
-        print("Connection timed out.", file=sys.stderr, end='')
-        errflag = 1
-    except requests.exceptions.ReadTimeout:
-        print("Data download timed out.", file=sys.stderr, end='')
-        errflag = 1
-    if (errflag):
-        retry = retry - 1
-        if (retry):
-            print("  Retrying...", file=sys.stderr)
-            time.sleep(RETRY_DELAY)
-        else:
-            print("  Giving up.", file=sys.stderr)
-            print("Failed URL was: ", file=sys.stderr)
-            print(request_url, file=sys.stderr)
-            exit(1)
-    else:
-        break
-f = open("temp.grb", 'wb')
-f.write(r.content)
-f.flush()
-grbindx = pygrib.index("temp.grb", "shortName", "level")
-
-#
-# Turn the grib2 data into am layers.  In a first pass, interpolate
-# at each pressure level to lat,lon. For height and temperature,
-# insert BADVAL if the variable is missing or not defined on the level.
-# For other variables, set missing values to zero.
-#
-u = (args.lat - bottomlat) / latlon_delta 
-v = (args.lon - leftlon) / latlon_delta
-Pbase     = []
-z         = []
-T         = []
-o3_vmr    = []
-RH        = []
-cloud_lmr = []
-cloud_imr = []
-for i,lev in enumerate(LEVELS):
-    Pbase.append(lev)
-    try:
-        # gh, Geopotential height
-        x = (grid_interp(grbindx.select(
-            shortName="gh", level=lev)[0].values, u, v))
-        z.append(x)
-    except:
-        z.append(BADVAL)
-    try:
-        # t, Temperature
-        x = (grid_interp(grbindx.select(
-            shortName="t", level=lev)[0].values, u, v))
-        T.append(x)
-    except:
-        T.append(BADVAL)
-    try:
-        # o3mr, Ozone mixing ratio
-        x = (grid_interp(grbindx.select(
-            shortName="o3mr", level=lev)[0].values, u, v))
-        x *= M_AIR / M_O3 # convert mass mixing ratio to volume mixing ratio
-        o3_vmr.append(x)
-    except:
-        o3_vmr.append(0.0)
-    try:
-        # r, Relative humidity
-        x = (grid_interp(grbindx.select(
-            shortName="r", level=lev)[0].values, u, v))
-        RH.append(x)
-    except:
-        RH.append(0.0)
-    try:
-        # clwmr, Cloud mixing ratio
-        x = (grid_interp(grbindx.select(
-            shortName="clwmr", level=lev)[0].values, u, v))
-        cloud_lmr.append(x)
-    except:
-        cloud_lmr.append(0.0)
-    try:
-        # icmr, Ice water mixing ratio
-        x = (grid_interp(grbindx.select(
-            shortName="icmr", level=lev)[0].values, u, v))
-        cloud_imr.append(x)
-    except:
-        cloud_imr.append(0.0)
-
-
-#
-# Print a header comment over the layer descriptions
-#
-if (args.gfsprod == "anl"):
-    product_str = "analysis"
-else:
-    product_str = args.gfsprod[1:] + " hour forecast"
-print(LAYER_HEADER.format(
-        args.gfsdate,
-        args.gfscycle,
-        product_str,
-        args.lat,
-        args.lon,
-        args.altitude))
-#
-# Print out the layer descriptions.  On a layer, mixing ratios and
-# RH are set to their averages over the two levels bounding the layer.
-#
-for i,lev in enumerate(LEVELS):
-    if (z[i] < args.altitude):
-        break
-    print("layer")
-    print("Pbase {0:.1f} mbar  # {1:.1f} m".format(Pbase[i], z[i]))
-    print("Tbase {0:.1f} K".format(T[i]))
-    print("column dry_air vmr")
-    if (i > 0):
-        o3_vmr_mid    = 0.5 * (   o3_vmr[i-1] +    o3_vmr[i])
-        RH_mid        = 0.5 * (       RH[i-1] +        RH[i])
-        cloud_lmr_mid = 0.5 * (cloud_lmr[i-1] + cloud_lmr[i])
-        cloud_imr_mid = 0.5 * (cloud_imr[i-1] + cloud_imr[i])
-        T_mid         = 0.5 * (        T[i-1] +         T[i])
-    else:
-        o3_vmr_mid    = o3_vmr[i]
-        RH_mid        = RH[i]
-        cloud_lmr_mid = cloud_lmr[i]
-        cloud_imr_mid = cloud_imr[i]
-        T_mid         = T[i]
-    if (o3_vmr_mid > 0.0):
-        print("column o3 vmr {0:.3e}".format(o3_vmr_mid))
-    if (Pbase[i] > RH_TOP_PLEVEL):
-        if (T_mid < H2O_SUPERCOOL_LIMIT):
-            print("column h2o RHi {0:.2f}%".format(RH_mid))
-        else:
-            print("column h2o RH {0:.2f}%".format(RH_mid))
-    else:
-        print("column h2o vmr {0:.3e}".format(STRAT_H2O_VMR))
-    if (cloud_lmr_mid > 0.0):
-        #
-        # Convert cloud liquid water mixing ratio [kg / kg] to
-        # cloud total liquid water across the layer [kg / m^2].
-        # Below the supercooling limit, assume any liquid water
-        # is really ice.  (GFS 15 occasionally had numerically
-        # negligible amounts of liquid water at unphysically
-        # low temperature.)
-        #
-        dP = PASCAL_ON_MBAR * (Pbase[0] if i == 0 else Pbase[i] - Pbase[i-1])
-        m = dP / G_STD 
-        ctw = m * cloud_lmr_mid
-        if (T_mid < H2O_SUPERCOOL_LIMIT):
-            print("column iwp_abs_Rayleigh {0:.3e} kg*m^-2".format(ctw))
-        else:
-            print("column lwp_abs_Rayleigh {0:.3e} kg*m^-2".format(ctw))
-    if (cloud_imr_mid > 0.0):
+# URL of the index file whose presence on the server shows that a
+# given product is available for download.
+#
+def index_url(gfsdate, gfscycle, gfsprod):
+    return INDEX_URL_FORMAT.format(gfsdate, gfscycle, LATLON_GRID_STR, gfsprod)
+
+
+#
+# Build a string identifying the data requested by request_url(),
+# for use as a cache key.  It contains every field that goes into
+# the request, so any change to the request changes the key.
+#
+def request_key(lat, lon, gfsdate, gfscycle, gfsprod):
+    leftlon, bottomlat, latlon_delta = latlon_subregion(lat, lon)
+    return "gfs {0} {1:02d} {2} {3} lev={4} var={5} sub={6},{7},{8}".format(
+            gfsdate,
+            gfscycle,
+            gfsprod,
+            LATLON_GRID_STR,
+            ",".join(str(lev) for lev in LEVELS),
+            ",".join(VARIABLES),
+            leftlon,
+            bottomlat,
+            latlon_delta)
+
+
+#
+# Download the GFS data for a given site position, production date
+# and cycle, and product, returning the grib2 data as bytes.  Raises
+# nomads.DownloadError if the download fails.  If a GribCache is
+# given, the data are taken from the cache if present there, and
+# otherwise are stored in the cache after downloading.
+#
+def fetch_grib(lat, lon, gfsdate, gfscycle, gfsprod, cache=None):
+    if cache is not None:
+        key = request_key(lat, lon, gfsdate, gfscycle, gfsprod)
+        content = cache.get(key)
+        if content is not None:
+            return content
+    content = nomads.fetch(request_url(lat, lon, gfsdate, gfscycle, gfsprod))
+    if cache is not None:
+        cache.put(key, content)
+    return content
+
+
+#
+# Split a buffer holding a sequence of grib2 messages, as returned by
+# NOMADS, into a list of individual messages.  Each message starts
+# with "GRIB", and its total length is given in octets 9-16 of the
+# indicator section.
+#
+def split_grib(content):
+    msgs = []
+    pos = 0
+    while True:
+        start = content.find(b"GRIB", pos)
+        if start < 0:
+            break
+        if start + 16 > len(content):
+            raise ValueError("truncated grib message")
+        if content[start + 7] != 2:
+            raise ValueError("not a grib2 message")
+        end = start + int.from_bytes(content[start + 8:start + 16], "big")
+        if content[end - 4:end] != b"7777":
+            raise ValueError("truncated grib message")
+        msgs.append(content[start:end])
+        pos = end
+    return msgs
+
+
+#
+# Indices of the GFS variables along the variable axis of the arrays
+# used below, keyed by grib shortName.  The variables are
+#   gh    - Geopotential height [m]
+#   t     - Temperature [K]
+#   o3mr  - Ozone mixing ratio [kg O3 / kg air]
+#   r     - Relative humidity [%]
+#   clwmr - Cloud mixing ratio [kg liquid / kg air]
+#   icmr  - Ice water mixing ratio [kg ice / kg air]
+#
+PROFILE_VARS = ("gh", "t", "o3mr", "r", "clwmr", "icmr")
+I_Z, I_T, I_O3, I_RH, I_CLW, I_ICE = range(len(PROFILE_VARS))
+
+#
+# Values substituted for missing data.  For height and temperature,
+# BADVAL is inserted if the variable is missing or not defined on a
+# level.  Other variables are set to zero.
+#
+PROFILE_FILL = np.array((BADVAL, BADVAL, 0.0, 0.0, 0.0, 0.0))
+
+#
+# Codes for the form of the h2o column on each layer
+#
+H2O_VMR = 0     # fixed stratospheric mixing ratio
+H2O_RH  = 1     # RH over water
+H2O_RHI = 2     # RH over ice
+
+
+#
+# Decode the grib2 data in a single pass over the messages, filling
+# an array of shape (variable, level, 2, 2) holding the four grid
+# points around the site for each variable and level.  Returns this
+# array, and a boolean mask of shape (variable, level) which is True
+# where data were present.  Messages for other variables or levels
+# are ignored.
+#
+def decode_grid(content):
+    var_index = {var: i for i, var in enumerate(PROFILE_VARS)}
+    lev_index = {lev: i for i, lev in enumerate(LEVELS)}
+    grid    = np.zeros((len(PROFILE_VARS), len(LEVELS), 2, 2))
+    present = np.zeros((len(PROFILE_VARS), len(LEVELS)), dtype=bool)
+    for msg in split_grib(content):
+        grb = pygrib.fromstring(msg)
+        i = var_index.get(grb.shortName)
+        j = lev_index.get(grb.level)
+        if i is None or j is None:
+            continue
+        grid[i, j]    = grb.values
+        present[i, j] = True
+    return grid, present
+
+
+#
+# Interpolate the grid returned by decode_grid() to lat,lon at all
+# variables and levels at once.  Returns an array of shape (variable,
+# level), with missing data replaced by PROFILE_FILL, and ozone
+# converted from mass mixing ratio to volume mixing ratio.
+#
+def interp_profiles(grid, present, lat, lon):
+    leftlon, bottomlat, latlon_delta = latlon_subregion(lat, lon)
+    u = (lat - bottomlat) / latlon_delta
+    v = (lon - leftlon) / latlon_delta
+    profiles = grid_interp(grid, u, v)
+    profiles[..., I_O3, :] *= M_AIR / M_O3
+    return np.where(present, profiles, PROFILE_FILL[:, np.newaxis])
+
+
+#
+# Turn grib2 data given as bytes into profiles interpolated to lat,lon
+# at each pressure level.  Returns the profiles array and the mask of
+# data present, as described above.
+#
+def extract_profiles(content, lat, lon):
+    grid, present = decode_grid(content)
+    return interp_profiles(grid, present, lat, lon), present
+
+
+#
+# Derive the am layer quantities from profiles interpolated to the
+# site.  The profiles array has shape (..., variable, level); the
+# leading axes, if any, are typically forecast hour, so that a whole
+# cycle stacked into an (hour, variable, level) array is processed
+# at once.  Returns a dict of arrays, in which those describing the
+# layers at the GFS levels have shape (..., level), and those
+# describing the base layer at the site altitude have shape (...):
+#
+#   nlayers    - number of GFS levels above the site altitude
+#   Pbase, z, T, o3, RH, h2o, lwp, lwp_ice, iwp
+#              - base pressure, height, and temperature, layer mean
+#                o3 vmr and RH, h2o column code (H2O_*), cloud liquid
+#                path (as liquid and as ice below the supercooling
+#                limit), and cloud ice path for each layer
+#   ok         - False where the altitude is above the top GFS level
+#   base       - True where a base layer is needed below the lowest
+#                GFS level above the site
+#   P_s, T_s, o3_s, RH_s, h2o_s, lwp_s, lwp_ice_s, iwp_s
+#              - the same quantities for the base layer
+#
+def derive_layers(profiles, altitude):
+    P         = np.array(LEVELS, dtype=float)
+    z         = profiles[..., I_Z,   :]
+    T         = profiles[..., I_T,   :]
+    o3_vmr    = profiles[..., I_O3,  :]
+    RH        = profiles[..., I_RH,  :]
+    cloud_lmr = profiles[..., I_CLW, :]
+    cloud_imr = profiles[..., I_ICE, :]
+    nlev      = len(LEVELS)
+
+    #
+    # On a layer, mixing ratios and RH are set to their averages over
+    # the two levels bounding the layer.  The top layer takes the
+    # values at the top level.
+    #
+    def mid(x):
+        xm = x.copy()
+        xm[..., 1:] = 0.5 * (x[..., :-1] + x[..., 1:])
+        return xm
+    o3_vmr_mid    = mid(o3_vmr)
+    RH_mid        = mid(RH)
+    cloud_lmr_mid = mid(cloud_lmr)
+    cloud_imr_mid = mid(cloud_imr)
+    T_mid         = mid(T)
+
+    #
+    # Convert cloud liquid water and ice mixing ratios [kg / kg] to
+    # cloud total liquid water and ice across the layer [kg / m^2].
+    # Below the supercooling limit, assume any liquid water is
+    # really ice.  (GFS 15 occasionally had numerically negligible
+    # amounts of liquid water at unphysically low temperature.)
+    #
+    dP = PASCAL_ON_MBAR * np.concatenate((P[:1], P[1:] - P[:-1]))
+    m  = dP / G_STD
+    icy = T_mid < H2O_SUPERCOOL_LIMIT
+    ctw = np.where(cloud_lmr_mid > 0.0, m * cloud_lmr_mid, 0.0)
+    cti = np.where(cloud_imr_mid > 0.0, m * cloud_imr_mid, 0.0)
+    h2o = np.where(P > RH_TOP_PLEVEL, np.where(icy, H2O_RHI, H2O_RH), H2O_VMR)
+
+    #
+    # Layers are generated down to the first level below the site
+    # altitude.  If no level is below the site, the last layer is the
+    # bottom GFS level, and the base level is extrapolated below it.
+    #
+    below   = z < altitude
+    nlayers = np.where(below.any(axis=-1), np.argmax(below, axis=-1), nlev)
+    i       = np.minimum(nlayers, nlev - 1)
+    ok      = i > 0
+    i       = np.maximum(i, 1)
+
+    def at(x, k):
+        return np.take_along_axis(x, k[..., np.newaxis], axis=-1)[..., 0]
+
+    #
+    # The base layer and base level of the model are special cases.
+    # First, we find the pressure and temperature of the base level by
+    # linearly interpolating (or extrapolating) log P and T in z.  If
+    # the base level coincides exactly with a model level, there is
+    # no base layer.
+    #
+    z0, z1 = at(z, i - 1), at(z, i)
+    T0, T1 = at(T, i - 1), at(T, i)
+    P0, P1 = P[i - 1], P[i]
+    base = ok & (z1 != altitude)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u      = (altitude - z0) / (z1 - z0)
+        logP_s = u * np.log(P1) + (1.0 - u) * np.log(P0)
+        P_s    = np.exp(logP_s)
+        T_s    = u * T1 + (1.0 - u) * T0
+        T_mid_s = 0.5 * (T_s + T0)
+
         #
-        # Convert cloud ice mixing ratio [kg / kg] to cloud total
-        # ice across the layer [kg / m^2].
+        # Other variables are interpolated or extrapolated linearly in
+        # P to the base level and clamped at zero.
         #
-        dP = PASCAL_ON_MBAR * (Pbase[0] if i == 0 else Pbase[i] - Pbase[i-1])
-        m = dP / G_STD 
-        cti = m * cloud_imr_mid
-        print("column iwp_abs_Rayleigh {0:.3e} kg*m^-2".format(cti))
-    print("")
+        u = (P_s - P0) / (P1 - P0)
+        def base_mid(x):
+            x0, x1 = at(x, i - 1), at(x, i)
+            x_s = np.maximum(u * x1 + (1.0 - u) * x0, 0.0)
+            return 0.5 * (x0 + x_s)
+        o3_vmr_mid_s    = base_mid(o3_vmr)
+        RH_mid_s        = base_mid(RH)
+        cloud_lmr_mid_s = base_mid(cloud_lmr)
+        cloud_imr_mid_s = base_mid(cloud_imr)
+        m_s = PASCAL_ON_MBAR * (P1 - P0) / G_STD
+    icy_s = T_mid_s < H2O_SUPERCOOL_LIMIT
+
+    return {
+        "nlayers":   nlayers,
+        "Pbase":     np.broadcast_to(P, z.shape),
+        "z":         z,
+        "T":         T,
+        "o3":        o3_vmr_mid,
+        "RH":        RH_mid,
+        "h2o":       h2o,
+        "lwp":       np.where(icy, 0.0, ctw),
+        "lwp_ice":   np.where(icy, ctw, 0.0),
+        "iwp":       cti,
+        "ok":        ok,
+        "base":      base,
+        "P_s":       P_s,
+        "T_s":       T_s,
+        "o3_s":      o3_vmr_mid_s,
+        "RH_s":      RH_mid_s,
+        "h2o_s":     np.where(P_s > RH_TOP_PLEVEL,
+                             np.where(icy_s, H2O_RHI, H2O_RH), H2O_VMR),
+        "lwp_s":     np.where((cloud_lmr_mid_s > 0.0) & ~icy_s,
+                             m_s * cloud_lmr_mid_s, 0.0),
+        "lwp_ice_s": np.where((cloud_lmr_mid_s > 0.0) & icy_s,
+                             m_s * cloud_lmr_mid_s, 0.0),
+        "iwp_s":     np.where(cloud_imr_mid_s > 0.0,
+                             m_s * cloud_imr_mid_s, 0.0),
+        }
+
 
 #
-# The base layer and base level of the model are special cases.  First,
-# we find the pressure and temperature of the base level by linearly
-# interpolating (or extrapolating) log P and T in z.
+# Format the column lines for one layer.
 #
-if (i == 0):
-    print("User-specified altitude exceeds top GFS level", file=sys.stderr)
-    exit(1)
+def _layer_columns(o3, RH, h2o, lwp, lwp_ice, iwp):
+    out = ["column dry_air vmr"]
+    if (o3 > 0.0):
+        out.append("column o3 vmr {0:.3e}".format(o3))
+    if (h2o == H2O_RHI):
+        out.append("column h2o RHi {0:.2f}%".format(RH))
+    elif (h2o == H2O_RH):
+        out.append("column h2o RH {0:.2f}%".format(RH))
+    else:
+        out.append("column h2o vmr {0:.3e}".format(STRAT_H2O_VMR))
+    if (lwp_ice > 0.0):
+        out.append("column iwp_abs_Rayleigh {0:.3e} kg*m^-2".format(lwp_ice))
+    elif (lwp > 0.0):
+        out.append("column lwp_abs_Rayleigh {0:.3e} kg*m^-2".format(lwp))
+    if (iwp > 0.0):
+        out.append("column iwp_abs_Rayleigh {0:.3e} kg*m^-2".format(iwp))
+    return out
+
 
 #
-# If the base level coincides exactly with a model level, we're done.
+# Render the layers returned by derive_layers() as am layers down to
+# the site altitude, and return them as a string.  If the layers were
+# derived from stacked profiles, index selects the one to render,
+# e.g. index=(k,) for the k-th forecast hour.  Raises ValueError if
+# the altitude is above the top GFS level.
+#
+def render_layers(layers, lat, lon, altitude, gfsdate, gfscycle, gfsprod,
+        index=()):
+    L = {key: val[index] for key, val in layers.items()}
+    if not L["ok"]:
+        raise ValueError("User-specified altitude exceeds top GFS level")
+    out = []
+    #
+    # Start with a header comment over the layer descriptions
+    #
+    if (gfsprod == "anl"):
+        product_str = "analysis"
+    else:
+        product_str = gfsprod[1:] + " hour forecast"
+    out.append(LAYER_HEADER.format(
+            gfsdate,
+            gfscycle,
+            product_str,
+            lat,
+            lon,
+            altitude))
+    for i in range(L["nlayers"]):
+        out.append("layer")
+        out.append("Pbase {0:.1f} mbar  # {1:.1f} m".format(
+                L["Pbase"][i], L["z"][i]))
+        out.append("Tbase {0:.1f} K".format(L["T"][i]))
+        out.extend(_layer_columns(L["o3"][i], L["RH"][i], L["h2o"][i],
+                L["lwp"][i], L["lwp_ice"][i], L["iwp"][i]))
+        out.append("")
+    if L["base"]:
+        out.append("layer")
+        out.append("Pbase {0:.1f} mbar  # {1:.1f} m".format(
+                L["P_s"], altitude))
+        out.append("Tbase {0:.1f} K".format(L["T_s"]))
+        out.extend(_layer_columns(L["o3_s"], L["RH_s"], L["h2o_s"],
+                L["lwp_s"], L["lwp_ice_s"], L["iwp_s"]))
+    return "\n".join(out) + "\n"
+
+
 #
-if (z[i] == args.altitude):
-    exit(0)
+# Validate a GFS product name, returning an error message string, or
+# None if the name is OK.
+#
+def check_product(gfsprod):
+    if (gfsprod == "anl"):
+        return None
+    if (gfsprod[0:1] != "f"):
+        return "invalid GFS product name"
+    forecast_hour = int(gfsprod[1:])
+    #
+    # These checks pertain to the 0.25 degree product
+    #
+    if (forecast_hour < 0 or forecast_hour > 384):
+        return "invalid forecast hour (out of range)"
+    if (forecast_hour > 120 and forecast_hour % 3 != 0):
+        return "invalid forecast hour (3-hourly only after 120 h)"
+    return None
 
-u      = (args.altitude - z[i-1]) / (z[i] - z[i-1])
-logP_s = u * math.log(Pbase[i]) + (1.0 - u) * math.log(Pbase[i-1]) 
-P_s    = math.exp(logP_s)
-T_s    = u * T[i] + (1.0 - u) * T[i-1]
-T_mid  = 0.5 * (T_s + T[i-1])
-
-#
-# Other variables are interpolated or extrapolated linearly in P
-# to the base level and clamped at zero.
-#
-u = (P_s - Pbase[i-1]) / (Pbase[i] - Pbase[i-1])
-o3_vmr_s    = u *    o3_vmr[i] + (1.0 - u) *    o3_vmr[i-1]
-RH_s        = u *        RH[i] + (1.0 - u) *        RH[i-1]
-cloud_lmr_s = u * cloud_lmr[i] + (1.0 - u) * cloud_lmr[i-1]
-cloud_imr_s = u * cloud_imr[i] + (1.0 - u) * cloud_imr[i-1]
-if (o3_vmr_s < 0.0):
-    o3_vmr_s = 0.0
-if (RH_s < 0.0):
-    RH_s = 0.0
-if (cloud_lmr_s < 0.0):
-    cloud_lmr_s = 0.0
-if (cloud_imr_s < 0.0):
-    cloud_imr_s = 0.0
-o3_vmr_mid    = 0.5 * (   o3_vmr[i-1] +    o3_vmr_s)
-RH_mid        = 0.5 * (       RH[i-1] +        RH_s)
-cloud_lmr_mid = 0.5 * (cloud_lmr[i-1] + cloud_lmr_s)
-cloud_imr_mid = 0.5 * (cloud_imr[i-1] + cloud_imr_s)
-print("layer")
-print("Pbase {0:.1f} mbar  # {1:.1f} m".format(P_s, args.altitude))
-print("Tbase {0:.1f} K".format(T_s))
-print("column dry_air vmr")
-if (o3_vmr_mid > 0.0):
-    print("column o3 vmr {0:.3e}".format(o3_vmr_mid))
-if (P_s > RH_TOP_PLEVEL):
-    if (T_mid < H2O_SUPERCOOL_LIMIT):
-        print("column h2o RHi {0:.2f}%".format(RH_mid))
-    else:
-        print("column h2o RH {0:.2f}%".format(RH_mid))
-else:
-    print("column h2o vmr {0:.3e}".format(STRAT_H2O_VMR))
-if (cloud_lmr_mid > 0.0):
-    dP = PASCAL_ON_MBAR * (Pbase[0] if i == 0 else Pbase[i] - Pbase[i-1])
-    m = dP / G_STD 
-    ctw = m * cloud_lmr_mid
-    if (T_mid < H2O_SUPERCOOL_LIMIT):
-        print("column iwp_abs_Rayleigh {0:.3e} kg*m^-2".format(ctw))
+
+def main():
+    #
+    # Parse the command line and validate arguments.
+    #
+    parser = argparse.ArgumentParser()
+    parser.add_argument("lat",      help="site latitude [deg], (-90 to 90)",
+        type=float)
+    parser.add_argument("lon",      help="site longitude [deg], (-180 to 180)",
+        type=float)
+    parser.add_argument("altitude", help="site altitude [m]",
+        type=float)
+    parser.add_argument("gfsdate",  help="GFS production date (YYYYMMDD)",
+        type=str)
+    parser.add_argument("gfscycle", help="GFS production cycle (0, 6, 12, 18)",
+        type=int)
+    parser.add_argument("gfsprod",  help="GFS product: anl or f000 - f384",
+        type=str)
+    parser.add_argument("--gribfile",
+        help="read GFS data from this previously downloaded file instead of NOMADS",
+        type=str)
+    parser.add_argument("--no-cache",
+        help="bypass the GRIB cache (see grib_cache.py)",
+        action="store_true")
+    args = parser.parse_args()
+
+    if (args.lat < -90. or args.lat > 90.):
+        parser.error("invalid latitude")
+    if (args.lon < -180. or args.lon > 180.):
+        parser.error("invalid longitude")
+    if (args.altitude < -500.):
+        parser.error("invalid altitude")
+    try:
+        gfsdatetime = dparser.parse(args.gfsdate)
+    except:
+        parser.error("bad GFS production date")
+    if (gfsdatetime < datetime.datetime(2017, 1, 1)):
+        parser.error("GFS production date too early")
+    if (args.gfscycle not in (0, 6, 12, 18)):
+        parser.error("invalid GFS production cycle")
+    errmsg = check_product(args.gfsprod)
+    if (errmsg is not None):
+        parser.error(errmsg)
+
+    #
+    # Args OK.  If a previously downloaded file was given, use that.
+    # Otherwise, download the requested data in grib2 format.  Either
+    # way, the data are decoded in memory.
+    #
+    if (args.gribfile is not None):
+        with open(args.gribfile, 'rb') as f:
+            content = f.read()
     else:
-        print("column lwp_abs_Rayleigh {0:.3e} kg*m^-2".format(ctw))
-if (cloud_imr_mid > 0.0):
-    dP = PASCAL_ON_MBAR * (Pbase[0] if i == 0 else Pbase[i] - Pbase[i-1])
-    m = dP / G_STD 
-    cti = m * cloud_imr_mid
-    print("column iwp_abs_Rayleigh {0:.3e} kg*m^-2".format(cti))
-exit(0)
+        try:
+            cache = None if args.no_cache else grib_cache.default_cache()
+            content = fetch_grib(args.lat, args.lon,
+                    args.gfsdate, args.gfscycle, args.gfsprod, cache)
+        except nomads.DownloadError:
+            exit(1)
+    try:
+        profiles, present = extract_profiles(content, args.lat, args.lon)
+    except ValueError as err:
+        print("Bad grib data: {0}".format(err), file=sys.stderr)
+        exit(1)
+    layers = derive_layers(profiles, args.altitude)
+    try:
+        print(render_layers(layers, args.lat, args.lon, args.altitude,
+                args.gfsdate, args.gfscycle, args.gfsprod), end='')
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        exit(1)
+    exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+#
+# gfs_cycle.py - for a given site latitude, longitude, and altitude,
+# download the GFS data for all the forecast products of one GFS
+# production cycle (or a subset of them), and generate the
+# corresponding sets of am layers interpolated to the site position.
+# The layers for each product are written to a file named for the
+# product, e.g. f000.amc, in the output directory.
+#
+# Products already in the GRIB cache (see grib_cache.py) are taken
+# from there, and only the rest are downloaded.  Downloads run
+# concurrently, with the number of requests in flight and the
+# request rate limited as described in nomads.py.  Each
+# product is decoded and interpolated to the site as soon as its
+# download completes.  The am layers for the whole cycle are then
+# derived at once from the stacked profiles.  All of this is done
+# with the functions in gfs16_to_am10.py, within this one process.
+# At the end, a summary is written to stderr, including an estimate
+# of the time saved by not starting a new Python interpreter to run
+# gfs16_to_am10.py for each product.
+#
+
+import argparse
+import itertools
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import gfs16_to_am10
+import grib_cache
+import nomads
+from gfs_products import FORECAST_HOURS, product_name
+
+#
+# Measure the time taken to start a new Python interpreter and
+# import gfs16_to_am10 (and with it pygrib, requests, and dateutil).
+# This is the overhead paid for each product when gfs16_to_am10.py
+# is run as a separate script.
+#
+def measure_startup_time():
+    t0 = time.monotonic()
+    subprocess.run([sys.executable, "-c", "import gfs16_to_am10"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.monotonic() - t0
+
+
+#
+# Write the am layers for each product, given profiles stacked into
+# an array of shape (product, variable, level) with the products in
+# the order listed in prods.  The layer quantities are derived for
+# all products at once.  Returns the number of products that failed.
+#
+def write_layers(profiles, prods, outdir, lat, lon, altitude, gfsdate,
+        gfscycle):
+    nfail  = 0
+    layers = gfs16_to_am10.derive_layers(profiles, altitude)
+    for k, prod in enumerate(prods):
+        try:
+            text = gfs16_to_am10.render_layers(layers, lat, lon, altitude,
+                    gfsdate, gfscycle, prod, index=(k,))
+        except ValueError as err:
+            print("{0}: conversion failed: {1}".format(prod, err),
+                    file=sys.stderr)
+            nfail += 1
+            continue
+        with open(os.path.join(outdir, prod + ".amc"), 'w') as f:
+            f.write(text)
+    return nfail
+
+
+#
+# Retrieve the GRIB data for a set of products of a GFS cycle,
+# returning an iterator over (product, content) pairs, with content
+# None for products that failed to download.  Products found in the
+# cache come first, then the rest as their downloads complete, which
+# are put in the cache.  Downloads draw from the given rate limiter,
+# if any, with up to max_connections in flight (see
+# nomads.download()).
+#
+def fetch_products(lat, lon, gfsdate, gfscycle, prods, cache=None,
+        limiter=None, max_connections=nomads.MAX_CONNECTIONS):
+    hits = []
+    reqs = []
+    keys = {}
+    for prod in prods:
+        if cache is not None:
+            keys[prod] = gfs16_to_am10.request_key(
+                    lat, lon, gfsdate, gfscycle, prod)
+            content = cache.get(keys[prod])
+            if content is not None:
+                hits.append((prod, content))
+                continue
+        reqs.append((prod, gfs16_to_am10.request_url(
+                lat, lon, gfsdate, gfscycle, prod)))
+
+    def downloads():
+        for prod, content in nomads.download(reqs, max_connections,
+                limiter=limiter):
+            if content is not None and cache is not None:
+                cache.put(keys[prod], content)
+            yield prod, content
+
+    return itertools.chain(hits, downloads())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("lat",      help="site latitude [deg], (-90 to 90)",
+        type=float)
+    parser.add_argument("lon",      help="site longitude [deg], (-180 to 180)",
+        type=float)
+    parser.add_argument("altitude", help="site altitude [m]",
+        type=float)
+    parser.add_argument("gfsdate",  help="GFS production date (YYYYMMDD)",
+        type=str)
+    parser.add_argument("gfscycle", help="GFS production cycle (0, 6, 12, 18)",
+        type=int)
+    parser.add_argument("outdir",   help="directory for am layer files",
+        type=str)
+    parser.add_argument("--no-cache",
+        help="bypass the GRIB cache (see grib_cache.py)",
+        action="store_true")
+    parser.add_argument("--products",
+        help="process only these products (default: the full cycle)",
+        nargs="+", metavar="fxxx")
+    args = parser.parse_args()
+
+    if (args.lat < -90. or args.lat > 90.):
+        parser.error("invalid latitude")
+    if (args.lon < -180. or args.lon > 180.):
+        parser.error("invalid longitude")
+    if (args.altitude < -500.):
+        parser.error("invalid altitude")
+    if (args.gfscycle not in (0, 6, 12, 18)):
+        parser.error("invalid GFS production cycle")
+    if (not os.path.isdir(args.outdir)):
+        parser.error("output directory does not exist")
+    all_prods = [product_name(hour) for hour in FORECAST_HOURS]
+    if args.products is None:
+        args.products = all_prods
+    for prod in args.products:
+        if prod not in all_prods:
+            parser.error("invalid product {0}".format(prod))
+
+    cache = None if args.no_cache else grib_cache.default_cache()
+
+    #
+    # Each product is decoded and interpolated to the site as soon as
+    # it is available, and the profiles are collected.
+    #
+    t0 = time.monotonic()
+    t_convert = 0.0
+    nfail = 0
+    profiles = {}
+    for prod, content in fetch_products(args.lat, args.lon, args.gfsdate,
+            args.gfscycle, args.products, cache):
+        if content is None:
+            nfail += 1
+            continue
+        t1 = time.monotonic()
+        try:
+            profiles[prod], _ = gfs16_to_am10.extract_profiles(
+                    content, args.lat, args.lon)
+        except Exception as err:
+            print("{0}: conversion failed: {1}".format(prod, err),
+                    file=sys.stderr)
+            nfail += 1
+        t_convert += time.monotonic() - t1
+
+    #
+    # Then the whole cycle is stacked into an (hour, variable, level)
+    # array for layer derivation.
+    #
+    t1 = time.monotonic()
+    prods = [prod for prod in all_prods if prod in profiles]
+    if prods:
+        nfail += write_layers(np.stack([profiles[p] for p in prods]), prods,
+                args.outdir, args.lat, args.lon, args.altitude,
+                args.gfsdate, args.gfscycle)
+    t_convert += time.monotonic() - t1
+    t_total = time.monotonic() - t0
+
+    nprod = len(args.products)
+    nconv = nprod - nfail
+    t_startup = measure_startup_time()
+    print("Converted {0} of {1} products in {2:.1f} s ".format(
+            nconv, nprod, t_total) +
+            "({0:.3f} s per product in conversion).".format(
+            t_convert / max(nconv, 1)), file=sys.stderr)
+    stats = nomads.connection_stats()
+    print("Made {0} requests over {1} connections ({2} reused).".format(
+            stats["requests"], stats["connections"], stats["reused"]),
+            file=sys.stderr)
+    stats = nomads.retry_stats()
+    print("Made {0} attempts with {1} retries ".format(
+            stats["attempts"], stats["retries"]) +
+            "({0} throttled, {1:.0f} s waiting); ".format(
+            stats["throttled"], stats["wait"]) +
+            "circuit breaker tripped {0} times, deferring {1} requests.".format(
+            stats["trips"], stats["deferred"]), file=sys.stderr)
+    if cache is not None:
+        stats = cache.stats()
+        print("GRIB cache: {0} hits, {1} misses, {2:.1f} MB in use.".format(
+                stats["hits"], stats["misses"], stats["bytes"] / 1e6),
+                file=sys.stderr)
+    print("Interpreter startup is {0:.3f} s per product, ".format(t_startup) +
+            "so running in one process saved {0:.1f} s.".format(
+            t_startup * max(nconv - 1, 0)), file=sys.stderr)
+    exit(1 if nfail else 0)
+
+
+if __name__ == "__main__":
+    main()
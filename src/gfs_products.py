@@ -0,0 +1,38 @@
+#
+# gfs_products.py - the forecast products making up one GFS
+# production cycle, their names, and their valid times.  This module
+# is not run directly; it is imported by the other scripts.
+#
+
+import datetime
+
+#
+# Forecast hours making up a full cycle of the 0.25 degree product.
+# These are hourly for the first 5 days, and 3-hourly thereafter.
+#
+FORECAST_HOURS = tuple(range(0, 121)) + tuple(range(123, 385, 3))
+
+
+#
+# Product name for a given forecast hour, e.g. "f006"
+#
+def product_name(hour):
+    return "f{0:03d}".format(hour)
+
+
+#
+# Forecast hour for a given product name
+#
+def product_hour(prod):
+    return int(prod[1:])
+
+
+#
+# Time stamp for the forecast table line for a given forecast hour of
+# the GFS cycle given by gfsdate (YYYYMMDD) and gfscycle (0, 6, 12,
+# 18).  This is the same as the output of make_gfs_timestamp.py.
+#
+def valid_time_str(gfsdate, gfscycle, hour):
+    valid = (datetime.datetime.strptime(gfsdate, "%Y%m%d") +
+            datetime.timedelta(hours=(gfscycle + hour)))
+    return valid.strftime("%Y%m%d_%H:00:00")
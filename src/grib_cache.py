@@ -0,0 +1,133 @@
+#
+# grib_cache.py - on-disk cache of subsetted GRIB2 responses from
+# NOMADS.  This module is not run directly; it is imported by the
+# scripts which retrieve GFS data.
+#
+# Entries are content-addressed: the key for a response is a hash
+# of a string built from all the fields that make up the request
+# (see gfs16_to_am10.request_key()), so that a change to any of them,
+# e.g. the list of levels, can never return stale data.  The cache
+# has a byte budget, and when it is exceeded, the least recently
+# used entries are evicted.  Recency of use is tracked with file
+# modification times, so that a cache directory can be shared by
+# more than one process.
+#
+# The cache is configured in the environment:
+#
+#   GRIB_CACHE_DIR    - cache directory.  If unset or empty, there
+#                       is no caching.
+#   GRIB_CACHE_MAX_MB - byte budget for the cache, in MB.
+#
+
+import hashlib
+import os
+import tempfile
+import threading
+
+CACHE_DIR    = os.getenv('GRIB_CACHE_DIR', '')
+CACHE_MAX_MB = float(os.getenv('GRIB_CACHE_MAX_MB', '200'))
+
+CACHE_SUFFIX = ".grb2"
+
+
+class GribCache:
+
+    suffix = CACHE_SUFFIX
+
+    def __init__(self, path=CACHE_DIR, max_bytes=CACHE_MAX_MB * 1e6):
+        self.path      = path
+        self.max_bytes = max_bytes
+        self.hits      = 0
+        self.misses    = 0
+        self.lock      = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.nbytes    = sum(size for _, size, _ in self._entries())
+
+    #
+    # List the cache entries as (path, size, mtime) tuples.
+    #
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(self.suffix):
+                continue
+            fpath = os.path.join(self.path, name)
+            try:
+                st = os.stat(fpath)
+            except FileNotFoundError:
+                continue    # evicted by another process
+            entries.append((fpath, st.st_size, st.st_mtime))
+        return entries
+
+    def _path(self, key):
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.path, digest + self.suffix)
+
+    #
+    # Return the cached content for key, or None if there is none.
+    # A hit marks the entry as most recently used.
+    #
+    def get(self, key):
+        fpath = self._path(key)
+        try:
+            with open(fpath, 'rb') as f:
+                content = f.read()
+            os.utime(fpath)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return content
+
+    #
+    # Store content under key.  The entry is written to a temporary
+    # file and renamed into place, so readers never see a partial
+    # entry.
+    #
+    def put(self, key, content):
+        fd, tmppath = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmppath, self._path(key))
+        with self.lock:
+            self.nbytes += len(content)
+            if self.nbytes > self.max_bytes:
+                self.evict()
+
+    #
+    # Remove least recently used entries until the cache is within
+    # its byte budget.  Since other processes may be using the same
+    # directory, the running total is refreshed from the directory
+    # listing here.
+    #
+    def evict(self):
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        self.nbytes = sum(size for _, size, _ in entries)
+        for fpath, size, _ in entries:
+            if self.nbytes <= self.max_bytes:
+                break
+            try:
+                os.remove(fpath)
+            except FileNotFoundError:
+                pass
+            self.nbytes -= size
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits":   self.hits,
+                "misses": self.misses,
+                "bytes":  self.nbytes,
+                }
+
+
+#
+# Return a cache using the directory and budget set in the
+# environment, or None if caching is not configured.
+#
+def default_cache():
+    if not CACHE_DIR:
+        return None
+    return GribCache()
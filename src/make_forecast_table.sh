@@ -1,65 +1,56 @@
 # make_forecast_table.sh - writes a forecast summary table with
 # one line for each forecast hour starting from the analysis
-# epoch.  For each hour, gfs_to_am10.py is called to generate am
-# model layers.  These are appended to a header and am is run to
-# compute total column densities and the 225 GHz opacity, which
-# are then summarized in a single data line.
+# epoch.
+#
+# Progress is checkpointed hour by hour in the cycle state
+# directory CYCLE_DIR, as described in forecast_manifest.py, so
+# that if this script is rerun after a partial failure, only the
+# missing hours are computed.  These are computed by
+# forecast_cycle.py, which downloads the GFS data for all of them at
+# once, generates am layers for each hour as its data arrive, and
+# runs am on many hours at once to compute total column densities
+# and the 225 GHz opacity, which are then summarized in a single
+# data line and recorded as complete.  Finally, the table is
+# assembled from all the completed hours.
+#
+# With the option --first-pass, a quick provisional table is made
+# instead, with the 225 GHz opacity and brightness temperature for
+# the missing hours estimated by the surrogate model in the file
+# SURROGATE_MODEL (see surrogate.py) rather than computed by am.
+# The hours remain missing, to be computed by am when this script is
+# next run without the option, which replaces the provisional data.
 #
 # This script depends on the following environment variables:
 #   GFS_CYCLE - forecast cycle (YYYYMMDD HH) for this table
+#   CYCLE_DIR - state directory for this forecast cycle
 #   LAT       - site latitude
 #   LON       - site longitude
+#   ALT       - site altitude
 #   APPDIR    - directory containing this and related scripts
 #   AM        - path to am executable
-
-#
-# Limit the maximum download rate on the GFS server by sleeping
-# for RATE_LIMIT_DELAY seconds after each access.
+#   SURROGATE_MODEL - surrogate model file (for --first-pass only)
 #
-RATE_LIMIT_DELAY=1
+# The number of concurrent downloads and the request rate on the
+# GFS server are limited as described in nomads.py (see the NOMADS_*
+# environment variables), and the number of concurrent am processes
+# as described in am_runner.py (see AM_WORKERS).
 
-#
-# Print table column headers.
-#
-printf "#%16s %12s %12s %12s %12s %12s %12s\n" \
-        "date" \
-        "tau225" \
-        "Tb[K]" \
-        "pwv[mm]" \
-        "lwp[kg*m^-2]" \
-        "iwp[kg*m^-2]" \
-        "o3[DU]"
+mkdir -p $CYCLE_DIR
 
-#
-# Hourly GFS forecast for the first 5 days
-#
-for (( H = 0   ; H <= 120 ; H += 1 )); do
-    FORECAST_HOUR=$(printf "f%03d" $H)
-    if gfs16_to_am10.py $LAT $LON $ALT $GFS_CYCLE $FORECAST_HOUR \
-            > layers.amc 2>layers.err; then
-        make_gfs_timestamp.py $GFS_CYCLE $H
-        cat $APPDIR/header.amc layers.amc | $AM - 2>&1 |
-            awk -f $APPDIR/summarize.awk
-    else
-        date >> errors.log
-        cat layers.err >> errors.log
-    fi
-    sleep $RATE_LIMIT_DELAY
-done
+FIRST_PASS=
+if [ "$1" = "--first-pass" ]; then
+    FIRST_PASS="--surrogate $SURROGATE_MODEL"
+fi
 
-#
-# 3-hourly forecasts after 5 days
-#
-for (( H = 123 ; H <= 384 ; H += 3 )); do
-    FORECAST_HOUR=$(printf "f%03d" $H)
-    if gfs16_to_am10.py $LAT $LON $ALT $GFS_CYCLE $FORECAST_HOUR \
-            > layers.amc 2>layers.err; then
-        make_gfs_timestamp.py $GFS_CYCLE $H
-        cat $APPDIR/header.amc layers.amc | $AM - 2>&1 |
-            awk -f $APPDIR/summarize.awk
-    else
-        date >> errors.log
-        cat layers.err >> errors.log
-    fi
-    sleep $RATE_LIMIT_DELAY
-done
+if [ -n "$(forecast_manifest.py missing $CYCLE_DIR)" ]; then
+    #
+    # Forecast hours that fail to download or convert are skipped,
+    # and remain missing.  The summary and any error messages from
+    # forecast_cycle.py are logged.
+    #
+    date >> errors.log
+    forecast_cycle.py $LAT $LON $ALT $GFS_CYCLE $CYCLE_DIR $FIRST_PASS \
+            2>> errors.log
+fi
+
+forecast_manifest.py assemble $CYCLE_DIR
@@ -0,0 +1,419 @@
+#
+# nomads.py - download layer for the NOAA Operational Model Archive
+# Distribution System (NOMADS) grib filter CGI.  This module is not
+# run directly; it is imported by the scripts which retrieve GFS
+# data.
+#
+# A single request is made with fetch().  A whole set of requests,
+# such as all the forecast hours of a GFS cycle, is made with
+# download(), which keeps a bounded number of requests in flight
+# at once.  In both cases, the request rate is held under a limit
+# set by a token bucket shared by all requests, so that we stay
+# within the NOMADS usage policy no matter how many requests are
+# in flight.
+#
+# All requests go through a single HTTP session with a pool of
+# keep-alive connections, which lasts for the life of the process.
+# This way, the TCP connection and TLS handshake to the server are
+# paid once per pooled connection rather than once per request.
+# The pool is made large enough for the number of threads making
+# requests at once, as given to reserve_connections() by download()
+# and by other callers running their own threads.
+# connection_stats() reports how well connections are being reused.
+#
+# Failed requests are retried under a RetryPolicy, with delays that
+# grow exponentially and are randomized (jittered) so concurrent
+# retries don't arrive at the server together.  Throttling responses
+# (429 Too Many Requests and 503 Service Unavailable) are retried
+# after longer delays than timeouts and other server errors, and a
+# 429 also slows down the shared rate limiter.  Other client errors,
+# such as 404 for a product not yet posted, are not retried.  A
+# CircuitBreaker shared by all the requests for a cycle trips after
+# a run of consecutive failures, after which the remaining requests
+# fail at once without contacting the server, to be retried by the
+# next run.  retry_stats() reports the attempts, time spent waiting
+# to retry, and breaker trips.
+#
+
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+import requests.adapters
+
+# Timeouts and retries
+CONN_TIMEOUT        = 15       # Initial server response timeout in seconds
+READ_TIMEOUT        = 15       # Stalled download timeout in seconds
+RETRY_DELAY         = 10       # Initial delay before retry after an error
+THROTTLE_DELAY      = 60       # Initial delay after 429/503 (NOAA requests 60 s)
+MAX_RETRY_DELAY     = 300      # Upper limit on retry delays
+MAX_DOWNLOAD_TRIES  = 4
+BREAKER_THRESHOLD   = 8        # Consecutive failures that trip the breaker
+
+#
+# Concurrency and rate limits.  NOMADS asks users to stay under
+# 120 requests per minute, and blocks addresses that exceed this.
+# The defaults here are well under that limit, and can be
+# overridden in the environment.
+#
+#   NOMADS_MAX_CONNECTIONS - maximum number of requests in flight
+#   NOMADS_REQUEST_RATE    - sustained request rate [1 / s]
+#   NOMADS_REQUEST_BURST   - number of requests that may be issued
+#                            back-to-back before the sustained rate
+#                            limit takes hold
+#   NOMADS_POOL_SIZE       - minimum number of keep-alive
+#                            connections kept open to the server; the
+#                            pool grows to the number of threads
+#                            making requests at once
+#
+MAX_CONNECTIONS = int(os.getenv('NOMADS_MAX_CONNECTIONS', '4'))
+REQUEST_RATE    = float(os.getenv('NOMADS_REQUEST_RATE', '1.0'))
+REQUEST_BURST   = int(os.getenv('NOMADS_REQUEST_BURST', '4'))
+POOL_SIZE       = int(os.getenv('NOMADS_POOL_SIZE', str(MAX_CONNECTIONS)))
+
+_session      = None
+_session_lock = threading.Lock()
+_pool_size    = POOL_SIZE
+
+_stats = {
+    "attempts":  0,    # requests made, including retries
+    "retries":   0,    # retries after a failed attempt
+    "throttled": 0,    # 429 or 503 responses
+    "wait":      0.0,  # total time spent waiting to retry [s]
+    "trips":     0,    # circuit breaker trips
+    "deferred":  0,    # requests not made because the breaker was open
+    }
+_stats_lock = threading.Lock()
+
+
+class DownloadError(Exception):
+    pass
+
+
+class CircuitOpenError(DownloadError):
+    pass
+
+
+def _count(key, n=1):
+    with _stats_lock:
+        _stats[key] += n
+
+
+#
+# Return a copy of the retry statistics accumulated in this process.
+#
+def retry_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+#
+# Token bucket rate limiter.  The bucket holds up to burst tokens,
+# and refills at rate tokens per second.  Each request takes one
+# token, waiting for the bucket to refill if it is empty.  A single
+# bucket is shared among all the threads making requests.
+#
+class TokenBucket:
+
+    def __init__(self, rate=REQUEST_RATE, burst=REQUEST_BURST):
+        if rate <= 0.0 or burst < 1:
+            raise ValueError("rate and burst must be positive")
+        self.rate   = rate
+        self.rate0  = rate
+        self.burst  = burst
+        self.tokens = float(burst)
+        self.tlast  = time.monotonic()
+        self.lock   = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst,
+                        self.tokens + (now - self.tlast) * self.rate)
+                self.tlast = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    #
+    # Halve the sustained rate, down to a floor of 1/8 the initial
+    # rate.  This is called when the server says we are making too
+    # many requests.
+    #
+    def slow_down(self):
+        with self.lock:
+            self.rate = max(0.5 * self.rate, 0.125 * self.rate0)
+
+
+#
+# Retry policy.  Returns the delay before the next try, given the
+# number of tries so far, whether the last failure was a throttling
+# response, and the delay requested by the server in a Retry-After
+# header, if any.  Delays double with each try, up to max_delay.
+# After errors, "equal jitter" is applied, randomizing the delay
+# between half and all of the nominal value.  After throttling, the
+# nominal delay is a minimum, and the jitter adds up to half again.
+#
+class RetryPolicy:
+
+    def __init__(self, max_tries=MAX_DOWNLOAD_TRIES, base_delay=RETRY_DELAY,
+            throttle_delay=THROTTLE_DELAY, max_delay=MAX_RETRY_DELAY):
+        self.max_tries      = max_tries
+        self.base_delay     = base_delay
+        self.throttle_delay = throttle_delay
+        self.max_delay      = max_delay
+
+    def delay(self, tries, throttled=False, retry_after=None):
+        if throttled:
+            d = self.throttle_delay * 2 ** (tries - 1)
+            if retry_after is not None:
+                d = max(d, retry_after)
+            return min(d, self.max_delay) * random.uniform(1.0, 1.5)
+        d = min(self.base_delay * 2 ** (tries - 1), self.max_delay)
+        return d * random.uniform(0.5, 1.0)
+
+
+DEFAULT_POLICY = RetryPolicy()
+
+
+#
+# Circuit breaker, shared by all the requests for a cycle.  Each
+# failed attempt due to a timeout, connection error, broken response
+# (e.g. one cut short), or server error (5xx, including 503) counts
+# towards the threshold.  Any other response, including 429 and 404,
+# shows the server is up, and resets the count, as does any success.
+# Once tripped, the breaker stays open, and requests checking it fail
+# immediately.
+#
+class CircuitBreaker:
+
+    def __init__(self, threshold=BREAKER_THRESHOLD):
+        self.threshold = threshold
+        self.failures  = 0
+        self.tripped   = False
+        self.lock      = threading.Lock()
+
+    def check(self):
+        if self.tripped:
+            _count("deferred")
+            raise CircuitOpenError("circuit breaker open")
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold and not self.tripped:
+                self.tripped = True
+                _count("trips")
+                print("{0} consecutive failures, ".format(self.failures) +
+                        "server appears to be down.  Deferring remaining " +
+                        "requests.", file=sys.stderr)
+
+
+#
+# Return the HTTP session shared by all requests, creating it on
+# first use.
+#
+def session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            _mount(_session)
+    return _session
+
+
+def _mount(s):
+    adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=_pool_size)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+
+
+#
+# Make sure the connection pool of the shared session holds at least
+# n keep-alive connections, for n threads making requests at once, so
+# that no connection is discarded on return to a full pool and opened
+# again for the next request.  If the session is already in use with
+# a smaller pool, it is given a new one.
+#
+def reserve_connections(n):
+    global _pool_size
+    with _session_lock:
+        if n <= _pool_size:
+            return
+        _pool_size = n
+        if _session is not None:
+            _mount(_session)
+
+
+#
+# Return a dict of connection statistics for the shared session:
+#   requests    - requests made
+#   connections - new connections opened to make them
+#   reused      - requests made on an already-open connection
+#
+def connection_stats():
+    nreq  = 0
+    nconn = 0
+    if _session is not None:
+        for adapter in set(_session.adapters.values()):
+            for key in adapter.poolmanager.pools.keys():
+                pool   = adapter.poolmanager.pools[key]
+                nreq  += pool.num_requests
+                nconn += pool.num_connections
+    return {
+        "requests":    nreq,
+        "connections": nconn,
+        "reused":      max(nreq - nconn, 0),
+        }
+
+
+#
+# Parse a Retry-After header given in seconds, returning None if it
+# is absent or in some other form.
+#
+def _retry_after(r):
+    try:
+        return float(r.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+
+#
+# Fetch the response to a single request URL, and return it as a
+# bytes object.  Failed tries are retried under the retry policy,
+# DEFAULT_POLICY if none is given.  If all tries fail, DownloadError
+# is raised.  If a rate limiter is given, a token is taken from it
+# before each try.  If a circuit breaker is given, each try first
+# checks that it is closed, raising CircuitOpenError if not, and the
+# outcome of the try is reported to it.  Progress messages are
+# written to stderr.
+#
+def fetch(url, limiter=None, policy=None, breaker=None):
+    if policy is None:
+        policy = DEFAULT_POLICY
+    tries = 0
+    while True:
+        if breaker is not None:
+            breaker.check()
+        if limiter is not None:
+            limiter.acquire()
+        tries += 1
+        _count("attempts")
+        status      = None
+        throttled   = False
+        retry_after = None
+        retryable   = True
+        try:
+            r = session().get(url, timeout=(CONN_TIMEOUT, READ_TIMEOUT))
+            status = r.status_code
+            if status == requests.codes.ok:
+                if breaker is not None:
+                    breaker.success()
+                return r.content
+            msg = "Download failed with status code {0}".format(status)
+            if status in (429, 503):
+                throttled   = True
+                retry_after = _retry_after(r)
+                _count("throttled")
+                if status == 429 and limiter is not None:
+                    limiter.slow_down()
+            elif status < 500:
+                retryable = False
+        except requests.exceptions.ConnectTimeout:
+            msg = "Connection timed out."
+        except requests.exceptions.ReadTimeout:
+            msg = "Data download timed out."
+        except requests.exceptions.ConnectionError:
+            msg = "Connection failed."
+        except requests.exceptions.RequestException as err:
+            msg = "Download failed: {0}.".format(type(err).__name__)
+        if breaker is not None:
+            if status is None or status >= 500:
+                breaker.failure()
+            else:
+                breaker.success()
+        #
+        # Messages are written with a single print() so that those
+        # from concurrent downloads don't get interleaved.
+        #
+        if not retryable or tries >= policy.max_tries:
+            break
+        wait = policy.delay(tries, throttled, retry_after)
+        print(msg + "  Retrying in {0:.0f} s...".format(wait), file=sys.stderr)
+        _count("retries")
+        _count("wait", wait)
+        time.sleep(wait)
+    print(msg + "  Giving up.\nFailed URL was: \n" + url, file=sys.stderr)
+    raise DownloadError(url)
+
+
+#
+# Check whether a file is available on the server, with a HEAD
+# request, which transfers no data.  Returns False on any failure.
+#
+def available(url, limiter=None):
+    if limiter is not None:
+        limiter.acquire()
+    _count("attempts")
+    try:
+        r = session().head(url, timeout=(CONN_TIMEOUT, READ_TIMEOUT))
+    except requests.exceptions.RequestException:
+        return False
+    return r.status_code == requests.codes.ok
+
+
+#
+# Fetch a set of requests concurrently.  Here, reqs is an iterable of
+# (key, url) pairs.  Up to max_connections requests are in flight at
+# once, and all of them draw from the same rate limiter, and share
+# the same circuit breaker.  This is a generator, yielding (key,
+# content) pairs in the order the downloads complete.  For requests
+# that fail, or are deferred because the breaker tripped, content is
+# None.  Requests are taken from reqs as earlier ones complete and
+# their content is consumed, with no more than max_pending (by
+# default, twice max_connections) downloaded or in flight at once,
+# so that a slow consumer holds back the downloads, and the content
+# held in memory stays bounded.
+#
+def download(reqs, max_connections=MAX_CONNECTIONS, limiter=None,
+        policy=None, breaker=None, max_pending=None):
+    if limiter is None:
+        limiter = TokenBucket()
+    if breaker is None:
+        breaker = CircuitBreaker()
+    if max_pending is None:
+        max_pending = 2 * max_connections
+    reserve_connections(max_connections)
+    reqs = iter(reqs)
+    with ThreadPoolExecutor(max_workers=max_connections) as executor:
+        futures = {}
+
+        def submit(n):
+            for key, url in itertools.islice(reqs, n):
+                futures[executor.submit(
+                        fetch, url, limiter, policy, breaker)] = key
+
+        submit(max_pending)
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = futures.pop(future)
+                try:
+                    content = future.result()
+                except DownloadError:
+                    content = None
+                yield key, content
+                submit(1)
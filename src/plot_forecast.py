@@ -5,24 +5,35 @@
 #
 # Note that this script has to make use of, and interconvert
 # between, three different kinds of time objects, namely Python
-# datetime, matplotlib plot time, and skyfield timescale.
+# datetime, NumPy datetime64, and matplotlib plot time.  Sunrise and
+# sunset times are found with Skyfield, and cached, by sun_cache.py.
 #
 # Updated 6/17/2019 for new GFS output with 3-hour resolution
 # all the way out to 384 hours.
+#
+# With --store, the forecasts are read from the binary store of the
+# latest cycles kept by forecast_store.py, rather than from the text
+# tables in the data directory.
+#
+# Several numbers of hours may be given, with one plot, named
+# forecast_<hours>.png, made for each.  The forecasts are read, the
+# sunrise and sunset times computed, and the static parts of the
+# figure built, once for all of them.
 
 import argparse
+import collections
 import datetime
 import dateutil
+import sys
+from time import perf_counter
 import matplotlib
 matplotlib.use('Cairo')
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 from matplotlib.dates import DAILY, MO, TU, WE, TH, FR, SA, SU
 import numpy as np
-import skyfield.api as sf
-ts = sf.load.timescale()
-e  = sf.load('de421.bsp') # skyfield ephemeris data, cached locally
-from skyfield import almanac
+import forecast_store
+import sun_cache
 
 #
 # The list of files to be plotted.  These are symbolic links to
@@ -67,6 +78,12 @@ colors = (
         '0.6',
         '0.0')
 
+#
+# Line styles for the opacity at extra frequencies, cycled through
+# in the order of the columns in the forecast files.
+#
+band_styles = ('--', ':', '-.')
+
 #
 # Color and transparancy for the shading on the plots indicating
 # local night.
@@ -85,7 +102,14 @@ parser.add_argument("alt",     help="site altitude  [m]",         type=float)
 parser.add_argument("tz",      help="site time zone (IANA name)", type=str  )
 parser.add_argument("am_vers", help="am version string",          type=str  )
 parser.add_argument("datadir", help="data directory",             type=str  )
-parser.add_argument("hours",   help="hours forward  (0 to 384)",  type=int  )
+parser.add_argument("hours",   help="hours forward  (0 to 384), " +
+        "one plot for each", type=int, nargs="+")
+parser.add_argument("--bands",
+        help="also plot opacity at any extra frequencies in the tables",
+        action="store_true")
+parser.add_argument("--store",
+        help="read the forecasts from this store (see forecast_store.py)",
+        type=str)
 args=parser.parse_args()
 
 #
@@ -97,16 +121,9 @@ if (args.lon   < -180. or args.lon   > 180.):
     parser.error("invalid longitude")
 if (args.alt   < -100. or args.alt   > 1e5 ):
     parser.error("invalid altitude")
-if (args.hours <    0  or args.hours > 384 ):
+if (min(args.hours) < 0 or max(args.hours) > 384):
     parser.error("invalid number of hours")
 
-#
-# Here, 'site' is an object used by the Skyfield package to define
-# the topocentric location of the site.
-#
-site = sf.Topos(latitude_degrees=args.lat, longitude_degrees=args.lon,
-        elevation_m=args.alt)
-
 #
 # We need two time zones.  The data files use UTC, and the bottom
 # x-axis and x grid are UTC.  For convenience, weekdays in the
@@ -117,303 +134,426 @@ tz_UTC  = dateutil.tz.gettz("UTC")
 tz_site = dateutil.tz.gettz(args.tz) 
 
 #
-# Set up an array of 5 plots arranged vertically, sharing a
-# common x (time) axis, and take care of the axes setups that
-# don't depend on the data.
-#
-fig, axes_arr = plt.subplots(nrows=5,
-        gridspec_kw={'height_ratios':[2,1,1,1,1]}, sharex=True,
-        figsize=(6, 8))
-#
-# tau225 - 225 GHz optical depth
-#
-axes_arr[0].grid(
-        which="minor",
-        axis="y",
-        dashes=(1.0, 1.0),
-        color="0.9")
-axes_arr[0].set_yscale('log')
-axes_arr[0].annotate(
-        r'$\mathrm{\tau_{225}}$',
-        (0.0, 1.0),
-        xytext=(4.0, -4.0),
-        xycoords='axes fraction',
-        textcoords='offset points',
-        color='1.0',
-        backgroundcolor='0.3',
-        horizontalalignment='left',
-        verticalalignment='top')
-#
-# PWV - Precipitable water vapor [mm]
-#
-axes_arr[1].set_yticks([0.0, 1.0, 2.5, 4.0, 8.0, 16.0])
-axes_arr[1].annotate(
-        r'$\mathrm{PWV\ [mm]}$',
-        (0.0, 1.0),
-        xytext=(4.0, -4.0),
-        xycoords='axes fraction',
-        textcoords='offset points',
-        color='1.0',
-        backgroundcolor='0.3',
-        horizontalalignment='left',
-        verticalalignment='top')
-#
-# LWP - Cloud liquid water path [kg / m^2]
-#
-axes_arr[2].annotate(
-        r'$\mathrm{LWP\ [kg/m^2]}$',
-        (0.0, 1.0),
-        xytext=(4.0, -4.0),
-        xycoords='axes fraction',
-        textcoords='offset points',
-        color='1.0',
-        backgroundcolor='0.3',
-        horizontalalignment='left',
-        verticalalignment='top')
-#
-# LWP - Cloud ice water path [kg / m^2]
-#
-axes_arr[3].annotate(
-        r'$\mathrm{IWP\ [kg/m^2]}$',
-        (0.0, 1.0),
-        xytext=(4.0, -4.0),
-        xycoords='axes fraction',
-        textcoords='offset points',
-        color='1.0',
-        backgroundcolor='0.3',
-        horizontalalignment='left',
-        verticalalignment='top')
-#
-# O3 - ozone column density [Dobson units]
-#
-axes_arr[4].annotate(
-        r'$\mathrm{O_3\ [DU]}$',
-        (0.0, 1.0),
-        xytext=(4.0, -4.0),
-        xycoords='axes fraction',
-        textcoords='offset points',
-        color='1.0',
-        backgroundcolor='0.3',
-        horizontalalignment='left',
-        verticalalignment='top')
-#
-# Plot the forecast files, looping over the list of symbolic
-# links defined at the top of this script.
+# Read the forecast files, looping over the list of symbolic
+# links defined at the top of this script.  With --store, the
+# corresponding cycles are taken from the store instead, where the
+# cycle for e.g. 'latest-06' is the one 6 hours before the latest.
+# The forecasts are read once, and shared by the plots for all the
+# requested numbers of hours.
 #
+Forecast = collections.namedtuple("Forecast",
+        "fnum fname time_plottime tau225 pwv lwp iwp o3 band_tau")
+
+if (args.store is not None):
+    store = forecast_store.open_store(args.store)
+forecasts  = []
+time_start = None
 for fnum, fname in enumerate(filenames): 
+    if (args.store is None):
+        #
+        # The full path to the file includes the data directory path
+        # from the command line.  Each file is read in a single pass
+        # into a structured array, with the text date strings in the
+        # first column converted to datetime64 valid times, and the
+        # remaining columns named as in the one-line header.
+        #
+        table = forecast_store.read_table(args.datadir + '/' + fname)
+        names = table.dtype.names[1:]
+        time  = table["time"]
+        tau225, Tb, pwv, lwp, iwp, o3 = (table[name] for name in names[:6])
+        #
+        # With --bands, the opacity columns for any extra frequencies,
+        # e.g. tau345, are found from the column names in the header.
+        #
+        band_tau = []
+        if args.bands:
+            for name in names[6:]:
+                if name.startswith('tau'):
+                    band_tau.append((name[3:], table[name]))
+    else:
+        #
+        # The record for the cycle in the store holds the valid
+        # times as datetime64 values, and each of the numeric
+        # columns, with NaT and nan for hours not in the table.
+        #
+        rec = forecast_store.recent(store, int(fname[7:] or 0))
+        if rec is None:
+            continue
+        valid = ~np.isnat(rec["time"])
+        time  = rec["time"][valid]
+        tau225, Tb, pwv, lwp, iwp, o3 = (rec[name][valid]
+                for name in forecast_store.columns(store)[:6])
+        band_tau = []
+        if args.bands:
+            for name in forecast_store.columns(store)[6:]:
+                if name.startswith('tau'):
+                    band_tau.append((name[3:], rec[name][valid]))
     #
-    # The full path to the file includes the data directory path
-    # from the command line.
-    #
-    fpath = args.datadir + '/' + fname
-    #
-    # The forecast files contain a one-line header, which must
-    # be skipped.  The first data column in each file is a text
-    # date string:
-    #
-    time_str = np.loadtxt(
-            fpath,
-            dtype=str,
-            usecols=(0,),
-            skiprows=1,
-            unpack=True)
-    #
-    # .. and the remaining columns are all straight numeric data.
-    #
-    tau225, Tb, pwv, lwp, iwp, o3 = np.loadtxt(
-            fpath,
-            usecols=(1, 2, 3, 4, 5, 6),
-            skiprows=1,
-            unpack=True)
-    #
-    # The date strings need to be converted to Python datetimes
-    # as well as matplotlib plottimes for different purposes below
+    # The x axis starts at the first valid time of the first data
+    # file.
     #
-    time_datetime = []
-    time_plottime = []
-    for s in time_str.tolist():
-        dtime = datetime.datetime.strptime(s,
-                "%Y%m%d_%H:%M:%S").replace(tzinfo=tz_UTC)
-        time_datetime.append(dtime)
-        time_plottime.append(mdates.date2num(dtime))
-    time_plottime = np.asarray(time_plottime)
+    if (time_start is None):
+        time_start = time[0]
     #
-    # Computation of the x axis range and day/night shading
-    # are done once when the first data file is processed.
+    # The valid times are converted to matplotlib plot times all at
+    # once.
     #
-    if (fnum == 0):
+    forecasts.append(Forecast(fnum, fname, mdates.date2num(time),
+            tau225, pwv, lwp, iwp, o3, band_tau))
+
+#
+# Get sunrise, sunset times across the x axis of the longest plot,
+# once for all the plots, from the site's cache if there is one
+# (see sun_cache.py), and otherwise with Skyfield.  Here, tsun is a
+# sequence of rise/set times.  The corresponding values of rise are
+# True for rising, False for setting.
+#
+tmin = time_start
+tmax = time_start + np.timedelta64(48 + max(args.hours), 'h')
+sun  = sun_cache.default_cache(args.lat, args.lon, args.alt)
+if (sun is None):
+    tsun, rise = sun_cache.find_events(args.lat, args.lon, args.alt,
+            tmin, tmax)
+else:
+    tsun, rise = sun.events(tmin, tmax)
+tsun_plottime_all = mdates.date2num(tsun)
+
+
+#
+# The parts of the figure that don't depend on the forecasts or on
+# the number of hours plotted, namely the array of panels, their
+# scales, grids, and annotations, the twin axes for the local
+# weekdays, and the footnote, are built once, in a FigureTemplate.
+# Each plot is then made by swapping in the night shading, the data
+# lines, the tick locators for the number of hours, and the header
+# time, rendering, and removing them again, which costs a fraction
+# of building the whole figure anew.
+#
+class FigureTemplate:
+
+    def __init__(self):
+        #
+        # Set up an array of 5 plots arranged vertically, sharing a
+        # common x (time) axis, and take care of the axes setups that
+        # don't depend on the data.
+        #
+        fig, axes_arr = plt.subplots(nrows=5,
+                gridspec_kw={'height_ratios':[2,1,1,1,1]}, sharex=True,
+                figsize=(6, 8))
+        #
+        # tau225 - 225 GHz optical depth
+        #
+        axes_arr[0].grid(
+                which="minor",
+                axis="y",
+                dashes=(1.0, 1.0),
+                color="0.9")
+        axes_arr[0].set_yscale('log')
+        axes_arr[0].annotate(
+                r'$\mathrm{\tau_{225}}$',
+                (0.0, 1.0),
+                xytext=(4.0, -4.0),
+                xycoords='axes fraction',
+                textcoords='offset points',
+                color='1.0',
+                backgroundcolor='0.3',
+                horizontalalignment='left',
+                verticalalignment='top')
+        #
+        # PWV - Precipitable water vapor [mm]
+        #
+        axes_arr[1].set_yticks([0.0, 1.0, 2.5, 4.0, 8.0, 16.0])
+        axes_arr[1].annotate(
+                r'$\mathrm{PWV\ [mm]}$',
+                (0.0, 1.0),
+                xytext=(4.0, -4.0),
+                xycoords='axes fraction',
+                textcoords='offset points',
+                color='1.0',
+                backgroundcolor='0.3',
+                horizontalalignment='left',
+                verticalalignment='top')
+        #
+        # LWP - Cloud liquid water path [kg / m^2]
+        #
+        axes_arr[2].annotate(
+                r'$\mathrm{LWP\ [kg/m^2]}$',
+                (0.0, 1.0),
+                xytext=(4.0, -4.0),
+                xycoords='axes fraction',
+                textcoords='offset points',
+                color='1.0',
+                backgroundcolor='0.3',
+                horizontalalignment='left',
+                verticalalignment='top')
+        #
+        # LWP - Cloud ice water path [kg / m^2]
+        #
+        axes_arr[3].annotate(
+                r'$\mathrm{IWP\ [kg/m^2]}$',
+                (0.0, 1.0),
+                xytext=(4.0, -4.0),
+                xycoords='axes fraction',
+                textcoords='offset points',
+                color='1.0',
+                backgroundcolor='0.3',
+                horizontalalignment='left',
+                verticalalignment='top')
+        #
+        # O3 - ozone column density [Dobson units]
+        #
+        axes_arr[4].annotate(
+                r'$\mathrm{O_3\ [DU]}$',
+                (0.0, 1.0),
+                xytext=(4.0, -4.0),
+                xycoords='axes fraction',
+                textcoords='offset points',
+                color='1.0',
+                backgroundcolor='0.3',
+                horizontalalignment='left',
+                verticalalignment='top')
         for axes in axes_arr:
             axes.grid(
                     which="major",
                     dashes=(1.0, 1.0),
                     color="0.8")
-        xmin = time_plottime[0]
-        xmax = time_plottime[0] + 2. + args.hours / 24.
-        #
-        # Compute sunrise, sunset times across x axis with
-        # Skyfield.  Here, tsun is a sequence of rise/set times.
-        # The corresponding values of rise are True for rising,
-        # False for setting.
-        #
-        tmin = ts.utc(time_datetime[0])
-        tmax = ts.utc(time_datetime[0] +
-                datetime.timedelta(hours=(48. + args.hours)))
-        tsun, rise = almanac.find_discrete(tmin, tmax,
-                almanac.sunrise_sunset(e, site))
-        tsun_datetime = tsun.utc_datetime()
-        tsun_plottime = mdates.date2num(tsun_datetime)
+
+        #
+        # UTC tics along shared bottom x-axis.  The minor locator
+        # depends on the number of hours, and is set for each plot.
+        #
+        major_locator = mdates.DayLocator(interval=1, tz=tz_UTC)
+        axes_arr[-1].xaxis.set_major_locator(major_locator)
+        axes_arr[-1].xaxis.set_major_formatter(
+                mdates.ConciseDateFormatter(major_locator, tz=tz_UTC))
+        axes_arr[-1].xaxis.set_tick_params(which='major', labelsize=10)
+        axes_arr[-1].annotate(
+                "UTC",
+                xy=(0,-26),
+                xycoords='axes points',
+                fontsize=10)
+        #
+        # Create a twin of the top axes to carry weekday labels in
+        # local observatory time.  Major ticks are placed at the day
+        # boundaries.  Labels for selected days are placed on
+        # invisible minor ticks located at 12:00 noon local time; the
+        # days labeled depend on the number of hours, and are set for
+        # each plot.
+        #
+        axes_top = axes_arr[0].twiny()
+        axes_top.annotate(args.tz, xy=(5,12), xycoords='axes points',
+                fontsize=8)
+        axes_top.xaxis.set_tick_params(which='both', direction='in',
+                top=False, bottom=True, labeltop=False, labelbottom=True)
+
+        axes_top.xaxis.set_major_locator(mdates.DayLocator(tz=tz_site))
+        axes_top.xaxis.set_major_formatter(matplotlib.ticker.NullFormatter())
+        axes_top.xaxis.set_tick_params(which='major', length=8)
+        axes_top.xaxis.set_minor_formatter(
+                mdates.DateFormatter("%a", tz=tz_site))
+        axes_top.xaxis.set_tick_params(which='minor', length=0,
+                labelsize=8, pad=-8)
+
+        #
+        # Tweaks to adjust plot and label positions
+        #
+        fig.align_ylabels()
+        fig.subplots_adjust(top=0.96, bottom=0.17, left=0.12, right=0.97)
+
+        #
+        # The header with the update time right at the top is set for
+        # each plot.  This will make a stale forecast more easily
+        # noticed.
+        #
+        self.header = fig.text(0.05, 0.98, "", fontsize=9)
+
+        footnote = (
+                "Forecast is for " +
+                "{0} at {1} deg. {2}, {3} deg. {4}, {5} m altitude.  ".format(
+                        args.site,
+                        abs(args.lat), "S" if args.lat < 0 else "N",
+                        abs(args.lon), "W" if args.lon < 0 else "E",
+                        args.alt) +
+                "The current forecast is plotted in black and the prior " +
+                "48 hours' forecasts in grey.  Shading indicates local " +
+                "night, and weekdays in the top panel are indicated in " +
+                "local ({0}) time.\n".format(args.tz) +
+                "\n" +
+                "All quantities are referred to zenith.  Definitions are: " +
+                r"$\mathrm{\tau_{225}}$" +
+                " - 225 GHz optical depth; PWV - precipitable water vapor; " +
+                "LWP - cloud liquid water path; IWP - cloud ice water " +
+                "path; " +
+                r"$\mathrm{O_3\ [DU]}$" +
+                " - ozone column density in Dobson Units.\n" +
+                "\n" +
+                "Atmospheric state data are from the NOAA/NCEP Global " +
+                "Forecast System (GFS), with data access provided by the " +
+                "NOAA Operational Model Archive and Distribution System " +
+                "(https://nomads.ncep.noaa.gov).  Optical depth is from " +
+                "am v.{0} ".format(args.am_vers) +
+                "(https://doi.org/10.5281/zenodo.640645).\n"
+                )
+        fig.text(0.07, 0.0, footnote, fontsize=5.5, wrap=True)
+
+        self.fig      = fig
+        self.axes_arr = axes_arr
+        self.axes_top = axes_top
+
+    #
+    # Make the plot for the given number of hours forward, and write
+    # it to the named file.  The artists added for the plot are
+    # removed afterwards, leaving the template as it was.
+    #
+    def render(self, hours, filename):
+        axes_arr = self.axes_arr
+        artists  = []
+        #
+        # Computation of the x axis range and day/night shading.  The
+        # rise/set times are those within this plot's x axis range.
+        #
+        xmin = forecasts[0].time_plottime[0]
+        xmax = forecasts[0].time_plottime[0] + 2. + hours / 24.
+        tsun_plottime = tsun_plottime_all[tsun_plottime_all <= xmax]
+        rise_plot     = rise[tsun_plottime_all <= xmax]
         #
         # Set x limits and plot vspan rectangles from sunset to
         # sunrise.
         #
         for axes in axes_arr:
             axes.set_xlim(xmin, xmax)
-            if (rise[0] == True):
-                axes.axvspan(xmin, tsun_plottime[0],
-                        facecolor=nightcolor, alpha=nightalpha)
+            if (rise_plot[0] == True):
+                artists.append(axes.axvspan(xmin, tsun_plottime[0],
+                        facecolor=nightcolor, alpha=nightalpha))
                 i = 1
             else:
                 i = 0
-            while(i < len(rise) - 1):
-                axes.axvspan(tsun_plottime[i], tsun_plottime[i + 1],
-                        facecolor=nightcolor, alpha=nightalpha)
+            while(i < len(rise_plot) - 1):
+                artists.append(axes.axvspan(tsun_plottime[i],
+                        tsun_plottime[i + 1],
+                        facecolor=nightcolor, alpha=nightalpha))
                 i += 2
-            if (rise[-1] == False):
-                axes.axvspan(tsun_plottime[-1], xmax,
-                        facecolor=nightcolor, alpha=nightalpha)
+            if (rise_plot[-1] == False):
+                artists.append(axes.axvspan(tsun_plottime[-1], xmax,
+                        facecolor=nightcolor, alpha=nightalpha))
 
-    #
-    # Plot all the data columns from the current file, setting
-    # a mask to restrict to the x-axis range.
-    #
-    mask = time_plottime <= xmax
-    axes_arr[0].plot(
-            time_plottime[mask],
-            tau225[mask],
-            color=colors[fnum],
-            linewidth=widths[fnum])
-    axes_arr[1].plot(
-            time_plottime[mask],
-            pwv[mask],
-            color=colors[fnum],
-            linewidth=widths[fnum])
-    axes_arr[2].plot(
-            time_plottime[mask],
-            lwp[mask],
-            color=colors[fnum],
-            linewidth=widths[fnum])
-    axes_arr[3].plot(
-            time_plottime[mask],
-            iwp[mask],
-            color=colors[fnum],
-            linewidth=widths[fnum])
-    axes_arr[4].plot(
-            time_plottime[mask],
-            o3[mask],
-            color=colors[fnum],
-            linewidth=widths[fnum])
+        for fnum, fname, time_plottime, tau225, pwv, lwp, iwp, o3, band_tau \
+                in forecasts:
+            #
+            # Plot all the data columns from the current file, setting
+            # a mask to restrict to the x-axis range.
+            #
+            mask = time_plottime <= xmax
+            artists += axes_arr[0].plot(
+                    time_plottime[mask],
+                    tau225[mask],
+                    color=colors[fnum],
+                    linewidth=widths[fnum])
+            for k, (band, tau) in enumerate(band_tau):
+                artists += axes_arr[0].plot(
+                        time_plottime[mask],
+                        tau[mask],
+                        color=colors[fnum],
+                        linewidth=widths[fnum],
+                        linestyle=band_styles[k % len(band_styles)],
+                        label=(band + ' GHz' if fname == 'latest' else None))
+            artists += axes_arr[1].plot(
+                    time_plottime[mask],
+                    pwv[mask],
+                    color=colors[fnum],
+                    linewidth=widths[fnum])
+            artists += axes_arr[2].plot(
+                    time_plottime[mask],
+                    lwp[mask],
+                    color=colors[fnum],
+                    linewidth=widths[fnum])
+            artists += axes_arr[3].plot(
+                    time_plottime[mask],
+                    iwp[mask],
+                    color=colors[fnum],
+                    linewidth=widths[fnum])
+            artists += axes_arr[4].plot(
+                    time_plottime[mask],
+                    o3[mask],
+                    color=colors[fnum],
+                    linewidth=widths[fnum])
 
-#
-# UTC tics along shared bottom x-axis
-#
-major_locator = mdates.DayLocator(interval=1, tz=tz_UTC)
-if (args.hours <= 120):
-    minor_locator = mdates.HourLocator(byhour=(0, 6, 12, 18), tz=tz_UTC)
-elif (args.hours <= 240):
-    minor_locator = mdates.HourLocator(byhour=(0, 12), tz=tz_UTC)
-else:
-    minor_locator = mdates.HourLocator(byhour=(0), tz=tz_UTC)
-axes_arr[-1].xaxis.set_major_locator(major_locator)
-axes_arr[-1].xaxis.set_minor_locator(minor_locator)
-axes_arr[-1].xaxis.set_major_formatter(
-        mdates.ConciseDateFormatter(major_locator, tz=tz_UTC))
-axes_arr[-1].xaxis.set_tick_params(which='major', labelsize=10)
-axes_arr[-1].annotate(
-        "UTC",
-        xy=(0,-26),
-        xycoords='axes points',
-        fontsize=10)
-#
-# Create a twin of the top axes to carry weekday labels in
-# local observatory time.  Major ticks are placed at the day
-# boundaries.  Labels for selected days are placed on invisible
-# minor ticks located at 12:00 noon local time.
-#
-axes_top = axes_arr[0].twiny()
-axes_top.set_xlim(xmin, xmax)
-axes_top.annotate(args.tz, xy=(5,12), xycoords='axes points', fontsize=8)
-axes_top.xaxis.set_tick_params(which='both', direction='in',
-        top=False, bottom=True, labeltop=False, labelbottom=True)
+        #
+        # The y axes are autoscaled to the data of this plot alone,
+        # not to those of the plots made before it from the template.
+        #
+        for axes in axes_arr:
+            axes.relim()
+            axes.set_autoscaley_on(True)
+            axes.autoscale_view(scalex=False)
 
-axes_top.xaxis.set_major_locator(mdates.DayLocator(tz=tz_site))
-axes_top.xaxis.set_major_formatter(matplotlib.ticker.NullFormatter()) 
-axes_top.xaxis.set_tick_params(which='major', length=8)
+        #
+        # UTC minor tics along shared bottom x-axis
+        #
+        if (hours <= 120):
+            minor_locator = mdates.HourLocator(byhour=(0, 6, 12, 18),
+                    tz=tz_UTC)
+        elif (hours <= 240):
+            minor_locator = mdates.HourLocator(byhour=(0, 12), tz=tz_UTC)
+        else:
+            minor_locator = mdates.HourLocator(byhour=(0), tz=tz_UTC)
+        axes_arr[-1].xaxis.set_minor_locator(minor_locator)
+        #
+        # Weekday labels in local time across the top.
+        #
+        self.axes_top.set_xlim(xmin, xmax)
+        if (hours <= 120):
+            labeled_days=(MO, TU, WE, TH, FR, SA, SU)
+        else:
+            labeled_days=(SA, SU)
+        rule = mdates.rrulewrapper(DAILY, byweekday=labeled_days, byhour=12)
+        loc  = mdates.RRuleLocator(rule, tz=tz_site)
+        self.axes_top.xaxis.set_minor_locator(loc)
 
-if (args.hours <= 120):
-    labeled_days=(MO, TU, WE, TH, FR, SA, SU)
-else:
-    labeled_days=(SA, SU)
-rule = mdates.rrulewrapper(DAILY, byweekday=labeled_days, byhour=12)
-loc  = mdates.RRuleLocator(rule, tz=tz_site)
-axes_top.xaxis.set_minor_locator(loc)
-axes_top.xaxis.set_minor_formatter(mdates.DateFormatter("%a", tz=tz_site)) 
-axes_top.xaxis.set_tick_params(which='minor', length=0, labelsize=8, pad=-8)
+        #
+        # Identify the line styles of the extra frequencies, if plotted.
+        #
+        if forecasts[-1].band_tau:
+            artists.append(axes_arr[0].legend(loc='upper right',
+                    fontsize=6, framealpha=0.8))
 
-#
-# Tweak to tau225 y-axis to ensure we always get at least one
-# full log decade
-#
-tau_max = axes_arr[0].get_ylim()[1]
-if (tau_max < 0.1):
-    tau_max = 0.1
-axes_arr[0].set_ylim(bottom=0.01, top=tau_max)
-#
-# Tweak to PWV y axis to always start from pwv = 0, with a
-# small offset.
-pwv_max = axes_arr[1].get_ylim()[1]
-axes_arr[1].set_ylim(bottom=-0.05 * pwv_max, top=None)
-#
-# Tweaks to adjust plot and label positions
-#
-fig.align_ylabels()
-plt.subplots_adjust(top=0.96, bottom=0.17, left=0.12, right=0.97)
+        #
+        # Tweak to tau225 y-axis to ensure we always get at least one
+        # full log decade
+        #
+        tau_max = axes_arr[0].get_ylim()[1]
+        if (tau_max < 0.1):
+            tau_max = 0.1
+        axes_arr[0].set_ylim(bottom=0.01, top=tau_max)
+        #
+        # Tweak to PWV y axis to always start from pwv = 0, with a
+        # small offset.
+        pwv_max = axes_arr[1].get_ylim()[1]
+        axes_arr[1].set_ylim(bottom=-0.05 * pwv_max, top=None)
 
-#
-# Write a header with the update time right at the top.  This will
-# make a stale forecast more easily noticed.
-#
-update_time = datetime.datetime.now(tz=tz_site)
-update_str  = update_time.strftime("%A, %B %d, %Y at %I:%M %p")
-header   = "Updated {0} {1}".format(update_str, args.tz)
-plt.figtext(0.05, 0.98, header, fontsize=9)
+        update_time = datetime.datetime.now(tz=tz_site)
+        update_str  = update_time.strftime("%A, %B %d, %Y at %I:%M %p")
+        self.header.set_text("Updated {0} {1}".format(update_str, args.tz))
+
+        self.fig.savefig(filename, dpi=150)
+        for artist in artists:
+            artist.remove()
 
-footnote = (
-        "Forecast is for " +
-        "{0} at {1} deg. {2}, {3} deg. {4}, {5} m altitude.  ".format(
-                args.site,
-                abs(args.lat), "S" if args.lat < 0 else "N",
-                abs(args.lon), "W" if args.lon < 0 else "E",
-                args.alt) +
-        "The current forecast is plotted in black and the prior 48 " +
-        "hours' forecasts in grey.  Shading indicates local night, " +
-        "and weekdays in the top panel are indicated in local " +
-        "({0}) time.\n".format(args.tz) +
-        "\n" +
-        "All quantities are referred to zenith.  Definitions are: " +
-        r"$\mathrm{\tau_{225}}$" +
-        " - 225 GHz optical depth; PWV - precipitable water vapor; " +
-        "LWP - cloud liquid water path; IWP - cloud ice water path; " +
-        r"$\mathrm{O_3\ [DU]}$" +
-        " - ozone column density in Dobson Units.\n" +
-        "\n" +
-        "Atmospheric state data are from the NOAA/NCEP Global " +
-        "Forecast System (GFS), with data access provided by the " +
-        "NOAA Operational Model Archive and Distribution System " +
-        "(https://nomads.ncep.noaa.gov).  Optical depth is from " +
-        "am v.{0} ".format(args.am_vers) + 
-        "(https://doi.org/10.5281/zenodo.640645).\n"
-        )
 
-plt.figtext(0.07, 0.0, footnote, fontsize=5.5, wrap=True)
-fig.savefig('forecast_{0}.png'.format(args.hours), dpi=150)
-plt.close(fig)
+#
+# Build the template, and make the plot for each number of hours
+# forward, writing it to forecast_<hours>.png.  The time taken to
+# build the template, and to render each plot, is reported on
+# stderr.
+#
+t0 = perf_counter()
+template = FigureTemplate()
+print("Built figure template in {0:.0f} ms.".format(
+        1e3 * (perf_counter() - t0)), file=sys.stderr)
+for hours in args.hours:
+    t0 = perf_counter()
+    filename = 'forecast_{0}.png'.format(hours)
+    template.render(hours, filename)
+    print("Rendered {0} in {1:.0f} ms.".format(filename,
+            1e3 * (perf_counter() - t0)), file=sys.stderr)
+plt.close(template.fig)
@@ -0,0 +1,146 @@
+#
+# profile_archive.py - archive of the GFS profiles interpolated to
+# the site, from which forecast tables can be recomputed without
+# downloading anything, e.g. after a change of am version or of the
+# layer physics in gfs16_to_am10.py.  NOMADS only keeps about ten
+# days of GFS data, so this is the only way to reprocess older
+# cycles.  This module is not run directly; it is imported by the
+# scripts which compute forecast tables.
+#
+# The profiles for each forecast hour are those returned by
+# gfs16_to_am10.extract_profiles(), an array of shape (variable,
+# level).  For each cycle, they are kept in a NumPy .npz file named
+# for the cycle, e.g. 2024/20240101_06.npz, in columnar form: an
+# array of the forecast hours, and for each of the variables in
+# gfs16_to_am10.PROFILE_VARS, an array of shape (hour, level), along
+# with the pressure levels and the site latitude and longitude.
+#
+# As each hour is computed, its profiles are first written to a
+# staging file of its own, e.g. 2024/20240101_06.d/f006.npz, which
+# also records the site latitude and longitude.  The staging files
+# are merged into the .npz file by consolidate(),
+# under a lock, so that the archive can be added to concurrently,
+# e.g. by forecast_daemon.py and the forecast job.  Profiles for a
+# different site are never merged: the site of every staging file is
+# checked against that of the archive file.
+#
+# The archive is configured in the environment:
+#
+#   PROFILE_ARCHIVE_DIR - archive directory.  If unset or empty,
+#                         profiles are not archived.
+#
+
+import fcntl
+import glob
+import os
+
+import numpy as np
+
+import gfs16_to_am10
+from gfs_products import product_hour, product_name
+
+ARCHIVE_DIR = os.getenv('PROFILE_ARCHIVE_DIR', '')
+
+
+class ProfileArchive:
+
+    def __init__(self, path=ARCHIVE_DIR):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    #
+    # Path of the archive file for a cycle, without the extension.
+    #
+    def _base(self, gfsdate, gfscycle):
+        return os.path.join(self.path, gfsdate[0:4],
+                "{0}_{1:02d}".format(gfsdate, gfscycle))
+
+    #
+    # Write the profiles for one product, computed for the site at
+    # lat, lon, to its staging file.  The file is written under a
+    # temporary name and renamed into place, so that a partial file
+    # is never consolidated.
+    #
+    def put(self, gfsdate, gfscycle, prod, profiles, lat, lon):
+        stagedir = self._base(gfsdate, gfscycle) + ".d"
+        os.makedirs(stagedir, exist_ok=True)
+        tmppath = os.path.join(stagedir, prod + ".tmp.npz")
+        np.savez(tmppath, profiles=profiles, lat=lat, lon=lon)
+        os.replace(tmppath, os.path.join(stagedir, prod + ".npz"))
+
+    #
+    # Return the profiles archived for a cycle, as a dict of arrays
+    # keyed by product, including any not yet consolidated.  lat and
+    # lon, if given, are checked against those the profiles were
+    # archived or staged with, raising ValueError if they differ.
+    #
+    def get(self, gfsdate, gfscycle, lat=None, lon=None):
+        base = self._base(gfsdate, gfscycle)
+        profiles = {}
+        if os.path.exists(base + ".npz"):
+            with np.load(base + ".npz") as f:
+                _check_site(f, lat, lon)
+                columns = np.stack([f[var]
+                        for var in gfs16_to_am10.PROFILE_VARS], axis=1)
+                for hour, p in zip(f["hours"], columns):
+                    profiles[product_name(int(hour))] = p
+        for fpath in glob.glob(os.path.join(base + ".d", "f???.npz")):
+            prod = os.path.basename(fpath)[:-4]
+            with np.load(fpath) as f:
+                _check_site(f, lat, lon)
+                profiles[prod] = f["profiles"]
+        return profiles
+
+    #
+    # Merge the staging files for a cycle into its archive file, and
+    # remove them.  lat and lon are recorded in the archive file;
+    # ValueError is raised, and nothing is merged, if the archive
+    # file or any staging file is for a different site.
+    #
+    def consolidate(self, gfsdate, gfscycle, lat, lon):
+        base = self._base(gfsdate, gfscycle)
+        staged = glob.glob(os.path.join(base + ".d", "f???.npz"))
+        if not staged:
+            return
+        with open(base + ".lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            staged = glob.glob(os.path.join(base + ".d", "f???.npz"))
+            profiles = self.get(gfsdate, gfscycle, lat, lon)
+            prods = sorted(profiles, key=product_hour)
+            stacked = np.stack([profiles[prod] for prod in prods])
+            columns = {var: stacked[:, i, :]
+                    for i, var in enumerate(gfs16_to_am10.PROFILE_VARS)}
+            tmppath = base + ".tmp.npz"
+            np.savez_compressed(tmppath,
+                    hours=np.array([product_hour(p) for p in prods]),
+                    levels=np.array(gfs16_to_am10.LEVELS),
+                    lat=lat, lon=lon, **columns)
+            os.replace(tmppath, base + ".npz")
+            for fpath in staged:
+                os.remove(fpath)
+        try:
+            os.rmdir(base + ".d")
+        except OSError:
+            pass    # more staged since, or removed by another process
+
+
+#
+# Raise ValueError if the site recorded in an archive or staging file
+# f differs from lat, lon.  Nothing is checked if these are None.
+#
+def _check_site(f, lat, lon):
+    if lat is None or lon is None:
+        return
+    if f["lat"] != lat or f["lon"] != lon:
+        raise ValueError("archived profiles are for " +
+                "{0}, {1}".format(f["lat"], f["lon"]))
+
+
+#
+# Return an archive using the directory set in the environment, or
+# None if archiving is not configured.
+#
+def default_archive():
+    if not ARCHIVE_DIR:
+        return None
+    return ProfileArchive()
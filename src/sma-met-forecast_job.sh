@@ -34,7 +34,36 @@ TZ="HST"
 export AM=/instance/sma-met-forecast/bin/am
 export AM_VERSION=$($AM -v | awk '/am version/ {print $3}')
 export OMP_NUM_THREADS=2
-export AM_CACHE_PATH=
+
+#
+# Frequencies [GHz], besides 225 GHz, at which to compute opacity
+# and brightness temperature, separated by spaces, e.g. "345 690".
+# These are computed in the same am run as 225 GHz, added as extra
+# columns in the forecast tables, and plotted with the 225 GHz
+# opacity.  Leave empty for 225 GHz only.
+#
+export AM_BANDS=
+
+#
+# The forecast hours of a cycle are run through am concurrently, in
+# up to AM_WORKERS am processes at once, each using OMP_NUM_THREADS
+# threads.  If AM_WORKERS is empty, enough am processes are run to
+# occupy all the cores of the machine.
+#
+export AM_WORKERS=
+
+#
+# Limits on GFS downloads from the NOMADS server.  Up to
+# NOMADS_MAX_CONNECTIONS requests are kept in flight at once, at a
+# sustained rate of no more than NOMADS_REQUEST_RATE requests per
+# second.  (NOAA blocks clients exceeding 120 requests per minute.)
+# Requests are made over a pool of at least NOMADS_POOL_SIZE
+# keep-alive connections, enlarged as needed to one per concurrent
+# download.
+#
+export NOMADS_MAX_CONNECTIONS=4
+export NOMADS_REQUEST_RATE=1.0
+export NOMADS_POOL_SIZE=4
 
 #
 # Directory where these scripts are located
@@ -49,11 +78,82 @@ export APPDIR=/instance/sma-met-forecast/src
 #RUNDIR=/application/src/sma-met-forecast/run
 RUNDIR=/instance/sma-met-forecast/run
 
+#
+# GRIB data downloaded from NOMADS are cached in GRIB_CACHE_DIR, up
+# to a size of GRIB_CACHE_MAX_MB, so that rebuilding a forecast
+# table after an outage only downloads what is missing.  Setting
+# GRIB_CACHE_DIR empty disables the cache.
+#
+export GRIB_CACHE_DIR=$RUNDIR/grib_cache
+export GRIB_CACHE_MAX_MB=200
+
+#
+# Likewise, summarized am results are cached in AM_RESULT_CACHE_DIR,
+# keyed by the am configuration and AM_VERSION, up to a size of
+# AM_RESULT_CACHE_MAX_MB, so that am is not rerun on forecast hours
+# it has already computed.  Setting AM_RESULT_CACHE_DIR empty
+# disables the cache.
+#
+export AM_RESULT_CACHE_DIR=$RUNDIR/am_cache
+export AM_RESULT_CACHE_MAX_MB=10
+
+#
+# am caches the absorption coefficients it computes for each layer in
+# AM_CACHE_PATH, and reuses them for layers at the same pressure and
+# temperature in later runs.  The cache is warmed up from a
+# representative set of forecast hours when the directory is first
+# made, and pruned to AM_CACHE_MAX_MB after each run of this script
+# (see am_coef_cache.py).  Setting AM_CACHE_PATH empty disables the
+# cache.
+#
+export AM_CACHE_PATH=$RUNDIR/am_coef_cache
+export AM_CACHE_MAX_MB=1000
+
+#
+# Sunrise and sunset times at the site, for the night shading on the
+# plots, are cached in SUN_CACHE_DIR, so that plot_forecast.py only
+# needs Skyfield every few months (see sun_cache.py).  Setting
+# SUN_CACHE_DIR empty disables the cache.
+#
+export SUN_CACHE_DIR=$RUNDIR/sun_cache
+
+#
+# The GFS profiles interpolated to the site for every forecast hour
+# are archived permanently in PROFILE_ARCHIVE_DIR, so that forecast
+# tables can be recomputed later, e.g. for a new am version, without
+# downloading the GFS data again (see profile_archive.py).  Setting
+# PROFILE_ARCHIVE_DIR empty disables the archive.
+#
+export PROFILE_ARCHIVE_DIR=$RUNDIR/profiles
+
+#
+# A surrogate model for am (see surrogate.py), refitted to recent am
+# results on each run, is kept in SURROGATE_MODEL.  When a forecast
+# table is (re-)made, a provisional table computed with the
+# surrogate is published first, then replaced by the table computed
+# with am.
+#
+export SURROGATE_MODEL=$RUNDIR/surrogate.json
+
 #
 # Destination directory for the site forecast data tables.
 #
 SITE_FCAST_DIR=/data/met/sma-met-forecast
 
+#
+# The tables of the latest nine cycles, linked as latest, latest-06,
+# ..., latest-48 in SITE_FCAST_DIR, are also kept in a binary store
+# (see forecast_store.py), from which the plots are made.
+#
+FCAST_STORE=$SITE_FCAST_DIR/latest.npy
+
+#
+# Each forecast table is added to the verification index (see
+# verify.py) when it is made, so that forecast errors by lead time
+# can be reported at any time without rescanning the archive.
+#
+VERIFY_INDEX=$RUNDIR/verify.dat
+
 #
 # Destination directory for the site forecast plots.
 #
@@ -107,61 +207,144 @@ GFS_LATEST=$(latest_gfs_cycle_time.py)
 # forecasts are saved in SITE_FCAST_DIR in subdirectories by
 # year.
 #
-# If any of the prior 48 hours' forecasts are missing or short of
-# full size, they will also be rebuilt.  This is needed the first
+# If any of the prior 48 hours' forecasts are missing or
+# incomplete, they will also be rebuilt.  This is needed the first
 # time this script runs and later to clean up after outages.
+# Completed forecast hours are recorded in a per-cycle state
+# directory under CYCLES_DIR (see forecast_manifest.py), so only the
+# hours that are missing get computed.  Cycle state directories
+# older than CYCLES_KEEP_DAYS are removed.
+#
+# The missing hours of all the cycles are computed by
+# forecast_pipeline.py, which downloads the GFS data for some cycles
+# while running am on others, with PIPELINE_CONCURRENT cycles in
+# progress at once.  It reports any stage that makes no progress
+# for PIPELINE_STALL_TIMEOUT seconds to errors.log, and gives up,
+# leaving the hours still missing to the next job, if the stall
+# lasts PIPELINE_STALL_LIMIT seconds.  With a surrogate model for
+# am, it also writes provisional tables, for use while the missing
+# hours are computed by am.
+#
+# Each cycle is worked on under a lock, held on the file named for
+# its state directory with the suffix .lock, which is also taken by
+# forecast_daemon.py and backfill.py.  If a job stalls on one cycle,
+# the next job skips that cycle while the lock is held, and carries
+# on with the others, rather than waiting for it or interfering with
+# it.
+#
+CYCLES_DIR=$RUNDIR/cycles
+CYCLES_KEEP_DAYS=4
+PIPELINE_CONCURRENT=3
+PIPELINE_STALL_TIMEOUT=900
+PIPELINE_STALL_LIMIT=3600
+
+#
+# Everything published is first written to a temporary file in the
+# same directory as its destination, and then renamed into place, so
+# that readers, e.g. the web server, see either the old file or the
+# new one, never a partial one.  publish_file moves FILE to DEST in
+# this way, with the ownership and permissions of a published file.
+#
+publish_file() {
+    local TMP=$2.tmp.$$
+    cp $1 $TMP && chown nobody:nobody $TMP && chmod 444 $TMP &&
+            mv -f $TMP $2 && rm -f $1
+}
+
+#
+# Make the soft link LINK to OUTFILE through which recent forecasts
+# are accessed, and put OUTFILE in the store used by the plotting
+# script.  The new link is made under a temporary name and renamed
+# over the old one.  If $OUTFILE somehow hasn't been successfully
+# created, leave the link and the store as they are.
+#
+update_link() {
+    if [ -f $OUTFILE ]; then
+        ln -s $OUTFILE $LINK.tmp.$$
+	chown -h nobody:nobody $LINK.tmp.$$
+        mv -f $LINK.tmp.$$ $LINK
+        forecast_store.py update $FCAST_STORE $OUTFILE
+        chown nobody:nobody $FCAST_STORE
+    fi
+}
+
+#
+# If am's absorption coefficient cache is enabled but has not been
+# made yet, warm it up on the latest GFS cycle.  The am run times
+# without the cache, and with it cold and warm, are logged.
+#
+if [ -n "$AM_CACHE_PATH" ] && [ ! -d $AM_CACHE_PATH ]; then
+    am_coef_cache.py warm $LAT $LON $ALT $GFS_LATEST \
+            >> am_coef_cache.log 2>&1
+fi
+
+mkdir -p $CYCLES_DIR
+find $CYCLES_DIR -mindepth 1 -maxdepth 1 -mtime +$CYCLES_KEEP_DAYS \
+        -exec rm -rf {} +
+SURROGATE=
+if [ -f $SURROGATE_MODEL ]; then
+    SURROGATE="--surrogate $SURROGATE_MODEL"
+fi
+date >> errors.log
+forecast_pipeline.py $LAT $LON $ALT $GFS_LATEST $CYCLES_DIR $SITE_FCAST_DIR \
+        --concurrent $PIPELINE_CONCURRENT \
+        --stall-timeout $PIPELINE_STALL_TIMEOUT \
+        --stall-limit $PIPELINE_STALL_LIMIT \
+        --verify $VERIFY_INDEX $SURROGATE 2>> errors.log
+
+#
+# Publish the tables, owned by nobody and read-only, and link them.
 #
-EXPECTED_TABLE_LINES=210
 for HOURS_AGO in 00 06 12 18 24 30 36 42 48; do
-    export GFS_CYCLE=$(relative_gfs_cycle_time.py $GFS_LATEST -$HOURS_AGO)
+    GFS_CYCLE=$(relative_gfs_cycle_time.py $GFS_LATEST -$HOURS_AGO)
     BASENAME=$(make_gfs_timestamp.py $GFS_CYCLE 0)
     YEAR=${BASENAME:0:4}
     OUTFILE=$SITE_FCAST_DIR/$YEAR/$BASENAME
-    #
-    # If the subdirectory for YEAR doesn't exist, make it
-    #
-    if [ ! -d $SITE_FCAST_DIR/$YEAR ]; then
-        mkdir $SITE_FCAST_DIR/$YEAR
-    fi
-    #
-    # If the file doesn't exist, make it
-    #
-    if [ ! -e $OUTFILE ]; then
-        make_forecast_table.sh > $OUTFILE
-    fi
-    #
-    # If the file exists but is missing lines, re-make it.
-    #
-    TABLE_LINES=$(wc -l $OUTFILE | awk '{print $1}')
-    if [ $TABLE_LINES -lt $EXPECTED_TABLE_LINES ]; then
-        make_forecast_table.sh > $OUTFILE
-    fi
-    chown nobody:nobody $OUTFILE
-    chmod 444 $OUTFILE
-    #
-    # Make the soft link that is used by the plotting script to
-    # access recent forecasts.  If $OUTFILE somehow hasn't been
-    # successfully created, leave the link as is.
-    #
     if [ $HOURS_AGO -eq 0 ]; then
         LINK=$SITE_FCAST_DIR/latest
     else
         LINK=$SITE_FCAST_DIR/latest-$HOURS_AGO
     fi
     if [ -f $OUTFILE ]; then
-        ln -f -s $OUTFILE $LINK
-	chown -h nobody:nobody $LINK
+        chown nobody:nobody $OUTFILE
+        chmod 444 $OUTFILE
     fi
+    update_link
 done
 
 #
-# Generate the plots and move the plot images to the data
-# directory.
+# Refit the surrogate model for am on the forecast hours computed by
+# am in the cycles kept in CYCLES_DIR (see surrogate.py).  The fit
+# and its error on the most recent cycles, which are held out, are
+# logged.
+#
+surrogate.py fit $SURROGATE_MODEL $CYCLES_DIR/* >> surrogate.log 2>&1
+
+#
+# Keep am's absorption coefficient cache within its budget.
+#
+if [ -n "$AM_CACHE_PATH" ]; then
+    am_coef_cache.py prune >> am_coef_cache.log 2>&1
+fi
+
+#
+# Generate the plots and publish the plot images in the plot
+# directory.  The plots for all the PLOT_HOURS are made by one run of
+# plot_forecast.py, which reads the forecasts, computes sunrise and
+# sunset, and builds the static parts of the figure once for all of
+# them, logging the time taken to render each plot to plot.log.
+# Plots are made in this directory, so overlapping jobs take turns,
+# under a lock.
 #
-plot_forecast.py "$SITE" $LAT $LON $ALT "$TZ" $AM_VERSION $SITE_FCAST_DIR 120
-plot_forecast.py "$SITE" $LAT $LON $ALT "$TZ" $AM_VERSION $SITE_FCAST_DIR 384
-chown nobody:nobody forecast*.png
-chmod 444 forecast*.png
-mv forecast*.png $SITE_FCAST_PLOT_DIR
+PLOT_HOURS="120 384"
+(
+    flock 9
+    plot_forecast.py "$SITE" $LAT $LON $ALT "$TZ" $AM_VERSION \
+            $SITE_FCAST_DIR $PLOT_HOURS --store $FCAST_STORE \
+            ${AM_BANDS:+--bands} 2>> plot.log
+    for PLOT in forecast*.png; do
+        publish_file $PLOT $SITE_FCAST_PLOT_DIR/$PLOT
+    done
+) 9> plot.lock
 
 conda deactivate
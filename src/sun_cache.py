@@ -0,0 +1,136 @@
+#
+# sun_cache.py - on-disk cache of the sunrise and sunset times at a
+# site, for the night shading in plot_forecast.py.  Finding these
+# with Skyfield means loading the timescale and the ephemeris, and
+# searching for the events over the whole x axis of a plot, every
+# time a plot is made, although the site never moves.  This module
+# is not run directly; it is imported by plot_forecast.py.
+#
+# The events for each site are kept in a NumPy .npz file named for
+# the site latitude, longitude, and altitude, holding the rise/set
+# times (datetime64[us], UTC), a matching array of flags, True for
+# rising and False for setting, and the start and end of the window
+# of time searched.  A request for the events in a window that the
+# cache covers is answered from the file, without Skyfield.
+# Otherwise, the events are searched for with Skyfield, and the
+# cache updated: if the window starts within the cached window, only
+# the time from its end onward is searched, out to CACHE_DAYS beyond
+# the end of the requested window, so that the cache is extended
+# only once every few months, and events more than KEEP_DAYS before
+# the start of the requested window are dropped.  If not, the cache
+# is made anew, from KEEP_DAYS before the requested window.  The file
+# is written under a temporary name and renamed into place, so that
+# concurrent readers never see a partial file.
+#
+# The cache is configured in the environment:
+#
+#   SUN_CACHE_DIR - cache directory.  If unset or empty, the events
+#                   are searched for with Skyfield every time.
+#
+
+import datetime
+import os
+
+import numpy as np
+import skyfield.api as sf
+from skyfield import almanac
+
+CACHE_DIR = os.getenv('SUN_CACHE_DIR', '')
+
+CACHE_DAYS = 120    # Time searched ahead of the requested window [d]
+KEEP_DAYS  = 30     # Time kept behind the requested window [d]
+
+EPHEMERIS = 'de421.bsp'
+
+_skyfield = {}
+
+
+#
+# Return the rise/set times at a site from tmin to tmax, given as
+# datetime64 values, searched for with Skyfield, as a datetime64[us]
+# array, and an array of flags, True for rising, False for setting.
+# The timescale and ephemeris are loaded on first use.
+#
+def find_events(lat, lon, alt, tmin, tmax):
+    if not _skyfield:
+        _skyfield['ts'] = sf.load.timescale()
+        _skyfield['e']  = sf.load(EPHEMERIS)   # cached locally
+    ts = _skyfield['ts']
+    site = sf.Topos(latitude_degrees=lat, longitude_degrees=lon,
+            elevation_m=alt)
+    utc = datetime.timezone.utc
+    tsun, rise = almanac.find_discrete(
+            ts.utc(tmin.astype(datetime.datetime).replace(tzinfo=utc)),
+            ts.utc(tmax.astype(datetime.datetime).replace(tzinfo=utc)),
+            almanac.sunrise_sunset(_skyfield['e'], site))
+    times = np.array([t.replace(tzinfo=None) for t in tsun.utc_datetime()],
+            dtype="M8[us]")
+    return times, np.asarray(rise, dtype=bool)
+
+
+class SunCache:
+
+    def __init__(self, lat, lon, alt, path=CACHE_DIR):
+        self.lat = lat
+        self.lon = lon
+        self.alt = alt
+        os.makedirs(path, exist_ok=True)
+        self.file = os.path.join(path,
+                "sun_{0:.4f}_{1:.4f}_{2:.0f}.npz".format(lat, lon, alt))
+
+    #
+    # Return the cached window and events, or None if there are none.
+    #
+    def _load(self):
+        try:
+            with np.load(self.file) as f:
+                return f["start"][()], f["end"][()], f["times"], f["rise"]
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def _save(self, start, end, times, rise):
+        tmppath = self.file + ".{0}.tmp.npz".format(os.getpid())
+        np.savez(tmppath, start=start, end=end, times=times, rise=rise)
+        os.replace(tmppath, self.file)
+
+    #
+    # Return the rise/set times from tmin to tmax, as for
+    # find_events(), from the cache if it covers them, and otherwise
+    # from Skyfield, updating the cache.
+    #
+    def events(self, tmin, tmax):
+        tmin = np.datetime64(tmin, 'us')
+        tmax = np.datetime64(tmax, 'us')
+        cached = self._load()
+        if cached is None or not (cached[0] <= tmin <= cached[1]):
+            start = tmin - np.timedelta64(KEEP_DAYS, 'D')
+            end   = tmax + np.timedelta64(CACHE_DAYS, 'D')
+            times, rise = find_events(self.lat, self.lon, self.alt,
+                    start, end)
+            self._save(start, end, times, rise)
+        elif tmax <= cached[1]:
+            start, end, times, rise = cached
+        else:
+            start, end, times, rise = cached
+            new_end = tmax + np.timedelta64(CACHE_DAYS, 'D')
+            new_times, new_rise = find_events(self.lat, self.lon, self.alt,
+                    end, new_end)
+            later = new_times > end
+            keep  = times >= tmin - np.timedelta64(KEEP_DAYS, 'D')
+            start = max(start, tmin - np.timedelta64(KEEP_DAYS, 'D'))
+            times = np.concatenate((times[keep], new_times[later]))
+            rise  = np.concatenate((rise[keep], new_rise[later]))
+            end   = new_end
+            self._save(start, end, times, rise)
+        window = (times >= tmin) & (times <= tmax)
+        return times[window], rise[window]
+
+
+#
+# Return a cache for a site using the directory set in the
+# environment, or None if caching is not configured.
+#
+def default_cache(lat, lon, alt):
+    if not CACHE_DIR:
+        return None
+    return SunCache(lat, lon, alt)
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+#
+# surrogate.py - fast surrogate for am at 225 GHz.  This evaluates
+# tau225 and Tb directly from a few column quantities of the model
+# layers, using a regression fitted to am results, taking
+# microseconds per forecast hour instead of a run of am.  It is used
+# for quick-look, provisional forecast tables, which
+# forecast_pipeline.py publishes as soon as all the hours of a cycle
+# have been converted, and which are replaced by the tables computed
+# with am as those hours are completed.
+#
+# The features of a forecast hour, computed by features() from the
+# layers returned by gfs16_to_am10.derive_layers(), are
+#
+#   pwv - precipitable water vapor [mm]
+#   lwp - cloud liquid water path [kg * m^-2]
+#   ice - cloud ice path, including supercooled liquid [kg * m^-2]
+#   o3  - ozone column [DU]
+#   T_w - water vapor weighted mean temperature [K]
+#   T_s - site temperature [K]
+#   P_s - site pressure [mbar]
+#
+# Water vapor is computed from RH with the Magnus formulas for
+# saturation vapor pressure, which differ slightly from those in am;
+# this is absorbed into the fit.  tau is fitted by linear least
+# squares on a polynomial basis in these features.  Tb is then
+# fitted as an effective emission temperature, linear in T_w and T_s,
+# times the emissivity 1 - exp(-tau) for the fitted tau.
+#
+# Training data come from the cycle state directories (see
+# forecast_manifest.py), which record the features of each hour
+# computed by am along with its am result.  sma-met-forecast_job.sh
+# refits the model after each run on the cycles it keeps, those of
+# the last CYCLES_KEEP_DAYS days.  Directories with no manifest, e.g.
+# those removed as they expire while the data are read, are skipped,
+# as are rows which are not valid am results, such as the rows of
+# zeros recorded for failed am runs before these were detected.
+# Used as a script, this takes a command, a model file, and cycle
+# state directories:
+#
+#   surrogate.py fit MODEL DIR ... [--holdout FRACTION]
+#       fit the model to the hours in the given directories, and save
+#       it.  The most recent cycles, by directory name, are held out
+#       of the fit, and the error against am on them is reported.
+#   surrogate.py validate MODEL DIR ...
+#       report the error of a saved model against am on the hours in
+#       the given directories, and the evaluation time.
+#
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from forecast_manifest import Manifest
+from gfs16_to_am10 import (G_STD, H2O_RHI, H2O_VMR, M_AIR, PASCAL_ON_MBAR,
+    STRAT_H2O_VMR)
+
+FEATURES = ("pwv", "lwp", "ice", "o3", "T_w", "T_s", "P_s")
+
+# Physical constants
+M_H2O    = 18.015          # H2O mass [g / mole]
+AVOGADRO = 6.02214076e23   # [1 / mole]
+M2_ON_DU = 2.6868e20       # column density of 1 DU [m^-2]
+T_ICE    = 273.15          # [K]
+
+
+#
+# Saturation vapor pressure [mbar] over water and over ice, at
+# temperature T [K], from the Magnus formulas.
+#
+def e_sat_water(T):
+    t = T - T_ICE
+    return 6.1094 * np.exp(17.625 * t / (t + 243.04))
+
+
+def e_sat_ice(T):
+    t = T - T_ICE
+    return 6.1121 * np.exp(22.587 * t / (t + 273.86))
+
+
+#
+# Water vapor volume mixing ratio on layers with h2o column code
+# h2o (gfs16_to_am10.H2O_*), RH [%], mean temperature T [K], and mean
+# pressure P [mbar].
+#
+def h2o_vmr(h2o, RH, T, P):
+    with np.errstate(over='ignore', invalid='ignore'):
+        e = np.where(h2o == H2O_RHI, e_sat_ice(T), e_sat_water(T))
+        return np.where(h2o == H2O_VMR, STRAT_H2O_VMR, 0.01 * RH * e / P)
+
+
+#
+# Compute the surrogate features from layers returned by
+# derive_layers(), for any number of leading axes, returning an
+# array of shape (..., len(FEATURES)).
+#
+def features(layers):
+    P    = layers["Pbase"]
+    T    = layers["T"]
+    nlev = P.shape[-1]
+    used = np.arange(nlev) < layers["nlayers"][..., np.newaxis]
+    base = layers["base"]
+
+    P_top = np.concatenate((np.zeros(P.shape[:-1] + (1,)), P[..., :-1]),
+            axis=-1)
+    T_mid = T.copy()
+    T_mid[..., 1:] = 0.5 * (T[..., :-1] + T[..., 1:])
+    m = np.where(used, PASCAL_ON_MBAR * (P - P_top) / G_STD, 0.0)
+    vmr = h2o_vmr(layers["h2o"], layers["RH"], T_mid, 0.5 * (P + P_top))
+
+    #
+    # The base layer runs from the lowest level above the site down
+    # to the site.
+    #
+    k = np.clip(layers["nlayers"] - 1, 0, nlev - 1)[..., np.newaxis]
+    P_b = np.take_along_axis(P, k, axis=-1)[..., 0]
+    T_b = np.take_along_axis(T, k, axis=-1)[..., 0]
+    with np.errstate(invalid='ignore'):
+        m_s = np.where(base,
+                PASCAL_ON_MBAR * np.maximum(layers["P_s"] - P_b, 0.0) / G_STD,
+                0.0)
+    T_mid_s = 0.5 * (layers["T_s"] + T_b)
+    vmr_s = h2o_vmr(layers["h2o_s"], layers["RH_s"], T_mid_s,
+            0.5 * (layers["P_s"] + P_b))
+
+    w   = vmr * m * (M_H2O / M_AIR)
+    w_s = np.where(base, vmr_s * m_s * (M_H2O / M_AIR), 0.0)
+    pwv = w.sum(axis=-1) + w_s
+    lwp = (np.where(used, layers["lwp"], 0.0).sum(axis=-1) +
+            np.where(base, layers["lwp_s"], 0.0))
+    ice = (np.where(used, layers["lwp_ice"] + layers["iwp"], 0.0).sum(axis=-1)
+            + np.where(base, layers["lwp_ice_s"] + layers["iwp_s"], 0.0))
+    o3  = ((layers["o3"] * m).sum(axis=-1) +
+            np.where(base, layers["o3_s"] * m_s, 0.0)) * (
+            1e3 * AVOGADRO / (M_AIR * M2_ON_DU))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        T_w = np.where(pwv > 0.0,
+                ((w * T_mid).sum(axis=-1) + w_s * T_mid_s) / pwv,
+                layers["T_s"])
+    return np.stack((pwv, lwp, ice, o3, T_w, layers["T_s"], layers["P_s"]),
+            axis=-1)
+
+
+#
+# Regression bases for tau, in the features F, and for Tb, in the
+# features and tau.
+#
+def _tau_basis(F):
+    pwv, lwp, ice, o3, T_w, T_s, P_s = np.moveaxis(F, -1, 0)
+    return np.stack((np.ones_like(pwv), pwv, pwv**2, pwv * (T_w - T_ICE),
+            pwv * P_s / 1000., lwp, lwp**2, ice, o3, P_s / 1000.), axis=-1)
+
+
+def _Tb_basis(F, tau):
+    T_w, T_s = F[..., 4], F[..., 5]
+    x = 1.0 - np.exp(-tau)
+    return np.stack((np.ones_like(x), x, x * T_w, x * T_s), axis=-1)
+
+
+class Surrogate:
+
+    def __init__(self, tau_coef, Tb_coef, info=None):
+        self.tau_coef = np.asarray(tau_coef, dtype=float)
+        self.Tb_coef  = np.asarray(Tb_coef, dtype=float)
+        self.info     = {} if info is None else info
+
+    #
+    # Fit to features F of shape (n, len(FEATURES)), and am results
+    # tau and Tb of shape (n,).
+    #
+    @classmethod
+    def fit(cls, F, tau, Tb):
+        tau_coef = np.linalg.lstsq(_tau_basis(F), tau, rcond=None)[0]
+        tau_fit  = _tau_basis(F) @ tau_coef
+        Tb_coef  = np.linalg.lstsq(_Tb_basis(F, tau_fit), Tb, rcond=None)[0]
+        return cls(tau_coef, Tb_coef, {"n_train": len(tau)})
+
+    #
+    # Evaluate tau and Tb for features F of shape (..., len(FEATURES)).
+    #
+    def predict(self, F):
+        tau = _tau_basis(F) @ self.tau_coef
+        Tb  = _Tb_basis(F, tau) @ self.Tb_coef
+        return tau, Tb
+
+    def save(self, path):
+        model = dict(self.info)
+        model.update({
+            "features": FEATURES,
+            "tau_coef": self.tau_coef.tolist(),
+            "Tb_coef":  self.Tb_coef.tolist(),
+            })
+        tmppath = path + ".tmp"
+        with open(tmppath, 'w') as f:
+            json.dump(model, f, indent=1)
+        os.replace(tmppath, path)
+
+
+def load(path):
+    with open(path) as f:
+        model = json.load(f)
+    if tuple(model.pop("features")) != FEATURES:
+        raise ValueError("surrogate model {0} has other features".format(path))
+    return Surrogate(model.pop("tau_coef"), model.pop("Tb_coef"), model)
+
+
+#
+# Return the am tau and Tb in a table row, or None if the row is not
+# a valid am result.
+#
+def _row_result(row):
+    fields = row.split()
+    try:
+        tau, Tb = float(fields[1]), float(fields[2])
+    except (IndexError, ValueError):
+        return None
+    if not (np.isfinite(tau) and np.isfinite(Tb) and tau > 0. and Tb > 0.):
+        return None
+    return tau, Tb
+
+
+#
+# Collect the features and am results of the completed hours in a
+# list of cycle state directories.  Returns arrays F, tau, Tb, and an
+# array giving the index of the directory each hour came from.
+# Directories with no manifest, including any removed while they are
+# read, and rows which are not valid am results, are skipped.
+#
+def training_data(cycle_dirs):
+    F, tau, Tb, group = [], [], [], []
+    for n, cycle_dir in enumerate(cycle_dirs):
+        manifest = Manifest(cycle_dir, create=False)
+        if not manifest.exists():
+            continue
+        for prod, feats in sorted(manifest.features().items()):
+            if len(feats) != len(FEATURES):
+                continue
+            try:
+                result = _row_result(manifest.row(prod))
+            except FileNotFoundError:
+                continue
+            if result is None or not np.all(np.isfinite(feats)):
+                continue
+            F.append(feats)
+            tau.append(result[0])
+            Tb.append(result[1])
+            group.append(n)
+    return (np.array(F).reshape(-1, len(FEATURES)), np.array(tau),
+            np.array(Tb), np.array(group, dtype=int))
+
+
+#
+# Report the error of a model against am results.
+#
+def report(model, F, tau, Tb, label):
+    if len(tau) == 0:
+        print("{0}: no data.".format(label))
+        return
+    t0 = time.monotonic()
+    tau_s, Tb_s = model.predict(F)
+    t_eval = time.monotonic() - t0
+    for name, x, x_s in (("tau225", tau, tau_s), ("Tb[K]", Tb, Tb_s)):
+        err = x_s - x
+        print("{0}: {1:>7s} rms error {2:.3e}, max error {3:.3e}, "
+                "bias {4:.3e}".format(label, name,
+                np.sqrt(np.mean(err**2)), np.max(np.abs(err)), np.mean(err)))
+    print("{0}: {1} hours, evaluated in {2:.3f} us per hour.".format(
+            label, len(tau), 1e6 * t_eval / len(tau)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command",  help="fit or validate",
+        choices=("fit", "validate"))
+    parser.add_argument("model",    help="surrogate model file",
+        type=str)
+    parser.add_argument("dirs",     help="cycle state directories",
+        nargs="+")
+    parser.add_argument("--holdout",
+        help="fraction of cycles held out of the fit (default 0.2)",
+        type=float, default=0.2)
+    args = parser.parse_args()
+
+    if (args.holdout < 0. or args.holdout >= 1.):
+        parser.error("invalid holdout fraction")
+    dirs = sorted(d for d in args.dirs if os.path.isdir(d))
+    if (args.command == "fit"):
+        nhold = int(round(args.holdout * len(dirs)))
+        F, tau, Tb, _ = training_data(dirs[:len(dirs) - nhold])
+        if len(tau) < len(_tau_basis(np.zeros(len(FEATURES)))):
+            print("Too few hours to fit.", file=sys.stderr)
+            exit(1)
+        model = Surrogate.fit(F, tau, Tb)
+        model.info["am_version"] = os.getenv('AM_VERSION', '')
+        report(model, F, tau, Tb, "training")
+        F, tau, Tb, _ = training_data(dirs[len(dirs) - nhold:])
+        report(model, F, tau, Tb, "held out")
+        model.save(args.model)
+    else:
+        F, tau, Tb, _ = training_data(dirs)
+        report(load(args.model), F, tau, Tb, "validation")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+#
+# verify.py - forecast verification against the GFS analyses.  For
+# each forecast lead time, this compares the forecasts made at that
+# lead with the analysis (the 0 hour forecast) of the cycle at the
+# same valid time, over all the cycles in an index of archived
+# forecast tables, and reports how the error grows with lead time.
+# Since analyses are only made every 6 hours, only leads which are
+# multiples of 6 hours are verified.
+#
+# The index is a binary file of fixed-size records, one per cycle,
+# each holding the analysis time of the cycle and, for each of the
+# table columns in INDEX_COLUMNS, its value at each of the forecast
+# hours listed in gfs_products.py (nan where missing).  New cycles
+# are appended to it as they land, so keeping it up to date never
+# requires rescanning the archive.  If a cycle is added more than
+# once, e.g. after a table is remade, the last record added for it is
+# the one used.  Appends are serialized with a lock on the index
+# file, and a partial record left by an interrupted append is
+# dropped.
+#
+# To verify, the records are laid out in an array indexed by cycle
+# (in steps of 6 hours) and forecast hour.  The forecast made by
+# cycle k at lead 6 m hours then verifies against the analysis of
+# cycle k + m, so the errors at every lead are computed at once by
+# offsetting the analysis column of this array.
+#
+# Used as a script, this takes a command and an index file:
+#
+#   verify.py add INDEX TABLE ...
+#       add the forecast tables, named for their cycles as in
+#       sma-met-forecast_job.sh, to the index, making it if need be
+#   verify.py stats INDEX [--column NAME] [--start DATE] [--end DATE]
+#       print the number of forecasts verified, the bias, the rms
+#       error, and percentiles of the error for each lead time, for
+#       the column NAME (default tau225), over cycles from DATE to
+#       DATE (YYYYMMDD)
+#
+
+import argparse
+import datetime
+import fcntl
+import os
+import sys
+import warnings
+
+import numpy as np
+
+import forecast_store
+from gfs_products import FORECAST_HOURS
+
+INDEX_COLUMNS = ("tau225", "Tb[K]", "pwv[mm]", "lwp[kg*m^-2]",
+        "iwp[kg*m^-2]", "o3[DU]")
+PERCENTILES   = (5, 25, 50, 75, 95)
+
+INDEX_DTYPE = np.dtype([("cycle", "<M8[s]")] +
+        [(name, "<f8", (len(FORECAST_HOURS),)) for name in INDEX_COLUMNS])
+
+
+#
+# Append the forecast table for the cycle with the given analysis
+# time to the index at path.
+#
+def add(path, cycle, table):
+    _, _, values = forecast_store.parse_table(cycle, table)
+    rec = np.zeros(1, dtype=INDEX_DTYPE)
+    rec["cycle"] = np.datetime64(cycle, 's')
+    for name in INDEX_COLUMNS:
+        rec[name] = values.get(name, np.nan)
+    with open(path, 'ab') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        #
+        # Drop any partial record left at the end by an interrupted
+        # append, so that the records stay aligned.
+        #
+        f.truncate(f.seek(0, os.SEEK_END) // INDEX_DTYPE.itemsize *
+                INDEX_DTYPE.itemsize)
+        f.write(rec.tobytes())
+
+
+#
+# Load the index, memory-mapped, keeping only the last record for
+# each cycle.  Returns the records sorted by cycle.
+#
+def load(path):
+    nrec = os.path.getsize(path) // INDEX_DTYPE.itemsize
+    if nrec == 0:
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    recs = np.memmap(path, dtype=INDEX_DTYPE, mode='r', shape=(nrec,))
+    _, last = np.unique(recs["cycle"][::-1], return_index=True)
+    return recs[nrec - 1 - last]
+
+
+#
+# Compute the verification statistics for one column over a set of
+# index records.  Returns the lead times verified [h], and for each,
+# the number of forecasts verified, the bias, the rms error, and the
+# error at each of PERCENTILES, as arrays.
+#
+def statistics(recs, column):
+    hours  = np.array(FORECAST_HOURS)
+    leads  = np.nonzero(hours % 6 == 0)[0]
+    nlead  = len(leads)
+    if len(recs) == 0:
+        return (hours[leads], np.zeros(nlead, dtype=int),
+                np.full(nlead, np.nan), np.full(nlead, np.nan),
+                np.full((len(PERCENTILES), nlead), np.nan))
+    k = ((recs["cycle"] - recs["cycle"][0]) //
+            np.timedelta64(6, 'h')).astype(int)
+    #
+    # Lay the records out by cycle, with nan for missing cycles,
+    # padded with enough missing cycles at the end that every lead
+    # has an analysis to offset to.
+    #
+    m = hours[leads] // 6
+    x = np.full((k[-1] + 1 + m[-1], len(hours)), np.nan)
+    x[k] = recs[column]
+    analysis = x[:, 0]
+    n = k[-1] + 1
+    err = x[:n, leads] - analysis[np.arange(n)[:, np.newaxis] + m]
+
+    count = np.sum(~np.isnan(err), axis=0)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)  # no data
+        bias = np.nanmean(err, axis=0)
+        rms  = np.sqrt(np.nanmean(err**2, axis=0))
+        pct  = np.nanpercentile(err, PERCENTILES, axis=0)
+    return hours[leads], count, bias, rms, pct
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", help="add or stats",
+        choices=("add", "stats"))
+    parser.add_argument("index",   help="verification index file",
+        type=str)
+    parser.add_argument("tables",  help="for add: forecast table files",
+        nargs="*")
+    parser.add_argument("--column",
+        help="for stats: column to verify (default tau225)",
+        choices=INDEX_COLUMNS, default="tau225")
+    parser.add_argument("--start",
+        help="for stats: first cycle date (YYYYMMDD)",
+        type=str)
+    parser.add_argument("--end",
+        help="for stats: last cycle date (YYYYMMDD)",
+        type=str)
+    args = parser.parse_args()
+
+    if (args.command == "add"):
+        nfail = 0
+        for fpath in args.tables:
+            try:
+                cycle = datetime.datetime.strptime(os.path.basename(fpath),
+                        "%Y%m%d_%H:%M:%S")
+                with open(fpath) as f:
+                    add(args.index, cycle, f.read())
+            except (OSError, ValueError) as err:
+                print("{0}: {1}".format(fpath, err), file=sys.stderr)
+                nfail += 1
+        exit(1 if nfail else 0)
+
+    if not os.path.exists(args.index):
+        parser.error("no index {0}".format(args.index))
+    recs = load(args.index)
+    try:
+        if args.start is not None:
+            start = np.datetime64(datetime.datetime.strptime(args.start,
+                    "%Y%m%d"), 's')
+            recs = recs[recs["cycle"] >= start]
+        if args.end is not None:
+            end = np.datetime64(datetime.datetime.strptime(args.end,
+                    "%Y%m%d") + datetime.timedelta(days=1), 's')
+            recs = recs[recs["cycle"] < end]
+    except ValueError:
+        parser.error("invalid date")
+    leads, count, bias, rms, pct = statistics(recs, args.column)
+    print("# {0} error against analysis, {1} cycles".format(
+            args.column, len(recs)))
+    print("#lead {0:>7s} {1:>12s} {2:>12s}".format("n", "bias", "rms") +
+            "".join(" {0:>12s}".format("p{0}".format(p))
+            for p in PERCENTILES))
+    for j, lead in enumerate(leads):
+        print("{0:5d} {1:7d} {2:12.4e} {3:12.4e}".format(
+                lead, count[j], bias[j], rms[j]) +
+                "".join(" {0:12.4e}".format(x) for x in pct[:, j]))
+
+
+if __name__ == "__main__":
+    main()